@@ -1,11 +1,38 @@
 import streamlit as st
-import anthropic
-import openai
 import requests
+import contextvars
 import json
 import os
+import queue
+import re
+import sys
+import threading
+import time
 from pathlib import Path
 
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+from async_providers import ANTHROPIC_MODELS, CALYPSO_BASE_URL, CALYPSO_SCAN_URL, OPENAI_MODELS, BackgroundLoop
+import async_providers
+from cache import SqliteStore, TTLCache, hash_key, verdict_cache_key
+from clients import ClientRegistry
+from context import context_budget, fit_to_budget, message_tokens
+from conversation_store import ConversationStore
+from local_pool import STRATEGIES, EndpointPool, parse_endpoints
+import metrics
+import tracing
+from routing import CURRENT_CANCEL, CancelScope, Router, close_on_cancel, is_error_chunk, stream_cancelled
+from ratelimit import AdmissionControl, AdmissionTimeout
+from resilience import (
+    BREAKERS, CircuitOpenError, RetryableStatusError, call_with_retry, entered_with_retry,
+    raise_for_retryable_status
+)
+from prompt_cache import anthropic_messages, anthropic_usage, local_cache_options, openai_usage
+from prefilter import Prefilter, default_prefilter
+from pricing import turn_cost
+from semantic_cache import SemanticCache, load_embedder
+from settings_store import SETTINGS_FILE, SettingsStore, forwarded_user
+
 # Page configuration
 st.set_page_config(
     page_title="Coffee Shop AI Assistant",
@@ -14,32 +41,198 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# File-based persistence
-SETTINGS_FILE = Path.home() / ".coffee_ai_settings.json"
+# Timed to track the cost of a full script run
+run_started = time.perf_counter()
+
+STYLESHEET_FILE = Path(__file__).with_name("style.css")
+# Messages rendered before "Show earlier messages"
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+
+@st.cache_resource
+def get_client_registry() -> ClientRegistry:
+    """Pooled provider clients shared across reruns and sessions"""
+    return ClientRegistry()
+
+@st.cache_resource
+def get_background_loop() -> BackgroundLoop:
+    """Event loop thread (with its own client pools) for the async backend"""
+    return BackgroundLoop()
+
+# Local server replica health checking
+LOCAL_HEALTH_INTERVAL = float(os.getenv("LOCAL_HEALTH_INTERVAL", "10"))
+LOCAL_FAILURE_THRESHOLD = int(os.getenv("LOCAL_FAILURE_THRESHOLD", "3"))
+
+@st.cache_resource(max_entries=8)
+def get_endpoint_pool(urls: tuple, strategy: str) -> EndpointPool:
+    """Load balancer for one set of Local server replicas"""
+    return EndpointPool(
+        list(urls),
+        strategy,
+        failure_threshold=LOCAL_FAILURE_THRESHOLD,
+        # A single server has nothing to fail over to, so skip probing it
+        health_interval=LOCAL_HEALTH_INTERVAL if len(urls) > 1 else 0
+    )
+
+def get_local_pool() -> EndpointPool:
+    """Load balancer for the primary Local server and its configured replicas"""
+    urls = parse_endpoints(
+        f"{st.session_state.local_host}:{st.session_state.local_port}\n{st.session_state.local_endpoints}"
+    )
+    return get_endpoint_pool(tuple(urls), st.session_state.lb_strategy)
+
+@st.cache_resource
+def get_router() -> Router:
+    """Failover/hedging router whose TTFT history is shared by all sessions"""
+    return Router()
+
+@st.cache_resource
+def get_admission_control() -> AdmissionControl:
+    """Rate limits and request queues shared by every session on this server"""
+    return AdmissionControl()
+
+@st.cache_resource
+def get_metrics_exporter():
+    """Prometheus endpoint on METRICS_PORT, started once per server process"""
+    if not metrics.METRICS_PORT:
+        return None
+    try:
+        return metrics.start_exporter(metrics.METRICS_PORT, metrics.METRICS_HOST)
+    except OSError as e:
+        # Usually another app process on this host already serves the port, but say so either way
+        print(f"⚠️ Metrics endpoint not started on {metrics.METRICS_HOST}:{metrics.METRICS_PORT}: {e}",
+              file=sys.stderr)
+        return None
+
+get_metrics_exporter()
+
+@st.cache_resource
+def get_tracing() -> bool:
+    """Install the OpenTelemetry exporter named by OTEL_TRACES_EXPORTER, once per server process"""
+    return tracing.setup()
+
+get_tracing()
+
+# Fallback targets: every hosted model plus the Local server
+LOCAL_FALLBACK_MODEL = os.getenv("LOCAL_FALLBACK_MODEL", "local-model")
+ROUTE_OPTIONS = (
+    [f"Local · {LOCAL_FALLBACK_MODEL}"]
+    + [f"Anthropic · {name}" for name in ANTHROPIC_MODELS]
+    + [f"OpenAI · {name}" for name in OPENAI_MODELS]
+)
+
+def rerun_requested() -> bool:
+    """True once the user has triggered a rerun or stop of the current run"""
+    # Streamlit has no public API for this; treat unknown internals as "no"
+    ctx = get_script_run_ctx()
+    request_state = getattr(getattr(ctx, "script_requests", None), "_state", None)
+    return request_state is not None and request_state.name != "CONTINUE"
+
+def stop_requested() -> bool:
+    """True once the run is rerun or stopped, or the background stream this feeds is cancelled"""
+    return stream_cancelled() or rerun_requested()
+
+# Guardrails verdict cache (set GUARDRAILS_CACHE_FILE to keep verdicts across restarts)
+GUARDRAILS_CACHE_SIZE = int(os.getenv("GUARDRAILS_CACHE_SIZE", "1024"))
+GUARDRAILS_CACHE_TTL = float(os.getenv("GUARDRAILS_CACHE_TTL", "3600"))
+GUARDRAILS_CACHE_FILE = os.getenv("GUARDRAILS_CACHE_FILE", "")
+
+@st.cache_resource
+def get_verdict_cache() -> TTLCache:
+    """Guardrails verdicts shared across reruns and sessions"""
+    store = SqliteStore(GUARDRAILS_CACHE_FILE, table="verdicts") if GUARDRAILS_CACHE_FILE else None
+    return TTLCache(maxsize=GUARDRAILS_CACHE_SIZE, ttl=GUARDRAILS_CACHE_TTL, store=store)
+
+@st.cache_resource
+def get_prefilter() -> Prefilter:
+    """Local blocklist/allowlist checks shared across sessions (None when GUARDRAILS_PREFILTER=0)"""
+    return default_prefilter()
+
+# Response cache for temperature 0 completions (memory LRU backed by SQLite)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+RESPONSE_CACHE_FILE = os.getenv("RESPONSE_CACHE_FILE", str(Path.home() / ".coffee_ai_responses.db"))
+
+@st.cache_resource
+def get_response_cache() -> TTLCache:
+    """Deterministic completions shared across reruns, sessions and restarts"""
+    store = SqliteStore(RESPONSE_CACHE_FILE, table="responses") if RESPONSE_CACHE_FILE else None
+    return TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, store=store)
+
+# Semantic cache for near-duplicate prompts (SEMANTIC_CACHE_MODEL names an
+# optional sentence-transformers model; hashed n-grams are used otherwise)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "2000"))
+SEMANTIC_CACHE_MODEL = os.getenv("SEMANTIC_CACHE_MODEL", "")
+
+@st.cache_resource
+def get_semantic_cache() -> SemanticCache:
+    """Near-duplicate prompt index shared across reruns and sessions"""
+    return SemanticCache(load_embedder(SEMANTIC_CACHE_MODEL), maxsize=SEMANTIC_CACHE_SIZE)
+
+# Saved conversations of proxy-authenticated users (set CONVERSATIONS_FILE empty to keep them in memory only)
+CONVERSATIONS_FILE = os.getenv("CONVERSATIONS_FILE", str(Path.home() / ".coffee_ai_conversations.db"))
+# Owner of the conversations in an anonymous session's own store
+ANONYMOUS_OWNER = "session"
+# Session state that makes up the conversation, kept when the settings are cleared
+CONVERSATION_STATE = ("conversation_memory", "conversation_id", "messages", "history_shown")
+
+@st.cache_resource
+def get_conversation_store() -> ConversationStore:
+    """Conversations shared by every session on this server and kept across restarts"""
+    return ConversationStore(CONVERSATIONS_FILE or ":memory:")
+
+def conversation_store() -> ConversationStore:
+    """This session's conversations: the shared file for a trusted proxy user, else this session's memory"""
+    if settings_user():
+        return get_conversation_store()
+    # An anonymous session cannot be recognised after a reload, so its chats are never
+    # written to disk, where nobody could reopen them; they go when the session does
+    if "conversation_memory" not in st.session_state:
+        st.session_state.conversation_memory = ConversationStore(":memory:")
+    return st.session_state.conversation_memory
+
+def conversation_owner() -> str:
+    """Whose saved conversations this session sees: the trusted proxy user, else this browser session alone"""
+    return settings_user() or ANONYMOUS_OWNER
+
+def open_conversation(conversation_id: str = None, seq: int = None):
+    """Show the latest page of a saved conversation (back to message seq if given), or start a new one with None"""
+    shown = HISTORY_PAGE_SIZE
+    saved = conversation_store().get(conversation_id) if conversation_id else None
+    if saved is None or saved["user"] != conversation_owner():
+        # Missing, or someone else's: start a new conversation instead
+        conversation_id = None
+    elif seq is not None:
+        # Far enough back to show a search match, within ten pages
+        shown = min(max(saved["message_count"] - seq, HISTORY_PAGE_SIZE), HISTORY_PAGE_SIZE * 10)
+    st.session_state.conversation_id = conversation_id
+    st.session_state.history_shown = shown
+    st.session_state.messages = conversation_store().page(conversation_id, shown) if conversation_id else []
+
+@st.cache_resource
+def get_settings_store() -> SettingsStore:
+    """Saved settings shared by every session on this server, written in the background"""
+    return SettingsStore(SETTINGS_FILE)
+
+def settings_user() -> str:
+    """The user an authenticating proxy named in X-Forwarded-User, if trusted ("" shares one file)"""
+    return forwarded_user(st.context.headers)
 
 def load_settings():
     """Load settings from file"""
     try:
-        if SETTINGS_FILE.exists():
-            with open(SETTINGS_FILE, 'r') as f:
-                return json.load(f)
+        return get_settings_store().load(settings_user())
     except Exception as e:
         st.error(f"Error loading settings: {e}")
     return {}
 
 def save_settings(settings):
-    """Save settings to file"""
-    try:
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(settings, f, indent=2)
-    except Exception as e:
-        st.error(f"Error saving settings: {e}")
+    """Queue settings to be saved to file"""
+    get_settings_store().save(settings, settings_user())
 
 def clear_settings():
     """Clear saved settings file"""
     try:
-        if SETTINGS_FILE.exists():
-            SETTINGS_FILE.unlink()
+        get_settings_store().clear(settings_user())
         return True
     except Exception as e:
         st.error(f"Error clearing settings: {e}")
@@ -56,449 +249,46 @@ def save_current_settings():
         "enable_guardrails": st.session_state.enable_guardrails,
         "calypso_api_key": st.session_state.calypso_api_key,
         "temperature": st.session_state.temperature,
-        "max_tokens": st.session_state.max_tokens
+        "max_tokens": st.session_state.max_tokens,
+        "stream_responses": st.session_state.stream_responses,
+        "speculative_guardrails": st.session_state.speculative_guardrails,
+        "cache_responses": st.session_state.cache_responses,
+        "semantic_cache": st.session_state.semantic_cache,
+        "semantic_threshold": st.session_state.semantic_threshold,
+        "context_limit": st.session_state.context_limit,
+        "summarize_context": st.session_state.summarize_context,
+        "prompt_caching": st.session_state.prompt_caching,
+        "async_backend": st.session_state.async_backend,
+        "local_endpoints": st.session_state.local_endpoints,
+        "lb_strategy": st.session_state.lb_strategy,
+        "fallback_chain": st.session_state.fallback_chain,
+        "hedge_requests": st.session_state.hedge_requests,
+        "compare_mode": st.session_state.compare_mode,
+        "compare_routes": st.session_state.compare_routes
     }
     save_settings(settings)
 
-# Custom CSS for cozy coffee shop theme with fall colors
-st.markdown("""
-<style>
-    /* Main background - cream color */
-    .main {
-        background-color: #faf7f2;
-        background-image:
-            linear-gradient(rgba(212, 137, 90, 0.03) 1px, transparent 1px),
-            linear-gradient(90deg, rgba(212, 137, 90, 0.03) 1px, transparent 1px);
-        background-size: 20px 20px;
-        color: #000000;
-    }
-
-    /* Ensure all text is black */
-    p, div, span, label, li, td, th {
-        color: #000000 !important;
-    }
-
-    .stApp {
-        background-color: #faf7f2;
-    }
-
-    /* Center chat content */
-    .main .block-container {
-        max-width: 900px;
-        padding-left: 5rem;
-        padding-right: 5rem;
-        padding-bottom: 8rem;
-        padding-top: 2rem;
-        margin: 0 auto;
-    }
-
-    /* Move chat messages up */
-    .main {
-        padding-bottom: 0 !important;
-    }
-
-    /* Sidebar styling */
-    [data-testid="stSidebar"] {
-        background-color: #f5f0e8;
-        border-right: 2px solid #d4895a;
-    }
-
-    [data-testid="stSidebar"] h2 {
-        color: #6b4423;
-    }
-
-    /* Headers */
-    h1 {
-        color: #6b4423;
-        font-weight: 700;
-        padding: 1.5rem 0.5rem;
-        text-shadow: 1px 1px 2px rgba(139, 111, 71, 0.1);
-        text-align: center;
-        background: linear-gradient(135deg, #fff8f0 0%, #f5ead5 50%, #fff8f0 100%);
-        border-radius: 12px;
-        box-shadow: 0 2px 8px rgba(139, 111, 71, 0.1);
-        position: relative;
-    }
-
-    /* Fall leaves decoration for header */
-    h1::before {
-        content: "🍂";
-        position: absolute;
-        left: 20px;
-        top: 50%;
-        transform: translateY(-50%) rotate(-15deg);
-        font-size: 1.5rem;
-        opacity: 0.6;
-    }
-
-    h1::after {
-        content: "🍁";
-        position: absolute;
-        right: 20px;
-        top: 50%;
-        transform: translateY(-50%) rotate(15deg);
-        font-size: 1.5rem;
-        opacity: 0.6;
-    }
-
-    h3 {
-        color: #8b6f47;
-    }
-
-    /* Chat messages */
-    .stChatMessage {
-        padding: 1.2rem;
-        border-radius: 12px;
-        margin-bottom: 1rem;
-        box-shadow: 0 2px 8px rgba(107, 68, 35, 0.08);
-        color: #000000 !important;
-        background-color: #ffffff !important;
-    }
-
-    .stChatMessage p, .stChatMessage div, .stChatMessage span {
-        color: #000000 !important;
-    }
-
-    /* User message - light cream with fall border */
-    [data-testid="stChatMessageContent"][data-testid*="user"] {
-        background-color: #fff8f0 !important;
-        border-left: 4px solid #d4895a;
-        color: #000000 !important;
-    }
-
-    /* Assistant message - warm white with brown border */
-    [data-testid="stChatMessageContent"][data-testid*="assistant"] {
-        background-color: #ffffff !important;
-        border-left: 4px solid #8b6f47;
-        color: #000000 !important;
-    }
-
-    /* Force assistant message container to white */
-    [data-testid="stChatMessage"]:has([data-testid*="assistant"]) {
-        background-color: #ffffff !important;
-    }
-
-    /* Assistant message avatar container */
-    .stChatMessage[data-testid*="assistant"] {
-        background-color: #ffffff !important;
-    }
-
-    /* All child elements in assistant messages */
-    [data-testid*="assistant"] * {
-        background-color: transparent !important;
-    }
-
-    /* Code blocks - make text readable with high specificity */
-    .stChatMessage code,
-    .stChatMessage pre code,
-    [data-testid="stChatMessageContent"] code,
-    [data-testid="stChatMessageContent"] pre code,
-    code {
-        background-color: #f5f0e8 !important;
-        color: #c17344 !important;
-        padding: 0.2rem 0.4rem !important;
-        border-radius: 4px !important;
-        font-family: 'Monaco', 'Menlo', 'Courier New', monospace !important;
-    }
-
-    .stChatMessage pre,
-    [data-testid="stChatMessageContent"] pre,
-    pre {
-        background-color: #2d2d2d !important;
-        border-radius: 8px !important;
-        padding: 1rem !important;
-        border: 1px solid #d4895a !important;
-    }
-
-    .stChatMessage pre code,
-    [data-testid="stChatMessageContent"] pre code,
-    pre code,
-    .stChatMessage pre span,
-    [data-testid="stChatMessageContent"] pre span {
-        background-color: transparent !important;
-        color: #f8f8f2 !important;
-        padding: 0 !important;
-    }
-
-    /* Override black text for code spans */
-    .stChatMessage span code,
-    .stChatMessage div code,
-    .stChatMessage p code {
-        color: #c17344 !important;
-    }
-
-    .stChatMessage pre span,
-    .stChatMessage pre div {
-        color: #f8f8f2 !important;
-    }
-
-    /* Buttons */
-    .stButton > button {
-        border-radius: 8px;
-        width: 100%;
-        background-color: #c17344;
-        color: white;
-        font-weight: 600;
-        border: none;
-        transition: all 0.3s;
-        box-shadow: 0 2px 4px rgba(193, 115, 68, 0.2);
-    }
-
-    .stButton > button:hover {
-        background-color: #a85e35;
-        box-shadow: 0 4px 12px rgba(193, 115, 68, 0.3);
-    }
-
-    /* Clear buttons - transparent background with border */
-    button[kind="secondary"],
-    .stButton > button[kind="secondary"],
-    button[data-testid="baseButton-secondary"],
-    [data-testid="stSidebar"] .stButton > button[kind="secondary"],
-    [data-testid="stSidebar"] button[data-testid="baseButton-secondary"],
-    [data-testid="stSidebar"] button[kind="secondary"],
-    .stButton button[type="secondary"],
-    .element-container button[kind="secondary"] {
-        background-color: transparent !important;
-        color: #8b6f47 !important;
-        border: 2px solid #d4895a !important;
-        box-shadow: none !important;
-    }
-
-    button[kind="secondary"]:hover,
-    .stButton > button[kind="secondary"]:hover,
-    button[data-testid="baseButton-secondary"]:hover,
-    [data-testid="stSidebar"] .stButton > button[kind="secondary"]:hover,
-    [data-testid="stSidebar"] button[data-testid="baseButton-secondary"]:hover,
-    [data-testid="stSidebar"] button[kind="secondary"]:hover,
-    .stButton button[type="secondary"]:hover,
-    .element-container button[kind="secondary"]:hover {
-        background-color: transparent !important;
-        color: #8b6f47 !important;
-        border: 2px solid #c17344 !important;
-        box-shadow: none !important;
-    }
-
-    /* Force text color on all secondary button text and children */
-    button[kind="secondary"] *,
-    .stButton > button[kind="secondary"] *,
-    button[data-testid="baseButton-secondary"] *,
-    [data-testid="stSidebar"] button[kind="secondary"] *,
-    button[kind="secondary"] p,
-    button[kind="secondary"] span,
-    button[kind="secondary"] div {
-        color: #8b6f47 !important;
-    }
-
-    /* Input fields */
-    .stTextInput > div > div > input,
-    .stNumberInput > div > div > input {
-        border-radius: 8px;
-        border: 2px solid #e6d5c3;
-        background-color: #ffffff;
-        color: #000000 !important;
-    }
-
-    .stTextInput > div > div > input:focus,
-    .stNumberInput > div > div > input:focus {
-        border-color: #d4895a;
-        box-shadow: 0 0 0 2px rgba(212, 137, 90, 0.1);
-    }
-
-    .stTextInput label, .stNumberInput label {
-        color: #6b4423 !important;
-    }
-
-    /* Selectbox */
-    .stSelectbox > div > div {
-        border-radius: 8px;
-        background-color: #ffffff;
-        color: #000000 !important;
-    }
-
-    .stSelectbox label {
-        color: #6b4423 !important;
-    }
-
-    .stSelectbox [data-baseweb="select"] {
-        color: #000000 !important;
-        background-color: #ffffff !important;
-    }
-
-    /* Dropdown menu options */
-    [data-baseweb="popover"] {
-        background-color: #ffffff !important;
-    }
-
-    [data-baseweb="menu"] {
-        background-color: #ffffff !important;
-    }
-
-    [role="listbox"] {
-        background-color: #ffffff !important;
-    }
-
-    [role="option"] {
-        background-color: #ffffff !important;
-        color: #000000 !important;
-    }
-
-    [role="option"]:hover {
-        background-color: #fff8f0 !important;
-        color: #000000 !important;
-    }
-
-    ul[role="listbox"] li {
-        background-color: #ffffff !important;
-        color: #000000 !important;
-    }
-
-    ul[role="listbox"] li:hover {
-        background-color: #fff8f0 !important;
-    }
-
-    /* Checkboxes */
-    .stCheckbox {
-        color: #000000 !important;
-    }
-
-    .stCheckbox label {
-        color: #000000 !important;
-    }
-
-    .stCheckbox span {
-        color: #000000 !important;
-    }
-
-    /* Markdown text */
-    .stMarkdown, .stMarkdown p, .stMarkdown li {
-        color: #000000 !important;
-    }
-
-    /* Expander */
-    .streamlit-expanderHeader {
-        background-color: #fff8f0;
-        border-radius: 8px;
-        color: #6b4423;
-        font-weight: 600;
-    }
-
-    /* Info boxes */
-    .stAlert {
-        background-color: #fff8f0;
-        border-left: 4px solid #d4895a;
-        border-radius: 8px;
-    }
-
-    /* Success message */
-    .stSuccess {
-        background-color: #f0f8f0;
-        border-left: 4px solid #7fb069;
-    }
-
-    /* Divider */
-    hr {
-        border-color: #e6d5c3;
-    }
-
-    /* Caption text */
-    .stCaptionContainer, .caption {
-        color: #8b6f47;
-        text-align: center;
-        background: linear-gradient(135deg, #fff8f0 0%, #f5ead5 50%, #fff8f0 100%);
-        padding: 0.5rem 1rem;
-        border-radius: 8px;
-        margin-bottom: 1rem;
-    }
-
-    /* Chat input */
-    .stChatInput {
-        max-width: 900px;
-        margin: 0 auto;
-        position: relative !important;
-        top: 0 !important;
-        bottom: auto !important;
-    }
-
-    .stChatInputContainer {
-        position: relative !important;
-        bottom: auto !important;
-    }
+@st.cache_data
+def load_stylesheet(mtime: float) -> str:
+    """The theme as a minified <style> block, re-read only when style.css changes"""
+    css = STYLESHEET_FILE.read_text(encoding="utf-8")
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};])\s*", r"\1", css)
+    return f"<style>{css.strip()}</style>"
 
-    [data-testid="stChatInput"] {
-        position: relative !important;
-        bottom: auto !important;
-    }
-
-    .stChatInput > div {
-        background-color: #ffffff;
-        border: 2px solid #e6d5c3;
-        border-radius: 12px;
-        margin-bottom: 2rem;
-    }
-
-    .stChatInput textarea {
-        background-color: #ffffff !important;
-        color: #000000 !important;
-        caret-color: #000000 !important;
-    }
-
-    .stChatInput textarea::placeholder {
-        color: #666666 !important;
-    }
-
-    /* Footer */
-    .footer {
-        position: fixed;
-        bottom: 0;
-        left: 0;
-        width: 100%;
-        background: linear-gradient(135deg, #fff8f0 0%, #f5ead5 50%, #fff8f0 100%);
-        padding: 1rem 2rem;
-        text-align: center;
-        color: #8b6f47;
-        font-size: 0.9rem;
-        border-top: 2px solid #d4895a;
-        box-shadow: 0 -2px 8px rgba(139, 111, 71, 0.1);
-        z-index: 999;
-    }
-
-    .footer::before {
-        content: "🍂 ";
-        opacity: 0.6;
-    }
-
-    .footer::after {
-        content: " 🍁";
-        opacity: 0.6;
-    }
-
-    /* Spinner */
-    .stSpinner > div {
-        border-top-color: #c17344;
-    }
-
-    /* Sliders */
-    .stSlider label {
-        color: #6b4423 !important;
-    }
-
-    .stSlider [data-baseweb="slider"] {
-        color: #000000 !important;
-    }
-
-    /* Info/Alert boxes */
-    .stAlert p, .stInfo p, .stSuccess p, .stWarning p, .stError p {
-        color: #000000 !important;
-    }
-</style>
-""", unsafe_allow_html=True)
+# Custom CSS for cozy coffee shop theme with fall colors
+st.markdown(load_stylesheet(STYLESHEET_FILE.stat().st_mtime), unsafe_allow_html=True)
 
-# Load saved settings from file
-saved_settings = load_settings()
+# Saved settings only seed a new session, so skip the disk read on later reruns
+saved_settings = load_settings() if "messages" not in st.session_state else {}
 
 # Initialize session state with saved values or defaults
 if "messages" not in st.session_state:
+    # Only the messages on screen; the whole conversation lives in the conversation store
     st.session_state.messages = []
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = None
 if "api_key" not in st.session_state:
     st.session_state.api_key = saved_settings.get("api_key", "")
 if "provider" not in st.session_state:
@@ -517,6 +307,36 @@ if "temperature" not in st.session_state:
     st.session_state.temperature = saved_settings.get("temperature", 0.7)
 if "max_tokens" not in st.session_state:
     st.session_state.max_tokens = saved_settings.get("max_tokens", 1024)
+if "stream_responses" not in st.session_state:
+    st.session_state.stream_responses = saved_settings.get("stream_responses", True)
+if "speculative_guardrails" not in st.session_state:
+    st.session_state.speculative_guardrails = saved_settings.get("speculative_guardrails", False)
+if "cache_responses" not in st.session_state:
+    st.session_state.cache_responses = saved_settings.get("cache_responses", False)
+if "semantic_cache" not in st.session_state:
+    st.session_state.semantic_cache = saved_settings.get("semantic_cache", False)
+if "semantic_threshold" not in st.session_state:
+    st.session_state.semantic_threshold = saved_settings.get("semantic_threshold", 0.9)
+if "context_limit" not in st.session_state:
+    st.session_state.context_limit = saved_settings.get("context_limit", 0)
+if "summarize_context" not in st.session_state:
+    st.session_state.summarize_context = saved_settings.get("summarize_context", False)
+if "prompt_caching" not in st.session_state:
+    st.session_state.prompt_caching = saved_settings.get("prompt_caching", True)
+if "async_backend" not in st.session_state:
+    st.session_state.async_backend = saved_settings.get("async_backend", False)
+if "local_endpoints" not in st.session_state:
+    st.session_state.local_endpoints = saved_settings.get("local_endpoints", "")
+if "lb_strategy" not in st.session_state:
+    st.session_state.lb_strategy = saved_settings.get("lb_strategy", STRATEGIES[0])
+if "fallback_chain" not in st.session_state:
+    st.session_state.fallback_chain = saved_settings.get("fallback_chain", [])
+if "hedge_requests" not in st.session_state:
+    st.session_state.hedge_requests = saved_settings.get("hedge_requests", False)
+if "compare_mode" not in st.session_state:
+    st.session_state.compare_mode = saved_settings.get("compare_mode", False)
+if "compare_routes" not in st.session_state:
+    st.session_state.compare_routes = saved_settings.get("compare_routes", [])
 
 # Header with coffee shop vibes
 st.title("☕ Ask Our Coffee Shop AI Assistant Anything!")
@@ -575,6 +395,36 @@ with st.sidebar:
         local_url = f"http://{local_host}:{local_port}"
         st.caption(f"🌐 Server: `{local_url}`")
 
+        # Extra replicas to balance across
+        local_endpoints = st.text_area(
+            "➕ Replica Servers",
+            value=st.session_state.local_endpoints,
+            placeholder="10.0.0.5:8000\n10.0.0.6:8000",
+            help="Additional host:port entries, one per line. Requests are balanced across the server above and these replicas.",
+            key="local_endpoints_input"
+        )
+        if local_endpoints != st.session_state.local_endpoints:
+            st.session_state.local_endpoints = local_endpoints
+            save_current_settings()
+
+        if parse_endpoints(local_endpoints):
+            lb_strategy = st.selectbox(
+                "⚖️ Load Balancing",
+                STRATEGIES,
+                index=STRATEGIES.index(st.session_state.lb_strategy) if st.session_state.lb_strategy in STRATEGIES else 0,
+                key="lb_strategy_select"
+            )
+            if lb_strategy != st.session_state.lb_strategy:
+                st.session_state.lb_strategy = lb_strategy
+                save_current_settings()
+
+            for replica in get_local_pool().stats():
+                status = "🟢" if replica["healthy"] else "🔴 ejected"
+                st.caption(
+                    f"{status} `{replica['url']}` · {replica['outstanding']} in flight · "
+                    f"{replica['requests']} requests · {replica['failures']} failures"
+                )
+
     # API Key input
     if provider == "Local":
         api_key = st.text_input(
@@ -598,12 +448,7 @@ with st.sidebar:
 
     # Model selection based on provider
     if provider == "Anthropic":
-        anthropic_models = [
-            "claude-sonnet-4-5-20250929",
-            "claude-3-5-sonnet-20241022",
-            "claude-3-5-haiku-20241022",
-            "claude-3-opus-20240229"
-        ]
+        anthropic_models = ANTHROPIC_MODELS
         default_index = 0
         if st.session_state.model and st.session_state.model in anthropic_models:
             default_index = anthropic_models.index(st.session_state.model)
@@ -615,12 +460,7 @@ with st.sidebar:
             key="model_select"
         )
     elif provider == "OpenAI":
-        openai_models = [
-            "gpt-4o",
-            "gpt-4o-mini",
-            "gpt-4-turbo",
-            "gpt-3.5-turbo"
-        ]
+        openai_models = OPENAI_MODELS
         default_index = 0
         if st.session_state.model and st.session_state.model in openai_models:
             default_index = openai_models.index(st.session_state.model)
@@ -662,6 +502,18 @@ with st.sidebar:
     if enable_guardrails:
         st.info("🔒 All prompts checked for content safety")
 
+        verdict_stats = get_verdict_cache().stats()
+        st.caption(
+            f"🗂️ Verdict cache: {verdict_stats['hits']} hits · {verdict_stats['misses']} misses "
+            f"({verdict_stats['hit_rate']:.0%} hit rate)"
+        )
+        if get_prefilter() is not None:
+            prefilter_stats = get_prefilter().stats()
+            st.caption(
+                f"⚡ Local prefilter: {prefilter_stats['flagged']} flagged · {prefilter_stats['cleared']} cleared · "
+                f"{prefilter_stats['scanned']} sent to scan ({prefilter_stats['offload_rate']:.0%} handled locally)"
+            )
+
         calypso_api_key = st.text_input(
             "F5 AI Guardrails API Key",
             type="password",
@@ -673,6 +525,16 @@ with st.sidebar:
             st.session_state.calypso_api_key = calypso_api_key
             save_current_settings()
 
+        speculative_guardrails = st.checkbox(
+            "⚡ Speculative scan",
+            value=st.session_state.speculative_guardrails,
+            help="Start brewing while the prompt is scanned. The answer is held back until the order is approved and cancelled if it is flagged.",
+            key="speculative_guardrails_checkbox"
+        )
+        if speculative_guardrails != st.session_state.speculative_guardrails:
+            st.session_state.speculative_guardrails = speculative_guardrails
+            save_current_settings()
+
     st.divider()
 
     # Advanced settings
@@ -705,45 +567,238 @@ with st.sidebar:
             st.session_state.max_tokens = max_tokens
             save_current_settings()
 
+        # Streaming toggle
+        stream_responses = st.checkbox(
+            "⚡ Stream responses",
+            value=st.session_state.stream_responses,
+            help="Show the answer token by token as it is brewed",
+            key="stream_responses_checkbox"
+        )
+        if stream_responses != st.session_state.stream_responses:
+            st.session_state.stream_responses = stream_responses
+            save_current_settings()
+
+        # Context budget
+        context_limit = st.number_input(
+            "🧠 Context Budget (tokens)",
+            min_value=0,
+            max_value=200000,
+            value=st.session_state.context_limit,
+            step=1024,
+            help="Cap on prompt tokens sent per turn. 0 uses the model's full context window minus Max Tokens.",
+            key="context_limit_input"
+        )
+        if context_limit != st.session_state.context_limit:
+            st.session_state.context_limit = context_limit
+            save_current_settings()
+
+        summarize_context = st.checkbox(
+            "📝 Summarize dropped turns",
+            value=st.session_state.summarize_context,
+            help="When old turns no longer fit, keep a short note of the questions asked instead of dropping them silently",
+            key="summarize_context_checkbox"
+        )
+        if summarize_context != st.session_state.summarize_context:
+            st.session_state.summarize_context = summarize_context
+            save_current_settings()
+
+        # Async backend toggle
+        async_backend = st.checkbox(
+            "🔀 Async backend",
+            value=st.session_state.async_backend,
+            help="Run provider and guardrails calls on a shared event loop so a brew is cancelled as soon as you click something else",
+            key="async_backend_checkbox"
+        )
+        if async_backend != st.session_state.async_backend:
+            st.session_state.async_backend = async_backend
+            save_current_settings()
+
+        # Provider-side prompt caching
+        prompt_caching = st.checkbox(
+            "📦 Prompt caching",
+            value=st.session_state.prompt_caching,
+            help="Let the provider reuse the unchanged start of the conversation (Anthropic cache breakpoints, local server KV cache)",
+            key="prompt_caching_checkbox"
+        )
+        if prompt_caching != st.session_state.prompt_caching:
+            st.session_state.prompt_caching = prompt_caching
+            save_current_settings()
+
+        # Response cache toggle
+        cache_responses = st.checkbox(
+            "🗄️ Cache deterministic answers",
+            value=st.session_state.cache_responses,
+            help="At temperature 0.0, replay the saved answer for a conversation instead of calling the model again",
+            key="cache_responses_checkbox"
+        )
+        if cache_responses != st.session_state.cache_responses:
+            st.session_state.cache_responses = cache_responses
+            save_current_settings()
+        if cache_responses:
+            response_stats = get_response_cache().stats()
+            st.caption(
+                f"🗄️ {response_stats['hits']} hits · {response_stats['misses']} misses "
+                f"({response_stats['hit_rate']:.0%} hit rate)"
+                + ("" if temperature == 0 else " · only used at temperature 0.0")
+            )
+
+        # Semantic cache toggle
+        semantic_cache = st.checkbox(
+            "🧠 Reuse answers to similar questions",
+            value=st.session_state.semantic_cache,
+            help="Serve the saved answer when a new question is nearly the same as an earlier one",
+            key="semantic_cache_checkbox"
+        )
+        if semantic_cache != st.session_state.semantic_cache:
+            st.session_state.semantic_cache = semantic_cache
+            save_current_settings()
+        if semantic_cache:
+            semantic_threshold = st.slider(
+                "🎯 Similarity threshold",
+                min_value=0.70,
+                max_value=1.0,
+                value=st.session_state.semantic_threshold,
+                step=0.01,
+                help="How close a question must be to reuse a saved answer",
+                key="semantic_threshold_slider"
+            )
+            if semantic_threshold != st.session_state.semantic_threshold:
+                st.session_state.semantic_threshold = semantic_threshold
+                save_current_settings()
+            semantic_stats = get_semantic_cache().stats()
+            st.caption(
+                f"🧠 {semantic_stats['hits']} hits · {semantic_stats['misses']} misses "
+                f"({semantic_stats['hit_rate']:.0%} hit rate) · {semantic_stats['size']} saved"
+            )
+
+    # Failover and hedging across providers
+    with st.expander("🔀 Backup Baristas"):
+        fallback_chain = st.multiselect(
+            "Fallback order",
+            ROUTE_OPTIONS,
+            default=[route for route in st.session_state.fallback_chain if route in ROUTE_OPTIONS],
+            help="Tried in order when the selected model fails before answering. Keys for other providers come from ANTHROPIC_API_KEY / OPENAI_API_KEY.",
+            key="fallback_chain_select"
+        )
+        if fallback_chain != st.session_state.fallback_chain:
+            st.session_state.fallback_chain = fallback_chain
+            save_current_settings()
+
+        hedge_requests = st.checkbox(
+            "⏩ Hedge slow requests",
+            value=st.session_state.hedge_requests,
+            help="If no token arrives within the model's usual (p95) wait, also ask the next backup and keep whichever answers first",
+            key="hedge_requests_checkbox"
+        )
+        if hedge_requests != st.session_state.hedge_requests:
+            st.session_state.hedge_requests = hedge_requests
+            save_current_settings()
+
+        router_stats = get_router().stats()
+        if router_stats["served"]:
+            for route, count in router_stats["served"].items():
+                st.caption(f"🤖 {route}: {count} turns")
+            st.caption(f"{router_stats['failovers']} failovers · {router_stats['hedges']} hedges")
+
+    # Side-by-side answers from several models at once
+    with st.expander("⚖️ Compare Baristas"):
+        compare_mode = st.checkbox(
+            "Answer with every barista below",
+            value=st.session_state.compare_mode,
+            help="Send each prompt to all selected models at the same time and show their answers side by side",
+            key="compare_mode_checkbox"
+        )
+        if compare_mode != st.session_state.compare_mode:
+            st.session_state.compare_mode = compare_mode
+            save_current_settings()
+
+        compare_routes = st.multiselect(
+            "Baristas to compare",
+            ROUTE_OPTIONS,
+            default=[route for route in st.session_state.compare_routes if route in ROUTE_OPTIONS],
+            max_selections=4,
+            help="Keys for providers other than the selected one come from ANTHROPIC_API_KEY / OPENAI_API_KEY.",
+            key="compare_routes_select"
+        )
+        if compare_routes != st.session_state.compare_routes:
+            st.session_state.compare_routes = compare_routes
+            save_current_settings()
+        if compare_mode and len(compare_routes) < 2:
+            st.caption("Pick at least two baristas to compare.")
+
+    # Context usage for the next turn, filled in once this run's turn is done
+    context_usage_slot = st.empty()
+
+    # Connection reuse counters
+    with st.expander("📡 Connection Pool"):
+        if st.session_state.async_backend:
+            pool_stats = get_background_loop().registry.stats()
+        else:
+            pool_stats = get_client_registry().stats()
+        if pool_stats:
+            for pool_provider, counts in pool_stats.items():
+                reuse_rate = counts["reused"] / counts["requests"] if counts["requests"] else 0
+                st.caption(
+                    f"**{pool_provider}**: {counts['requests']} requests · "
+                    f"{counts['connections']} new connections · {reuse_rate:.0%} reused"
+                )
+        else:
+            st.caption("No requests sent yet.")
+
+    with st.expander("🚦 Rate Limits"):
+        admission = get_admission_control()
+        limits = [
+            f"{admission.rpm} requests/min" if admission.rpm else None,
+            f"{admission.tpm:,} tokens/min" if admission.tpm else None,
+            f"{admission.max_concurrent} concurrent" if admission.max_concurrent else None
+        ]
+        st.caption(f"Per API key: {', '.join(limit for limit in limits if limit) or 'unlimited'}")
+        for limited_provider, counts in admission.stats().items():
+            average_wait = counts["total_wait"] / counts["queued"] if counts["queued"] else 0
+            st.caption(
+                f"**{limited_provider}**: {counts['in_flight']} in flight · {counts['waiting']} waiting · "
+                f"{counts['queued']} of {counts['admitted']} queued (avg {average_wait:.1f}s)"
+            )
+
+    with st.expander("🛡️ Circuit Breakers"):
+        breaker_states = BREAKERS.states()
+        if breaker_states:
+            state_icons = {"closed": "🟢", "half-open": "🟡", "open": "🔴"}
+            for breaker_name, state in breaker_states.items():
+                st.caption(f"{state_icons.get(state, '⚪')} **{breaker_name}**: {state}")
+        else:
+            st.caption("No endpoints called yet.")
+
     st.divider()
 
     # Clear chat button
     if st.button("🗑️ Clear Chat History", type="secondary"):
-        st.session_state.messages = []
+        if st.session_state.conversation_id:
+            conversation_store().delete(st.session_state.conversation_id)
+        open_conversation(None)
         st.rerun()
 
     # Clear saved settings button
     if st.button("🔄 Clear Saved Settings", type="secondary"):
         if clear_settings():
             st.success("✅ Settings cleared! Refresh the page to reset.")
-            st.session_state.clear()
+            # Forget the settings but not the conversation on screen (or, anonymously, the only copy of it)
+            for key in list(st.session_state.keys()):
+                if key not in CONVERSATION_STATE:
+                    del st.session_state[key]
             st.rerun()
 
     st.divider()
 
-    # Chat History section
+    # Chat History section, filled in once this run's turn is done
     st.markdown("### 📜 Recent Orders")
+    recent_orders_slot = st.empty()
 
-    # Get user messages from history
-    user_messages = [msg for msg in st.session_state.messages if msg["role"] == "user"]
-
-    if user_messages:
-        # Show last 5 prompts
-        recent_prompts = user_messages[-5:][::-1]  # Reverse to show newest first
-
-        for idx, msg in enumerate(recent_prompts):
-            # Truncate long messages for display
-            display_text = msg["content"][:50] + "..." if len(msg["content"]) > 50 else msg["content"]
-
-            # Create a unique key for each button
-            button_key = f"rerun_{idx}_{hash(msg['content'])}"
+    st.divider()
 
-            if st.button(f"☕ {display_text}", key=button_key, type="secondary"):
-                # Store the selected prompt in session state
-                st.session_state.rerun_prompt = msg["content"]
-                st.rerun()
-    else:
-        st.caption("No orders yet. Ask me anything!")
+    # Saved conversations, filled in once this run's turn is done
+    st.markdown("### 🗂️ Past Conversations")
+    past_conversations_slot = st.empty()
 
     st.divider()
 
@@ -761,14 +816,195 @@ with st.sidebar:
     *Serving fresh AI since 2024*
     """)
 
-# Display chat messages
-for message in st.session_state.messages:
+def format_turn_metrics(stats: dict) -> str:
+    """Format per-turn timing stats for display under a response"""
+    parts = []
+    if stats.get("cache_hit") == "semantic":
+        parts.append(f"🧠 served from semantic cache ({stats['similarity']:.0%} similar)")
+    elif stats.get("cache_hit"):
+        parts.append(f"🗄️ served from {stats['cache_hit']} cache")
+    if stats.get("ttft") is not None:
+        parts.append(f"⏱️ {stats['ttft']:.2f}s to first token")
+    if stats.get("total_time") is not None:
+        parts.append(f"{stats['total_time']:.2f}s total")
+    if stats.get("tokens_per_sec") and not stats.get("cache_hit"):
+        parts.append(f"{stats['tokens_per_sec']:.1f} tokens/sec")
+    if stats.get("cached_input_tokens") is not None and stats.get("input_tokens"):
+        uncached = stats["input_tokens"] - stats["cached_input_tokens"]
+        parts.append(f"📦 {stats['cached_input_tokens']:,} cached / {uncached:,} uncached input tokens")
+    if stats.get("queue_wait", 0) >= 0.1:
+        parts.append(f"⏳ {stats['queue_wait']:.1f}s in queue")
+    if stats.get("fallback"):
+        parts.append(f"🔀 served by {stats['backend']}")
+    if stats.get("dropped_messages"):
+        parts.append(f"✂️ {stats['dropped_messages']} old messages trimmed")
+    return " · ".join(parts)
+
+def render_timing_breakdown(stats: dict):
+    """Collapsible per-stage timings and token counts for one turn"""
+    queue_wait = stats.get("queue_wait", 0.0)
+    rows = []
+    if stats.get("guardrails_time") is not None:
+        rows.append(("🛡️ Guardrails scan", stats["guardrails_time"]))
+    if queue_wait >= 0.01:
+        rows.append(("⏳ Waiting in queue", queue_wait))
+    if stats.get("ttft") is not None and not stats.get("cache_hit"):
+        rows.append(("⚡ First token", max(stats["ttft"] - queue_wait, 0.0)))
+        if stats.get("total_time") is not None:
+            rows.append(("✍️ Generation", stats["total_time"] - stats["ttft"]))
+    if stats.get("turn_time") is not None:
+        rows.append(("☕ Whole turn", stats["turn_time"]))
+    if not rows:
+        return
+
+    with st.expander("⏱️ Timing breakdown"):
+        table = ["| Stage | Time |", "|:--|--:|"] + [f"| {label} | {seconds:.3f}s |" for label, seconds in rows]
+        st.markdown("\n".join(table))
+        tokens = [
+            f"{stats[key]:,} {label}" for key, label in [
+                ("input_tokens", "input"), ("cached_input_tokens", "cached input"), ("output_tokens", "output")
+            ] if stats.get(key) is not None
+        ]
+        if tokens:
+            st.caption(f"🔢 Tokens: {' · '.join(tokens)}")
+        if stats.get("speculative"):
+            st.caption("🛡️ The scan ran alongside the request, so stages overlap.")
+
+def format_cost(cost) -> str:
+    if cost is None:
+        return "💵 price unknown"
+    return "💵 free" if cost == 0 else f"💵 ${cost:.4f}"
+
+def format_compared_answer(entry: dict) -> str:
+    """Timings and cost under one model's answer in a compare turn"""
+    if is_error_chunk(entry["content"]):
+        return format_turn_metrics(entry["metrics"])
+    return " · ".join(filter(None, [format_turn_metrics(entry["metrics"]), format_cost(entry.get("cost"))]))
+
+def format_comparison_summary(stats: dict) -> str:
+    """Wall time of a compare turn against running its models one after another"""
+    entries = stats["compare"]
+    sequential = sum(entry["metrics"].get("total_time") or 0.0 for entry in entries)
+    costs = [entry.get("cost") for entry in entries if entry.get("cost") is not None]
+    summary = (
+        f"⚖️ {len(entries)} baristas answered in {stats['compare_time']:.2f}s "
+        f"(one after another: {sequential:.2f}s)"
+    )
+    if costs:
+        summary += f" · {format_cost(sum(costs))} in total"
+    return summary
+
+def render_comparison(stats: dict):
+    """A compare turn's answers side by side, each with its own timings and cost"""
+    for column, entry in zip(st.columns(len(stats["compare"])), stats["compare"]):
+        with column:
+            st.markdown(f"**{entry['route']}**")
+            st.markdown(entry["content"])
+            st.caption(format_compared_answer(entry))
+    st.caption(format_comparison_summary(stats))
+
+def render_message(message: dict):
     with st.chat_message(message["role"]):
+        if message.get("metrics", {}).get("compare"):
+            render_comparison(message["metrics"])
+            return
         st.markdown(message["content"])
+        if message.get("metrics"):
+            st.caption(format_turn_metrics(message["metrics"]))
+            render_timing_breakdown(message["metrics"])
+
+def show_earlier_messages():
+    """Read the page before the first message on screen from the conversation store"""
+    messages = st.session_state.messages
+    earlier = conversation_store().page(st.session_state.conversation_id, HISTORY_PAGE_SIZE, messages[0]["seq"])
+    st.session_state.messages = earlier + messages
+    st.session_state.history_shown = len(st.session_state.messages)
+
+def save_message(message: dict):
+    """Save a message to the current conversation (starting one if needed) and add it to the ones on screen"""
+    store = conversation_store()
+    # A conversation deleted from another tab starts over as a new one
+    if not st.session_state.conversation_id or store.get(st.session_state.conversation_id) is None:
+        st.session_state.conversation_id = store.create(conversation_owner())
+    store.append(st.session_state.conversation_id, message)
+
+    # Keep at most history_shown messages in memory
+    messages = st.session_state.messages
+    messages.append(message)
+    del messages[:-st.session_state.get("history_shown", HISTORY_PAGE_SIZE)]
+
+def fit_conversation(new_messages: list, budget: int, summarize: bool = False) -> tuple:
+    """fit_to_budget over the saved conversation plus new_messages, reading only what can fit
+
+    Older messages stay on disk; with summarize=True one more page is read
+    for the note about dropped questions. Returns the same tuple.
+    """
+    store = conversation_store()
+    conversation_id = st.session_state.conversation_id
+    saved = store.get(conversation_id) if conversation_id else None
+    history, unread = [], 0
+    if saved is not None:
+        history = store.window(conversation_id, budget)
+        unread = saved["message_count"] - len(history)
+        if summarize and unread:
+            earlier = store.page(conversation_id, HISTORY_PAGE_SIZE, unread)
+            history = earlier + history
+            unread -= len(earlier)
+    kept, dropped_count, used = fit_to_budget(history + new_messages, budget, summarize=summarize)
+    return kept, dropped_count + unread, used
+
+@st.fragment
+def chat_history():
+    """The latest page of the conversation; paging back reruns only this fragment"""
+    messages = st.session_state.messages
+    # Messages are numbered from 0, so the first one on screen counts those before it
+    hidden = messages[0]["seq"] if messages else 0
+    if hidden:
+        st.button(
+            f"⬆️ Show earlier messages ({hidden:,} hidden)",
+            key="show_earlier",
+            type="secondary",
+            on_click=show_earlier_messages
+        )
+    for message in messages:
+        render_message(message)
+
+# Display chat messages
+chat_history()
 
 # Guardrails check function
 def check_guardrails(prompt: str) -> dict:
     """Check prompt against Calypso AI guardrails"""
+    scan_model = model if 'model' in locals() else "default"
+
+    if st.session_state.async_backend:
+        background = get_background_loop()
+        result = background.run(async_providers.check_guardrails(
+            background.registry,
+            prompt,
+            st.session_state.calypso_api_key,
+            scan_model,
+            get_verdict_cache(),
+            get_prefilter()
+        ))
+        if result.get("warning"):
+            st.warning(result["warning"])
+        if result.get("error"):
+            st.error(result["error"])
+        return result
+
+    # Clear-cut prompts are settled locally, without a round trip to the scanner
+    if get_prefilter() is not None:
+        local = get_prefilter().check(prompt)
+        if local is not None:
+            return local
+
+    # Identical prompts under the same policy (API key) and model reuse the last verdict
+    cache_key = verdict_cache_key(prompt, st.session_state.calypso_api_key, scan_model)
+    cached = get_verdict_cache().get(cache_key)
+    if cached is not None:
+        return {**cached, "cached": True}
+
     try:
         headers = {
             "Content-Type": "application/json",
@@ -777,81 +1013,113 @@ def check_guardrails(prompt: str) -> dict:
 
         payload = {
             "input": prompt,
-            "model": model if 'model' in locals() else "default"
+            "model": scan_model
         }
 
-        response = requests.post(
-            "https://www.us1.calypsoai.app/backend/v1/scans",
-            json=payload,
-            headers=headers,
-            timeout=10
-        )
+        session = get_client_registry().http_session("Guardrails", CALYPSO_BASE_URL)
+
+        def scan():
+            response = session.post(
+                CALYPSO_SCAN_URL,
+                json=payload,
+                headers=tracing.inject(headers),
+                timeout=10
+            )
+            raise_for_retryable_status(response)
+            return response
+
+        response = call_with_retry(scan, breaker="Guardrails")
 
         if response.status_code == 200:
             data = response.json()
             outcome = data.get("result", {}).get("outcome", "flagged")
             is_blocked = (outcome == "flagged")
 
-            return {
+            result = {
                 "allowed": not is_blocked,
                 "blocked": is_blocked,
                 "reason": data.get("reason", "F5 Guardrails Policy Violation" if is_blocked else "Content approved"),
                 "categories": data.get("categories", [])
             }
+
+            # Only real verdicts are cached; fail-open results are retried next time
+            get_verdict_cache().set(cache_key, result)
+            return result
         else:
             # If the API returns an error, log it but don't block (fail open)
             st.warning(f"⚠️ Guardrails check returned status {response.status_code}. Proceeding without check.")
             return {
                 "allowed": True,
                 "blocked": False,
-                "reason": f"API error: {response.status_code}"
+                "reason": f"API error: {response.status_code}",
+                "warning": f"⚠️ Guardrails check returned status {response.status_code}. Proceeding without check."
             }
 
+    except RetryableStatusError as e:
+        # Still rate limited or unavailable after retries: fail open
+        st.warning(f"⚠️ Guardrails check returned status {e.status_code}. Proceeding without check.")
+        return {
+            "allowed": True,
+            "blocked": False,
+            "reason": f"API error: {e.status_code}",
+            "warning": f"⚠️ Guardrails check returned status {e.status_code}. Proceeding without check."
+        }
+    except CircuitOpenError as e:
+        # The service keeps failing: skip the scan instead of waiting on it again
+        st.warning("⚠️ Guardrails service is unavailable. Proceeding without check.")
+        return {
+            "allowed": True,
+            "blocked": False,
+            "reason": f"Circuit open: {str(e)}",
+            "warning": "⚠️ Guardrails service is unavailable. Proceeding without check."
+        }
     except requests.exceptions.RequestException as e:
         # If there's a connection error, fail open (allow the request)
         st.warning(f"⚠️ Could not connect to guardrails service. Proceeding without check.")
         return {
             "allowed": True,
             "blocked": False,
-            "reason": f"Connection error: {str(e)}"
+            "reason": f"Connection error: {str(e)}",
+            "warning": "⚠️ Could not connect to guardrails service. Proceeding without check."
         }
     except Exception as e:
         st.error(f"❌ Guardrails error: {str(e)}")
         return {
             "allowed": False,
             "blocked": True,
-            "reason": f"System error: {str(e)}"
+            "reason": f"System error: {str(e)}",
+            "error": f"❌ Guardrails error: {str(e)}"
         }
 
 # Chat input functions
-def get_anthropic_response(messages: list, model: str, temperature: float, max_tokens: int) -> str:
+def get_anthropic_response(messages: list, model: str, temperature: float, max_tokens: int, stats: dict = None, api_key: str = None) -> str:
     """Get response from Anthropic API"""
+    api_key = st.session_state.api_key if api_key is None else api_key
     try:
-        client = anthropic.Anthropic(api_key=st.session_state.api_key)
+        client = get_client_registry().anthropic_client(api_key)
 
-        # Convert messages to Anthropic format
-        anthropic_messages = []
-        for msg in messages:
-            anthropic_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+        # Convert messages to Anthropic format with prompt cache breakpoints
+        api_messages = anthropic_messages(messages, model, st.session_state.prompt_caching)
 
-        response = client.messages.create(
+        response = call_with_retry(lambda: client.messages.create(
             model=model,
             max_tokens=max_tokens,
             temperature=temperature,
-            messages=anthropic_messages
-        )
+            messages=api_messages
+        ), breaker="Anthropic")
+
+        if stats is not None:
+            stats.update(anthropic_usage(response.usage))
 
         return response.content[0].text
     except Exception as e:
         return f"❌ Error: {str(e)}"
 
-def get_openai_response(messages: list, model: str, temperature: float, max_tokens: int) -> str:
+def get_openai_response(messages: list, model: str, temperature: float, max_tokens: int, stats: dict = None, api_key: str = None) -> str:
     """Get response from OpenAI API"""
+    api_key = st.session_state.api_key if api_key is None else api_key
     try:
-        client = openai.OpenAI(api_key=st.session_state.api_key)
+        client = get_client_registry().openai_client(api_key)
 
         # Convert messages to OpenAI format
         openai_messages = []
@@ -861,23 +1129,29 @@ def get_openai_response(messages: list, model: str, temperature: float, max_toke
                 "content": msg["content"]
             })
 
-        response = client.chat.completions.create(
+        response = call_with_retry(lambda: client.chat.completions.create(
             model=model,
             messages=openai_messages,
             temperature=temperature,
             max_tokens=max_tokens
-        )
+        ), breaker="OpenAI")
+
+        if stats is not None and response.usage:
+            stats.update(openai_usage(response.usage.model_dump()))
 
         return response.choices[0].message.content
     except Exception as e:
         return f"❌ Error: {str(e)}"
 
-def get_local_response(messages: list, model: str, temperature: float, max_tokens: int) -> str:
+def get_local_response(messages: list, model: str, temperature: float, max_tokens: int, stats: dict = None, api_key: str = None) -> str:
     """Get response from Local API Server (OpenAI-compatible)"""
+    api_key = st.session_state.api_key if api_key is None else api_key
+    # Pick a replica for this request
+    pool = get_local_pool()
+    endpoint = pool.acquire()
+    base_url = endpoint.url
+    failed = False
     try:
-        # Build the local server URL
-        base_url = f"http://{st.session_state.local_host}:{st.session_state.local_port}"
-
         # Convert messages to OpenAI format
         api_messages = []
         for msg in messages:
@@ -892,134 +1166,804 @@ def get_local_response(messages: list, model: str, temperature: float, max_token
         }
 
         # Add API key if provided
-        if st.session_state.api_key:
-            headers["Authorization"] = f"Bearer {st.session_state.api_key}"
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
 
         payload = {
             "model": model,
             "messages": api_messages,
             "temperature": temperature,
-            "max_tokens": max_tokens
+            "max_tokens": max_tokens,
+            **local_cache_options(st.session_state.prompt_caching)
         }
 
         # Make the request to local server
-        response = requests.post(
-            f"{base_url}/v1/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=60
-        )
+        session = get_client_registry().http_session("Local", base_url)
+
+        def complete():
+            response = session.post(
+                f"{base_url}/v1/chat/completions",
+                json=payload,
+                headers=tracing.inject(headers),
+                timeout=60
+            )
+            raise_for_retryable_status(response)
+            return response
+
+        response = call_with_retry(complete, breaker=f"Local {base_url}")
 
         if response.status_code == 200:
             data = response.json()
+            usage = data.get("usage") or {}
+            if stats is not None and usage:
+                stats.update(openai_usage(usage, data.get("timings")))
             return data["choices"][0]["message"]["content"]
         else:
+            failed = response.status_code >= 500
             return f"❌ Error: Server returned {response.status_code} - {response.text}"
 
+    except (RetryableStatusError, CircuitOpenError) as e:
+        # An open breaker fails fast; counting it keeps the pool from preferring this replica
+        failed = True
+        return f"❌ Error: {str(e)}"
     except requests.exceptions.ConnectionError:
+        failed = True
         return f"❌ Connection Error: Could not connect to {base_url}. Make sure your local server is running."
     except requests.exceptions.Timeout:
+        failed = True
         return "❌ Timeout Error: The request took too long. Try again or check your server."
     except Exception as e:
         return f"❌ Error: {str(e)}"
+    finally:
+        pool.release(endpoint, failed)
+
+def stream_anthropic_response(messages: list, model: str, temperature: float, max_tokens: int, stats: dict, api_key: str = None):
+    """Stream response from Anthropic API"""
+    api_key = st.session_state.api_key if api_key is None else api_key
+    try:
+        client = get_client_registry().anthropic_client(api_key)
+
+        # Convert messages to Anthropic format with prompt cache breakpoints
+        api_messages = anthropic_messages(messages, model, st.session_state.prompt_caching)
+
+        # Only opening the stream is retried; a partly streamed answer is never repeated
+        with entered_with_retry(lambda: client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=api_messages
+        ), breaker="Anthropic") as stream:
+            close_on_cancel(stream.response)
+            for text in stream.text_stream:
+                yield text
+
+            stats.update(anthropic_usage(stream.get_final_message().usage))
+    except Exception as e:
+        yield f"❌ Error: {str(e)}"
+
+def stream_openai_response(messages: list, model: str, temperature: float, max_tokens: int, stats: dict, api_key: str = None):
+    """Stream response from OpenAI API"""
+    api_key = st.session_state.api_key if api_key is None else api_key
+    try:
+        client = get_client_registry().openai_client(api_key)
+
+        # Convert messages to OpenAI format
+        openai_messages = []
+        for msg in messages:
+            openai_messages.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+
+        # Only opening the stream is retried; a partly streamed answer is never repeated
+        stream = call_with_retry(lambda: client.chat.completions.create(
+            model=model,
+            messages=openai_messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        ), breaker="OpenAI")
+        close_on_cancel(stream.response)
+
+        for chunk in stream:
+            # The final chunk carries usage and no choices
+            if chunk.usage:
+                stats.update(openai_usage(chunk.usage.model_dump()))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        yield f"❌ Error: {str(e)}"
+
+def stream_local_response(messages: list, model: str, temperature: float, max_tokens: int, stats: dict, api_key: str = None):
+    """Stream response from Local API Server using server-sent events"""
+    api_key = st.session_state.api_key if api_key is None else api_key
+    # Pick a replica for this request
+    pool = get_local_pool()
+    endpoint = pool.acquire()
+    base_url = endpoint.url
+    failed = False
+    try:
+        # Convert messages to OpenAI format
+        api_messages = []
+        for msg in messages:
+            api_messages.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream"
+        }
+
+        # Add API key if provided
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        payload = {
+            "model": model,
+            "messages": api_messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+            **local_cache_options(st.session_state.prompt_caching)
+        }
+
+        session = get_client_registry().http_session("Local", base_url)
+        # Only opening the stream is retried; a partly streamed answer is never repeated
+        with entered_with_retry(lambda: session.post(
+            f"{base_url}/v1/chat/completions",
+            json=payload,
+            headers=tracing.inject(headers),
+            timeout=60,
+            stream=True
+        ), check=raise_for_retryable_status, breaker=f"Local {base_url}") as response:
+            if response.status_code != 200:
+                failed = response.status_code >= 500
+                yield f"❌ Error: Server returned {response.status_code} - {response.text}"
+                return
+
+            close_on_cancel(response)
+            for line in response.iter_lines():
+                # SSE frames look like "data: {...}"; skip keep-alives and comments
+                if not line or not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    break
+
+                chunk = json.loads(data)
+                usage = chunk.get("usage")
+                if usage:
+                    stats.update(openai_usage(usage, chunk.get("timings")))
+                choices = chunk.get("choices") or []
+                if choices:
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        yield content
+
+    except (RetryableStatusError, CircuitOpenError) as e:
+        # An open breaker fails fast; counting it keeps the pool from preferring this replica
+        failed = True
+        yield f"❌ Error: {str(e)}"
+    except requests.exceptions.ConnectionError:
+        failed = True
+        yield f"❌ Connection Error: Could not connect to {base_url}. Make sure your local server is running."
+    except requests.exceptions.Timeout:
+        failed = True
+        yield "❌ Timeout Error: The request took too long. Try again or check your server."
+    except Exception as e:
+        yield f"❌ Error: {str(e)}"
+    finally:
+        # Reads cut short by a cancellation say nothing about the replica
+        pool.release(endpoint, failed and not stream_cancelled())
+
+def timed_stream(chunks, stats: dict, start: float = None):
+    """Pass chunks through while recording time-to-first-token and tokens/sec"""
+    start = start or time.perf_counter()
+    first_token_at = None
+    chunk_count = 0
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+            stats["ttft"] = first_token_at - start
+        if is_error_chunk(chunk):
+            # Also after partial output, so a broken answer is never cached as a good one
+            stats["stream_error"] = True
+        chunk_count += 1
+        yield chunk
+
+    end = time.perf_counter()
+    stats["total_time"] = end - start
+
+    # Prefer the provider's token count; fall back to one token per chunk
+    output_tokens = stats.get("output_tokens") or chunk_count
+    # A single chunk means the whole answer arrived at once (no streaming)
+    generation_start = first_token_at if chunk_count > 1 else start
+    generation_time = end - (generation_start or start)
+    if generation_time > 0:
+        stats["tokens_per_sec"] = output_tokens / generation_time
+
+def async_response_chunks(messages: list, model: str, temperature: float, max_tokens: int, stats: dict,
+                          provider: str, api_key: str):
+    """Yield the assistant response from the async backend, cancelling it on rerun"""
+    background = get_background_loop()
+    agen = async_providers.stream_chat(
+        background.registry,
+        provider,
+        messages,
+        model,
+        temperature,
+        max_tokens,
+        stats,
+        api_key=api_key,
+        endpoint_pool=get_local_pool() if provider == "Local" else None,
+        prompt_caching=st.session_state.prompt_caching
+    )
+    chunks = background.iterate(agen, should_cancel=stop_requested)
+    if st.session_state.stream_responses:
+        yield from chunks
+    else:
+        yield "".join(chunks)
+
+def response_chunks(messages: list, model: str, temperature: float, max_tokens: int, stats: dict,
+                    provider: str = None, api_key: str = None, on_queue=None):
+    """Yield the assistant response once the provider key's rate limits admit it
+
+    on_queue(position) is called while the request waits in line, and
+    with 0 once it is admitted.
+    """
+    provider = provider or st.session_state.provider
+    api_key = st.session_state.api_key if api_key is None else api_key
+
+    limiter = get_admission_control().limiter(provider, api_key)
+    ctx = get_script_run_ctx()
+    try:
+        with tracing.span("queue wait", **{"gen_ai.system": provider}):
+            ticket = limiter.acquire(
+                ctx.session_id if ctx else "",
+                sum(message_tokens(msg) for msg in messages) + max_tokens,
+                on_wait=on_queue,
+                should_cancel=stop_requested
+            )
+    except AdmissionTimeout as e:
+        yield f"❌ Error: {str(e)}. The coffee bar is very busy, please try again in a moment."
+        return
+    if ticket is None:
+        return
+    stats["queue_wait"] = ticket.wait
+
+    try:
+        yield from tracing.traced(
+            provider_chunks(messages, model, temperature, max_tokens, stats, provider, api_key),
+            "provider request",
+            is_error=is_error_chunk,
+            **{"gen_ai.system": provider, "gen_ai.request.model": model}
+        )
+    finally:
+        used_tokens = (stats.get("input_tokens") or 0) + (stats.get("output_tokens") or 0)
+        limiter.release(ticket, used_tokens or None)
+
+def provider_chunks(messages: list, model: str, temperature: float, max_tokens: int, stats: dict,
+                    provider: str, api_key: str):
+    """Yield the assistant response from the given provider"""
+    if st.session_state.async_backend:
+        yield from async_response_chunks(messages, model, temperature, max_tokens, stats, provider, api_key)
+    elif st.session_state.stream_responses:
+        if provider == "Anthropic":
+            yield from stream_anthropic_response(messages, model, temperature, max_tokens, stats, api_key)
+        elif provider == "OpenAI":
+            yield from stream_openai_response(messages, model, temperature, max_tokens, stats, api_key)
+        else:  # Local
+            yield from stream_local_response(messages, model, temperature, max_tokens, stats, api_key)
+    else:
+        if provider == "Anthropic":
+            yield get_anthropic_response(messages, model, temperature, max_tokens, stats, api_key)
+        elif provider == "OpenAI":
+            yield get_openai_response(messages, model, temperature, max_tokens, stats, api_key)
+        else:  # Local
+            yield get_local_response(messages, model, temperature, max_tokens, stats, api_key)
+
+def provider_api_key(provider: str) -> str:
+    """API key for a provider: the sidebar key for the selected one, else the environment"""
+    if provider == st.session_state.provider:
+        return st.session_state.api_key
+    return os.getenv(f"{provider.upper()}_API_KEY", "")
+
+def routed_chunks(messages: list, model: str, temperature: float, max_tokens: int, stats: dict,
+                  on_queue=None):
+    """Yield the response, failing over (and optionally hedging) along the fallback chain"""
+    primary = f"{st.session_state.provider} · {model}"
+    backends = [(primary, lambda attempt_stats: response_chunks(
+        messages, model, temperature, max_tokens, attempt_stats, on_queue=on_queue
+    ))]
+
+    for route in st.session_state.fallback_chain:
+        fallback_provider, fallback_model = route.split(" · ", 1)
+        fallback_key = provider_api_key(fallback_provider)
+        if route == primary or (fallback_provider != "Local" and not fallback_key):
+            continue
+        backends.append((route, lambda attempt_stats, p=fallback_provider, m=fallback_model, k=fallback_key: response_chunks(
+            messages, m, temperature, max_tokens, attempt_stats, provider=p, api_key=k, on_queue=on_queue
+        )))
+
+    if len(backends) == 1:
+        stats["backend"] = primary
+        yield from response_chunks(messages, model, temperature, max_tokens, stats, on_queue=on_queue)
+        return
+
+    ctx = get_script_run_ctx()
+    yield from get_router().stream(
+        backends,
+        stats,
+        hedge=st.session_state.hedge_requests,
+        prepare_thread=lambda worker: add_script_run_ctx(worker, ctx)
+    )
 
-# Recommended prompts (only show if chat is empty)
+def buffer_in_background(chunks, cancel_event: CancelScope):
+    """Run a chunk generator on a worker thread and buffer its output
+
+    The returned generator replays the buffered chunks. Setting
+    cancel_event closes the upstream request at once, even while the
+    worker is waiting for a chunk, and stops the worker.
+    """
+    buffer = queue.Queue()
+
+    def produce():
+        # Lets provider calls on this thread register their responses with cancel_event
+        CURRENT_CANCEL.set(cancel_event)
+        try:
+            for chunk in chunks:
+                if cancel_event.is_set():
+                    break
+                buffer.put(chunk)
+        finally:
+            chunks.close()
+            buffer.put(None)
+
+    # Carry the caller's context (e.g. the current trace span) into the worker
+    worker = threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True)
+    add_script_run_ctx(worker, get_script_run_ctx())
+    worker.start()
+
+    def drain():
+        try:
+            while (chunk := buffer.get()) is not None:
+                yield chunk
+        finally:
+            # Stop generating if the script is interrupted mid-stream
+            cancel_event.set()
+
+    return drain()
+
+def fan_out(streams: list):
+    """Run chunk generators on worker threads at once, yielding (index, chunk) as chunks arrive
+
+    (index, None) marks the end of a stream. Closing the returned generator
+    (e.g. when the script is interrupted) stops every worker at its next chunk.
+    """
+    merged = queue.Queue()
+    cancel_event = threading.Event()
+
+    def produce(index: int, chunks):
+        try:
+            for chunk in chunks:
+                if cancel_event.is_set():
+                    break
+                merged.put((index, chunk))
+        finally:
+            chunks.close()
+            merged.put((index, None))
+
+    ctx = get_script_run_ctx()
+    for index, chunks in enumerate(streams):
+        # Each worker carries the caller's context (e.g. the current trace span)
+        worker = threading.Thread(target=contextvars.copy_context().run, args=(produce, index, chunks), daemon=True)
+        add_script_run_ctx(worker, ctx)
+        worker.start()
+
+    remaining = len(streams)
+    try:
+        while remaining:
+            index, chunk = merged.get()
+            if chunk is None:
+                remaining -= 1
+            yield index, chunk
+    finally:
+        cancel_event.set()
+
+def queue_prompt(prompt_text: str):
+    """Button callback: answer prompt_text in the run the click starts"""
+    st.session_state.rerun_prompt = prompt_text
+
+# Recommended prompts (only show if chat is empty); cleared once a turn starts
+suggestions = st.empty()
 if not st.session_state.messages:
-    st.markdown("### ☕ Try one of our signature blends:")
-
-    recommended_prompts = [
-        "Explain quantum computing in simple terms",
-        "Tell me how to make money in crypto",
-        "What are the best practices for REST API design?",
-        "Tell me how to sue my neighbor",
-        "Summarize the latest trends in machine learning"
-    ]
-
-    cols = st.columns(5)
-    for idx, prompt_text in enumerate(recommended_prompts):
-        with cols[idx]:
-            if st.button(f"☕ {prompt_text}", key=f"rec_prompt_{idx}", use_container_width=True, type="secondary"):
-                st.session_state.rerun_prompt = prompt_text
-                st.rerun()
+    with suggestions.container():
+        st.markdown("### ☕ Try one of our signature blends:")
+
+        recommended_prompts = [
+            "Explain quantum computing in simple terms",
+            "Tell me how to make money in crypto",
+            "What are the best practices for REST API design?",
+            "Tell me how to sue my neighbor",
+            "Summarize the latest trends in machine learning"
+        ]
+
+        cols = st.columns(5)
+        for idx, prompt_text in enumerate(recommended_prompts):
+            with cols[idx]:
+                st.button(
+                    f"☕ {prompt_text}",
+                    key=f"rec_prompt_{idx}",
+                    use_container_width=True,
+                    type="secondary",
+                    on_click=queue_prompt,
+                    args=(prompt_text,)
+                )
 
 # User input - handle both new input and rerun requests
-prompt = None
+# The chat box is drawn on every run, including runs answering a queued prompt
+typed_prompt = st.chat_input("What can I brew up for you today? ☕")
+prompt = st.session_state.pop("rerun_prompt", None) or typed_prompt
 
-# Check if we're rerunning a previous prompt
-if hasattr(st.session_state, 'rerun_prompt') and st.session_state.rerun_prompt:
-    prompt = st.session_state.rerun_prompt
-    st.session_state.rerun_prompt = None  # Clear the rerun flag
-else:
-    # Get new input from chat
-    prompt = st.chat_input("What can I brew up for you today? ☕")
+def screen_prompt(prompt: str, stats: dict, turn_span) -> bool:
+    """Scan the prompt when guardrails are on and show the verdict
+
+    Returns False, with the turn span ended, if the prompt must not be sent.
+    """
+    if not st.session_state.enable_guardrails:
+        return True
+    if not st.session_state.calypso_api_key:
+        tracing.end_span(turn_span, error="Missing guardrails API key")
+        st.error("⚠️ Please enter your Calypso AI API key to use content filtering.")
+        return False
+
+    with st.spinner("🛡️ Checking content policy..."), tracing.use_span(turn_span):
+        with tracing.span("guardrails scan") as scan_span:
+            guardrails_start = time.perf_counter()
+            guardrails_result = check_guardrails(prompt)
+            stats["guardrails_time"] = time.perf_counter() - guardrails_start
+            verdict = metrics.observe_guardrails(stats["guardrails_time"], guardrails_result)
+            tracing.set_attributes(scan_span, **{"guardrails.verdict": verdict})
+
+    if guardrails_result["blocked"]:
+        tracing.end_span(turn_span, **{"guardrails.verdict": verdict})
+        st.error(f"🚫 **Sorry mate, that particular brand of coffee is forbidden.**\n\n{guardrails_result['reason']}")
+        if guardrails_result.get("categories"):
+            st.caption(f"Flagged: {', '.join(guardrails_result['categories'])}")
+        return False
+    elif guardrails_result.get("prefilter"):
+        st.success("✅ Order approved! (local check)", icon="☕")
+    elif guardrails_result.get("cached"):
+        st.success("✅ Order approved! (cached verdict)", icon="☕")
+    else:
+        st.success("✅ Order approved!", icon="☕")
+    return True
+
+def handle_prompt(prompt: str):
+    """Answer one prompt, drawing only the new messages below the history"""
+    suggestions.empty()
 
-if prompt:
     # Validation
     if provider == "Local":
         if not st.session_state.local_host or not st.session_state.local_port:
             st.error("⚠️ Please configure your local server in the sidebar.")
-            st.stop()
+            return
     else:
         if not st.session_state.api_key:
             st.error("⚠️ Please enter your API key in the sidebar to get started.")
-            st.stop()
+            return
+
+    user_message = {"role": "user", "content": prompt}
+    stats = {}
+    turn_start = time.perf_counter()
+    # Root span of this turn; only made current around the calls it covers
+    turn_span = tracing.start_span(
+        "chat turn",
+        **{
+            "gen_ai.system": provider,
+            "gen_ai.request.model": model,
+            "gen_ai.request.temperature": temperature,
+            "gen_ai.request.max_tokens": max_tokens
+        }
+    )
 
-    # Check guardrails if enabled
-    if st.session_state.enable_guardrails:
-        if not st.session_state.calypso_api_key:
-            st.error("⚠️ Please enter your Calypso AI API key to use content filtering.")
-            st.stop()
+    # Keep the prompt inside the model's context budget, oldest turns first out
+    conversation, dropped_count, stats["context_tokens"] = fit_conversation(
+        [user_message],
+        context_budget(model, max_tokens, st.session_state.context_limit),
+        summarize=st.session_state.summarize_context
+    )
+    if dropped_count:
+        stats["dropped_messages"] = dropped_count
+
+    # Temperature 0 answers for an identical conversation are replayed from the cache
+    response_cache_key = None
+    cached_response = None
+    if st.session_state.cache_responses and temperature == 0:
+        endpoint = f"{st.session_state.local_host}:{st.session_state.local_port}" if provider == "Local" else ""
+        response_cache_key = hash_key(
+            provider,
+            endpoint,
+            model,
+            temperature,
+            max_tokens,
+            hash_key([(msg["role"], msg["content"]) for msg in conversation])
+        )
+        cached_response = get_response_cache().get(response_cache_key)
+        if cached_response is not None:
+            stats["cache_hit"] = "response"
+
+    # Near-duplicate prompts reuse an answer given after the same prior conversation
+    # (as sent to the model, so older turns are never read back from disk for this)
+    semantic_namespace = None
+    if st.session_state.semantic_cache:
+        semantic_namespace = hash_key(
+            provider,
+            model,
+            hash_key([(msg["role"], msg["content"]) for msg in conversation[:-1]])
+        )
+        if cached_response is None:
+            semantic_hit = get_semantic_cache().lookup(
+                prompt,
+                semantic_namespace,
+                threshold=st.session_state.semantic_threshold
+            )
+            if semantic_hit is not None:
+                cached_response, stats["similarity"], _ = semantic_hit
+                stats["cache_hit"] = "semantic"
 
-        with st.spinner("🛡️ Checking content policy..."):
-            guardrails_result = check_guardrails(prompt)
+    # Shows the user's place in line while the shared rate limits hold the request back
+    queue_notice = st.empty()
 
-        if guardrails_result["blocked"]:
-            st.error(f"🚫 **Sorry mate, that particular brand of coffee is forbidden.**\n\n{guardrails_result['reason']}")
-            if guardrails_result.get("categories"):
-                st.caption(f"Flagged: {', '.join(guardrails_result['categories'])}")
-            st.stop()
+    def show_queue_position(position: int):
+        if position:
+            queue_notice.info(f"⏳ The baristas are busy. You're #{position} in line...")
         else:
-            st.success("✅ Order approved!", icon="☕")
+            queue_notice.empty()
+
+    # Speculative mode: start the provider request now and hold its output
+    # back until the guardrails scan finishes
+    speculative = st.session_state.enable_guardrails and st.session_state.speculative_guardrails
+    if speculative and st.session_state.calypso_api_key and cached_response is None:
+        stats["speculative"] = True
+        cancel_event = CancelScope()
+        start = time.perf_counter()
+        with tracing.use_span(turn_span):
+            chunks = buffer_in_background(
+                routed_chunks(conversation, model, temperature, max_tokens, stats, show_queue_position),
+                cancel_event
+            )
+    else:
+        speculative = False
+
+    # Check guardrails if enabled
+    if not screen_prompt(prompt, stats, turn_span):
+        if speculative:
+            cancel_event.set()
+        return
 
     # Display user message
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    # Save the user message to the conversation
+    save_message(user_message)
+
+    if cached_response is not None:
+        start = time.perf_counter()
+        chunks = iter([cached_response])
+    elif not speculative:
+        start = time.perf_counter()
+        chunks = routed_chunks(conversation, model, temperature, max_tokens, stats, show_queue_position)
 
     # Get and display assistant response
-    with st.chat_message("assistant"):
-        with st.spinner("Brewing your response... ☕"):
-            if st.session_state.provider == "Anthropic":
-                response = get_anthropic_response(
-                    st.session_state.messages,
-                    model,
-                    temperature,
-                    max_tokens
-                )
-            elif st.session_state.provider == "OpenAI":
-                response = get_openai_response(
-                    st.session_state.messages,
-                    model,
-                    temperature,
-                    max_tokens
-                )
-            else:  # Local
-                response = get_local_response(
-                    st.session_state.messages,
-                    model,
-                    temperature,
-                    max_tokens
-                )
+    with st.chat_message("assistant"), tracing.use_span(turn_span):
+        if st.session_state.stream_responses:
+            response = st.write_stream(timed_stream(chunks, stats, start))
+        else:
+            with st.spinner("Brewing your response... ☕"):
+                response = "".join(timed_stream(chunks, stats, start))
+            st.markdown(response)
+
+        stats["turn_time"] = time.perf_counter() - turn_start
+        st.caption(format_turn_metrics(stats))
+        render_timing_breakdown(stats)
+    metrics.observe_turn(provider, model, stats, response)
+    tracing.end_span(
+        turn_span,
+        error=response if is_error_chunk(response) else None,
+        **{
+            "coffee.backend": stats.get("backend"),
+            "coffee.cache_hit": stats.get("cache_hit"),
+            "gen_ai.usage.input_tokens": stats.get("input_tokens"),
+            "gen_ai.usage.output_tokens": stats.get("output_tokens")
+        }
+    )
+
+    # Remember successful answers: no error chunk anywhere in the stream, not just at the start,
+    # and only from the primary backend, since the keys and namespace are the primary's
+    served_by_primary = stats.get("backend") == f"{provider} · {model}" and not stats.get("fallback")
+    if (cached_response is None and served_by_primary
+            and not stats.get("stream_error") and not is_error_chunk(response)):
+        if response_cache_key:
+            get_response_cache().set(response_cache_key, response)
+        if semantic_namespace:
+            get_semantic_cache().add(prompt, semantic_namespace, response)
+
+    # Save the assistant response; both messages are already on screen,
+    # so there is no need for another full rerun to show them
+    save_message({"role": "assistant", "content": response, "metrics": stats})
+
+def handle_compare_prompt(prompt: str, routes: list):
+    """Answer one prompt with every route at once, streaming each answer into its own column"""
+    suggestions.empty()
+
+    user_message = {"role": "user", "content": prompt}
+    stats = {}
+    turn_start = time.perf_counter()
+    turn_span = tracing.start_span("compare turn", **{"coffee.compare.routes": ", ".join(routes)})
+
+    # The prompt is scanned once, whichever models answer it
+    if not screen_prompt(prompt, stats, turn_span):
+        return
+
+    with st.chat_message("user"):
+        st.markdown(prompt)
+    save_message(user_message)
+
+    entries = []
+    streams = []
+    start = time.perf_counter()
+    for route in routes:
+        route_provider, route_model = route.split(" · ", 1)
+        route_key = provider_api_key(route_provider)
+        route_stats = {}
+        # Each model gets as much of the conversation as fits its own context window
+        conversation, dropped_count, route_stats["context_tokens"] = fit_conversation(
+            [user_message],
+            context_budget(route_model, max_tokens, st.session_state.context_limit),
+            summarize=st.session_state.summarize_context
+        )
+        if dropped_count:
+            route_stats["dropped_messages"] = dropped_count
+        entries.append({"route": route, "content": "", "metrics": route_stats})
+        if route_provider != "Local" and not route_key:
+            missing_key = f"❌ Error: No API key for {route_provider}. Set {route_provider.upper()}_API_KEY."
+            streams.append(chunk for chunk in [missing_key])
+        else:
+            streams.append(timed_stream(
+                response_chunks(
+                    conversation, route_model, temperature, max_tokens, route_stats,
+                    provider=route_provider, api_key=route_key
+                ),
+                route_stats,
+                start
+            ))
+
+    with st.chat_message("assistant"), tracing.use_span(turn_span):
+        slots = []
+        for column, entry in zip(st.columns(len(entries)), entries):
+            with column:
+                st.markdown(f"**{entry['route']}**")
+                slots.append((st.empty(), st.empty()))
+
+        # Total wall time is that of the slowest model, not the sum of all of them
+        for index, chunk in fan_out(streams):
+            entry = entries[index]
+            if chunk is None:
+                slots[index][0].markdown(entry["content"])
+                continue
+            entry["content"] += chunk
+            slots[index][0].markdown(entry["content"] + " ▌")
+        stats["compare_time"] = time.perf_counter() - start
+
+        for entry, (_, caption_slot) in zip(entries, slots):
+            route_provider, route_model = entry["route"].split(" · ", 1)
+            if not is_error_chunk(entry["content"]):
+                entry["cost"] = turn_cost(route_provider, route_model, entry["metrics"], entry["content"])
+            caption_slot.caption(format_compared_answer(entry))
+            metrics.observe_turn(route_provider, route_model, entry["metrics"], entry["content"])
+        stats["compare"] = entries
+        stats["turn_time"] = time.perf_counter() - turn_start
+        st.caption(format_comparison_summary(stats))
+    tracing.end_span(turn_span)
+
+    # Later turns see every answer, each under its model's name
+    save_message({
+        "role": "assistant",
+        "content": "\n\n".join(f"**{entry['route']}**\n\n{entry['content']}" for entry in entries),
+        "metrics": stats
+    })
+
+if prompt:
+    active_compare_routes = [route for route in st.session_state.compare_routes if route in ROUTE_OPTIONS]
+    if st.session_state.compare_mode and len(active_compare_routes) >= 2:
+        handle_compare_prompt(prompt, active_compare_routes)
+    else:
+        handle_prompt(prompt)
+
+# Sidebar sections that depend on the conversation, drawn after this run's turn
+with context_usage_slot.container():
+    budget = context_budget(model, max_tokens, context_limit)
+    _, dropped_count, context_used = fit_conversation([], budget)
+    st.progress(
+        min(context_used / budget, 1.0) if budget else 1.0,
+        text=f"🧠 Context: {context_used:,} / {budget:,} tokens"
+    )
+    if dropped_count:
+        st.caption(f"✂️ {dropped_count} older messages no longer fit and are not sent")
+
+with recent_orders_slot.container():
+    # Last 5 prompts, newest first, from the conversation store's index
+    recent_prompts = (
+        conversation_store().recent_prompts(st.session_state.conversation_id, 5)
+        if st.session_state.conversation_id else []
+    )
 
-        st.markdown(response)
+    if recent_prompts:
+        for idx, recent_prompt in enumerate(recent_prompts):
+            # Truncate long messages for display
+            display_text = recent_prompt[:50] + "..." if len(recent_prompt) > 50 else recent_prompt
 
-    # Add assistant response to chat history
-    st.session_state.messages.append({"role": "assistant", "content": response})
+            # Create a unique key for each button
+            button_key = f"rerun_{idx}_{hash(recent_prompt)}"
+
+            st.button(
+                f"☕ {display_text}",
+                key=button_key,
+                type="secondary",
+                on_click=queue_prompt,
+                args=(recent_prompt,)
+            )
+    else:
+        st.caption("No orders yet. Ask me anything!")
 
-    # Rerun to update the interface
-    st.rerun()
+with past_conversations_slot.container():
+    search_query = st.text_input(
+        "🔍 Search past orders",
+        key="conversation_search",
+        placeholder="e.g. cold brew ratio"
+    ).strip()
+    if search_query:
+        # Ranked full-text matches; clicking one reopens its conversation at the match
+        search_results = conversation_store().search(search_query, conversation_owner(), limit=8)
+        for result in search_results:
+            title = result["title"] or "Untitled"
+            st.button(
+                f"{'🙋' if result['role'] == 'user' else '🤖'} {title[:40] + '...' if len(title) > 40 else title}",
+                key=f"search_{result['conversation_id']}_{result['seq']}",
+                type="secondary",
+                on_click=open_conversation,
+                args=(result["conversation_id"], result["seq"])
+            )
+            st.caption(result["snippet"])
+        if not search_results:
+            st.caption("No matching orders found.")
+    else:
+        if st.session_state.conversation_id:
+            st.button("🆕 New conversation", key="new_conversation", type="secondary", on_click=open_conversation)
+        past_conversations = conversation_store().conversations(conversation_owner(), limit=5)
+        for conversation in past_conversations:
+            current = conversation["id"] == st.session_state.conversation_id
+            title = conversation["title"] or "Untitled"
+            st.button(
+                f"{'📖' if current else '💬'} {title[:40] + '...' if len(title) > 40 else title}",
+                key=f"conversation_{conversation['id']}",
+                type="secondary",
+                disabled=current,
+                help=f"{conversation['message_count']} messages · {time.strftime('%b %d, %H:%M', time.localtime(conversation['updated_at']))}",
+                on_click=open_conversation,
+                args=(conversation["id"],)
+            )
+        if not past_conversations:
+            st.caption("Your conversations will be saved here.")
 
 # Footer
 st.markdown(
@@ -1030,3 +1974,5 @@ st.markdown(
     """,
     unsafe_allow_html=True
 )
+
+metrics.SCRIPT_RUNS.observe(time.perf_counter() - run_started, kind="turn" if prompt else "rerun")
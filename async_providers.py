@@ -0,0 +1,351 @@
+"""Async provider and guardrails calls with cooperative cancellation"""
+import asyncio
+import json
+import os
+import queue
+import threading
+
+import httpx
+
+from cache import verdict_cache_key
+from clients import AsyncClientRegistry
+from prompt_cache import anthropic_messages, anthropic_usage, local_cache_options, openai_usage
+from resilience import (
+    CircuitOpenError, RetryableStatusError, acall_with_retry, aentered_with_retry, araise_for_retryable_status
+)
+import tracing
+
+# F5 AI Guardrails (Calypso AI) scan endpoint
+CALYPSO_BASE_URL = os.getenv("CALYPSO_BASE_URL", "https://www.us1.calypsoai.app")
+CALYPSO_SCAN_URL = f"{CALYPSO_BASE_URL}/backend/v1/scans"
+
+# Models offered per provider
+ANTHROPIC_MODELS = [
+    "claude-sonnet-4-5-20250929",
+    "claude-3-5-sonnet-20241022",
+    "claude-3-5-haiku-20241022",
+    "claude-3-opus-20240229"
+]
+OPENAI_MODELS = [
+    "gpt-4o",
+    "gpt-4o-mini",
+    "gpt-4-turbo",
+    "gpt-3.5-turbo"
+]
+
+GUARDRAILS_TIMEOUT = 10
+LOCAL_TIMEOUT = 60
+
+
+def to_openai_messages(messages: list) -> list:
+    """Strip app metadata (metrics, token counts) from chat messages"""
+    return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+
+
+async def stream_anthropic(registry: AsyncClientRegistry, messages: list, model: str, temperature: float,
+                           max_tokens: int, stats: dict, api_key: str, prompt_caching: bool = True):
+    """Stream response from Anthropic API"""
+    try:
+        client = registry.anthropic_client(api_key)
+        # Only opening the stream is retried; a partly streamed answer is never repeated
+        async with aentered_with_retry(lambda: client.messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            messages=anthropic_messages(messages, model, prompt_caching)
+        ), breaker="Anthropic") as stream:
+            async for text in stream.text_stream:
+                yield text
+
+            stats.update(anthropic_usage((await stream.get_final_message()).usage))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        yield f"❌ Error: {str(e)}"
+
+
+async def stream_openai(registry: AsyncClientRegistry, messages: list, model: str, temperature: float,
+                        max_tokens: int, stats: dict, api_key: str):
+    """Stream response from OpenAI API"""
+    try:
+        client = registry.openai_client(api_key)
+        # Only opening the stream is retried; a partly streamed answer is never repeated
+        stream = await acall_with_retry(lambda: client.chat.completions.create(
+            model=model,
+            messages=to_openai_messages(messages),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        ), breaker="OpenAI")
+        async with stream:
+            async for chunk in stream:
+                # The final chunk carries usage and no choices
+                if chunk.usage:
+                    stats.update(openai_usage(chunk.usage.model_dump()))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        yield f"❌ Error: {str(e)}"
+
+
+async def stream_local(registry: AsyncClientRegistry, messages: list, model: str, temperature: float,
+                       max_tokens: int, stats: dict, base_url: str = None, api_key: str = "",
+                       prompt_caching: bool = True, endpoint_pool=None):
+    """Stream response from Local API Server using server-sent events
+
+    With an endpoint_pool the request goes to the replica it picks
+    instead of base_url.
+    """
+    endpoint = endpoint_pool.acquire() if endpoint_pool is not None else None
+    if endpoint is not None:
+        base_url = endpoint.url
+    failed = False
+
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream"
+    }
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+
+    payload = {
+        "model": model,
+        "messages": to_openai_messages(messages),
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+        **local_cache_options(prompt_caching)
+    }
+
+    try:
+        client = registry.http_session("Local", base_url)
+        # Only opening the stream is retried; a partly streamed answer is never repeated
+        async with aentered_with_retry(lambda: client.stream(
+            "POST",
+            f"{base_url}/v1/chat/completions",
+            json=payload,
+            headers=tracing.inject(headers),
+            timeout=LOCAL_TIMEOUT
+        ), check=araise_for_retryable_status, breaker=f"Local {base_url}") as response:
+            if response.status_code != 200:
+                failed = response.status_code >= 500
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                yield f"❌ Error: Server returned {response.status_code} - {body}"
+                return
+
+            async for line in response.aiter_lines():
+                # SSE frames look like "data: {...}"; skip keep-alives and comments
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    # Keep reading to the end of the body so the connection is reused
+                    continue
+
+                chunk = json.loads(data)
+                usage = chunk.get("usage")
+                if usage:
+                    stats.update(openai_usage(usage, chunk.get("timings")))
+                choices = chunk.get("choices") or []
+                if choices:
+                    content = (choices[0].get("delta") or {}).get("content")
+                    if content:
+                        yield content
+
+    except asyncio.CancelledError:
+        raise
+    except (RetryableStatusError, CircuitOpenError) as e:
+        # An open breaker fails fast; counting it keeps the pool from preferring this replica
+        failed = True
+        yield f"❌ Error: {str(e)}"
+    except httpx.ConnectError:
+        failed = True
+        yield f"❌ Connection Error: Could not connect to {base_url}. Make sure your local server is running."
+    except httpx.TimeoutException:
+        failed = True
+        yield "❌ Timeout Error: The request took too long. Try again or check your server."
+    except Exception as e:
+        yield f"❌ Error: {str(e)}"
+    finally:
+        if endpoint is not None:
+            endpoint_pool.release(endpoint, failed)
+
+
+def stream_chat(registry: AsyncClientRegistry, provider: str, messages: list, model: str,
+                temperature: float, max_tokens: int, stats: dict, api_key: str = "",
+                base_url: str = None, prompt_caching: bool = True, endpoint_pool=None):
+    """Async generator for the response from the given provider"""
+    if provider == "Anthropic":
+        return stream_anthropic(registry, messages, model, temperature, max_tokens, stats,
+                                api_key, prompt_caching)
+    if provider == "OpenAI":
+        return stream_openai(registry, messages, model, temperature, max_tokens, stats, api_key)
+    return stream_local(registry, messages, model, temperature, max_tokens, stats,
+                        base_url, api_key, prompt_caching, endpoint_pool)
+
+
+async def check_guardrails(registry: AsyncClientRegistry, prompt: str, api_key: str,
+                           scan_model: str = "default", verdict_cache=None, prefilter=None) -> dict:
+    """Check prompt against Calypso AI guardrails
+
+    Same verdicts and fail-open/fail-closed behaviour as the app. Notices
+    meant for the user come back under "warning" or "error" instead of
+    being rendered here. Prompts the local prefilter settles are not sent.
+    """
+    if prefilter is not None:
+        local = prefilter.check(prompt)
+        if local is not None:
+            return local
+
+    cache_key = verdict_cache_key(prompt, api_key, scan_model)
+    if verdict_cache is not None:
+        cached = verdict_cache.get(cache_key)
+        if cached is not None:
+            return {**cached, "cached": True}
+
+    try:
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        payload = {
+            "input": prompt,
+            "model": scan_model
+        }
+
+        client = registry.http_session("Guardrails", CALYPSO_BASE_URL)
+
+        async def scan():
+            response = await client.post(
+                CALYPSO_SCAN_URL,
+                json=payload,
+                headers=tracing.inject(headers),
+                timeout=GUARDRAILS_TIMEOUT
+            )
+            await araise_for_retryable_status(response)
+            return response
+
+        response = await acall_with_retry(scan, breaker="Guardrails")
+
+        if response.status_code == 200:
+            data = response.json()
+            outcome = data.get("result", {}).get("outcome", "flagged")
+            is_blocked = (outcome == "flagged")
+
+            result = {
+                "allowed": not is_blocked,
+                "blocked": is_blocked,
+                "reason": data.get("reason", "F5 Guardrails Policy Violation" if is_blocked else "Content approved"),
+                "categories": data.get("categories", [])
+            }
+            if verdict_cache is not None:
+                verdict_cache.set(cache_key, result)
+            return result
+
+        # If the API returns an error, don't block (fail open)
+        return {
+            "allowed": True,
+            "blocked": False,
+            "reason": f"API error: {response.status_code}",
+            "warning": f"⚠️ Guardrails check returned status {response.status_code}. Proceeding without check."
+        }
+
+    except asyncio.CancelledError:
+        raise
+    except RetryableStatusError as e:
+        # Still rate limited or unavailable after retries: fail open
+        return {
+            "allowed": True,
+            "blocked": False,
+            "reason": f"API error: {e.status_code}",
+            "warning": f"⚠️ Guardrails check returned status {e.status_code}. Proceeding without check."
+        }
+    except CircuitOpenError as e:
+        # The service keeps failing: skip the scan instead of waiting on it again
+        return {
+            "allowed": True,
+            "blocked": False,
+            "reason": f"Circuit open: {str(e)}",
+            "warning": "⚠️ Guardrails service is unavailable. Proceeding without check."
+        }
+    except httpx.HTTPError as e:
+        # If there's a connection error, fail open (allow the request)
+        return {
+            "allowed": True,
+            "blocked": False,
+            "reason": f"Connection error: {str(e)}",
+            "warning": "⚠️ Could not connect to guardrails service. Proceeding without check."
+        }
+    except (ValueError, KeyError) as e:
+        # An unreadable response body is a service problem, not a verdict: fail open like the app,
+        # whose requests JSON errors are connection errors
+        return {
+            "allowed": True,
+            "blocked": False,
+            "reason": f"Invalid response: {str(e)}",
+            "warning": "⚠️ Guardrails service returned an unreadable response. Proceeding without check."
+        }
+    except Exception as e:
+        return {
+            "allowed": False,
+            "blocked": True,
+            "reason": f"System error: {str(e)}",
+            "error": f"❌ Guardrails error: {str(e)}"
+        }
+
+
+class BackgroundLoop:
+    """Event loop on a daemon thread for driving async calls from sync code"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-providers", daemon=True)
+        self._thread.start()
+        self.registry = AsyncClientRegistry()
+
+    def run(self, coro, timeout: float = None):
+        """Run a coroutine on the loop and wait for its result"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        finally:
+            future.cancel()
+
+    def iterate(self, agen, should_cancel=None, poll_interval: float = 0.1):
+        """Consume an async generator from sync code, one chunk at a time
+
+        Closing the returned generator, or should_cancel() returning True
+        while waiting, cancels the task on the loop. The cancellation
+        closes the upstream HTTP stream right away.
+        """
+        chunks = queue.Queue()
+        finished = object()
+
+        async def pump():
+            try:
+                async for chunk in agen:
+                    chunks.put(chunk)
+            finally:
+                chunks.put(finished)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                try:
+                    chunk = chunks.get(timeout=poll_interval)
+                except queue.Empty:
+                    if should_cancel is not None and should_cancel():
+                        return
+                    continue
+                if chunk is finished:
+                    break
+                yield chunk
+
+            # Surface unexpected failures from the pump itself
+            future.result()
+        finally:
+            future.cancel()
@@ -0,0 +1,327 @@
+"""Run JSONL prompt files through guardrails and a provider in parallel
+
+    python batch_eval.py prompts.jsonl -o results.jsonl --concurrency 32
+    python batch_eval.py prompts.jsonl -o results/ --format parquet --guardrails-only
+
+Each input line is a JSON object with a prompt ("prompt", "input", "body"
+or "content") or a "messages" list, and optionally an "id" or
+"request_id". Input is read lazily, results are written as they
+complete, and finished ids go to a checkpoint file so an interrupted run
+picks up where it stopped when started again with the same output.
+Prompts that ended in an error are not checkpointed: a rerun tries them
+again and appends a new row, which supersedes the earlier one.
+Provider, model and keys default to the settings saved by the app.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import async_providers
+from context import message_tokens
+from gateway import Gateway, provider_for_model
+from ratelimit import AdmissionTimeout
+from routing import is_error_chunk
+
+PROMPT_FIELDS = ["prompt", "input", "body", "content"]
+PARQUET_ROWS_PER_FILE = 1000
+
+
+def read_items(path: Path, prompt_field: str = None):
+    """Yield (id, messages) per input line without loading the whole file"""
+    fields = [prompt_field] if prompt_field else PROMPT_FIELDS
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                item_id = str(record.get("id") or record.get("request_id") or line_number)
+                if isinstance(record.get("messages"), list):
+                    messages = [{"role": msg["role"], "content": msg["content"]} for msg in record["messages"]]
+                else:
+                    prompt = next((record[field] for field in fields if record.get(field)), None)
+                    if prompt is None:
+                        print(f"⚠️ Line {line_number}: no prompt field, skipped", file=sys.stderr)
+                        continue
+                    messages = [{"role": "user", "content": prompt}]
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                # One bad line must not stop the run (or every resume of it)
+                print(f"⚠️ Line {line_number}: invalid record ({type(e).__name__}: {e}), skipped", file=sys.stderr)
+                continue
+            yield item_id, messages
+
+
+def load_checkpoint(path: Path) -> set:
+    if not path.exists():
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def settled(result: dict) -> bool:
+    """Whether a result is final, so a resumed run skips its prompt"""
+    return result["error"] is None
+
+
+class JsonlWriter:
+    """Append one result per line, flushed as it arrives"""
+
+    def __init__(self, path: Path, checkpoint):
+        self._file = open(path, "a", encoding="utf-8")
+        self._checkpoint = checkpoint
+
+    def write(self, result: dict):
+        self._file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if settled(result):
+            self._checkpoint.write(result["id"] + "\n")
+            self._checkpoint.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """Write results to part files in a directory, one file per PARQUET_ROWS_PER_FILE rows"""
+
+    def __init__(self, path: Path, checkpoint):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("❌ Parquet output needs pyarrow: pip install pyarrow")
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        self._dir = path
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._checkpoint = checkpoint
+        string, number = pyarrow.string(), pyarrow.float64()
+        # Fixed types so part files with all-empty columns still read as one dataset
+        self._schema = pyarrow.schema([
+            ("id", string), ("prompt", string), ("provider", string), ("model", string),
+            ("verdict", string), ("reason", string), ("categories", string), ("response", string),
+            ("error", string), ("guardrails_s", number), ("ttft_s", number), ("provider_s", number),
+            ("total_s", number), ("input_tokens", pyarrow.int64()), ("output_tokens", pyarrow.int64()),
+            ("cached_input_tokens", pyarrow.int64())
+        ])
+        self._run = uuid.uuid4().hex[:8]
+        self._parts = 0
+        self._rows = []
+
+    def write(self, result: dict):
+        self._rows.append(result)
+        if len(self._rows) >= PARQUET_ROWS_PER_FILE:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        # Categories vary in shape per policy, so keep them as JSON text
+        rows = [{**row, "categories": json.dumps(row["categories"])} for row in self._rows]
+        table = self._pyarrow.Table.from_pylist(rows, schema=self._schema)
+        self._parquet.write_table(table, self._dir / f"part-{self._run}-{self._parts:05d}.parquet")
+        self._parts += 1
+        # Only rows that reached disk count as done
+        self._checkpoint.write("".join(row["id"] + "\n" for row in self._rows if settled(row)))
+        self._checkpoint.flush()
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+
+def blank_result(item_id: str, messages: list, args) -> dict:
+    """Result row for a prompt before anything has run"""
+    return {
+        "id": item_id,
+        "prompt": next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), ""),
+        "provider": provider_for_model(args.model),
+        "model": args.model,
+        "verdict": "skipped",
+        "reason": "",
+        "categories": [],
+        "response": None,
+        "error": None,
+        "guardrails_s": None,
+        "ttft_s": None,
+        "provider_s": None,
+        "total_s": None,
+        "input_tokens": None,
+        "output_tokens": None,
+        "cached_input_tokens": None
+    }
+
+
+async def evaluate(gateway: Gateway, settings: dict, item_id: str, messages: list, args) -> dict:
+    """Guardrails scan and (if allowed) provider call for one prompt"""
+    result = blank_result(item_id, messages, args)
+    provider = result["provider"]
+    prompt = result["prompt"]
+    start = time.perf_counter()
+
+    calypso_api_key = settings.get("calypso_api_key")
+    if not args.no_guardrails and calypso_api_key:
+        verdict = await async_providers.check_guardrails(
+            gateway.registry, prompt, calypso_api_key, verdict_cache=gateway.verdict_cache,
+            prefilter=gateway.prefilter
+        )
+        result["guardrails_s"] = time.perf_counter() - start
+        result["reason"] = verdict.get("reason", "")
+        result["categories"] = verdict.get("categories", [])
+        if verdict.get("error"):
+            result["verdict"] = "error"
+            result["error"] = verdict["error"]
+        elif verdict["blocked"]:
+            result["verdict"] = "flagged"
+        elif verdict.get("warning"):
+            result["verdict"] = "unscanned"
+            result["error"] = verdict["warning"]
+        else:
+            result["verdict"] = "cleared"
+
+    if args.guardrails_only or result["verdict"] in ("flagged", "error"):
+        result["total_s"] = time.perf_counter() - start
+        return result
+
+    api_key = gateway.api_key(provider, settings)
+    limiter = gateway.admission.limiter(provider, api_key)
+    try:
+        ticket = await asyncio.to_thread(
+            limiter.acquire, "batch", sum(message_tokens(msg) for msg in messages) + args.max_tokens
+        )
+    except AdmissionTimeout as e:
+        result["error"] = f"❌ Error: {str(e)}"
+        result["total_s"] = time.perf_counter() - start
+        return result
+
+    stats = {}
+    provider_start = time.perf_counter()
+    parts = []
+    try:
+        async for chunk in async_providers.stream_chat(
+            gateway.registry,
+            provider,
+            messages,
+            args.model,
+            args.temperature,
+            args.max_tokens,
+            stats,
+            api_key=api_key,
+            prompt_caching=settings.get("prompt_caching", True),
+            endpoint_pool=gateway.local_pool(settings) if provider == "Local" else None
+        ):
+            if is_error_chunk(chunk):
+                result["error"] = chunk
+                break
+            if result["ttft_s"] is None:
+                result["ttft_s"] = time.perf_counter() - provider_start
+            parts.append(chunk)
+    finally:
+        used_tokens = (stats.get("input_tokens") or 0) + (stats.get("output_tokens") or 0)
+        limiter.release(ticket, used_tokens or None)
+
+    end = time.perf_counter()
+    result.update({
+        "response": "".join(parts) if parts else None,
+        "provider_s": end - provider_start,
+        "total_s": end - start,
+        "input_tokens": stats.get("input_tokens"),
+        "output_tokens": stats.get("output_tokens"),
+        "cached_input_tokens": stats.get("cached_input_tokens")
+    })
+    return result
+
+
+async def run(args) -> dict:
+    gateway = Gateway()
+    settings = gateway.settings()
+    args.model = args.model or settings.get("model", "")
+    args.temperature = settings.get("temperature", 0.7) if args.temperature is None else args.temperature
+    args.max_tokens = args.max_tokens or settings.get("max_tokens", 1024)
+
+    output = Path(args.output)
+    checkpoint_path = Path(args.checkpoint) if args.checkpoint else output.with_name(output.name + ".checkpoint")
+    done = load_checkpoint(checkpoint_path)
+    if done:
+        print(f"↩️ Resuming: {len(done):,} prompts already done", file=sys.stderr)
+
+    checkpoint = open(checkpoint_path, "a", encoding="utf-8")
+    writer = (ParquetWriter if args.format == "parquet" else JsonlWriter)(output, checkpoint)
+    # A bounded queue keeps memory flat however large the input file is
+    work = asyncio.Queue(maxsize=args.concurrency * 2)
+    counts = {"done": 0, "flagged": 0, "errors": 0}
+    started = time.perf_counter()
+
+    async def worker():
+        while True:
+            item = await work.get()
+            if item is None:
+                return
+            try:
+                result = await evaluate(gateway, settings, *item, args)
+            except Exception as e:
+                # Record the failure and keep going; a dead worker would leave work.put() waiting forever
+                result = blank_result(*item, args)
+                result["error"] = f"❌ Error: {str(e)}"
+            writer.write(result)
+            counts["done"] += 1
+            counts["flagged"] += result["verdict"] == "flagged"
+            counts["errors"] += result["error"] is not None and result["verdict"] != "unscanned"
+            if counts["done"] % args.progress_every == 0:
+                rate = counts["done"] / (time.perf_counter() - started)
+                print(f"☕ {counts['done']:,} done · {counts['flagged']:,} flagged · "
+                      f"{counts['errors']:,} errors · {rate:.1f} prompts/sec", file=sys.stderr)
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    try:
+        for item_id, messages in read_items(Path(args.input), args.prompt_field):
+            if item_id in done:
+                continue
+            await work.put((item_id, messages))
+        for _ in workers:
+            await work.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        writer.close()
+        checkpoint.close()
+        await gateway.registry.aclose()
+
+    counts["seconds"] = time.perf_counter() - started
+    return counts
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Batch-evaluate JSONL prompts through guardrails and a provider")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("-o", "--output", required=True,
+                        help="JSONL file, or a directory of part files with --format parquet")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--concurrency", type=int, default=16, help="parallel prompts in flight")
+    parser.add_argument("--model", help="model to call (default: the app's saved model)")
+    parser.add_argument("--temperature", type=float)
+    parser.add_argument("--max-tokens", type=int)
+    parser.add_argument("--prompt-field", help="input field holding the prompt")
+    parser.add_argument("--guardrails-only", action="store_true", help="only scan prompts, skip the provider")
+    parser.add_argument("--no-guardrails", action="store_true", help="skip the guardrails scan")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--progress-every", type=int, default=100)
+    args = parser.parse_args(argv)
+    if args.progress_every < 1:
+        parser.error("--progress-every must be at least 1")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
+    counts = asyncio.run(run(args))
+    print(f"✅ {counts['done']:,} prompts in {counts['seconds']:.1f}s · {counts['flagged']:,} flagged · "
+          f"{counts['errors']:,} errors", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""Offline bulk jobs through the Anthropic Message Batches and OpenAI Batch APIs
+
+    python batch_offline.py prompts.jsonl -o results.jsonl --model claude-3-5-haiku-20241022
+    python batch_offline.py prompts.jsonl -o results.jsonl --model gpt-4o-mini \\
+        --base-url http://127.0.0.1:8010 --poll-interval 0.5   # against mock_server.py
+
+Prompts (same input format as batch_eval.py) are packed into provider
+batches, which cost about half as much as interactive calls and finish
+within 24 hours. Submitted batch ids are saved next to the output, so an
+interrupted run resumes polling instead of submitting again. Results are
+matched back to input ids and appended to the output as each batch ends.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+import async_providers
+from batch_eval import read_items
+from clients import ClientRegistry
+from gateway import Gateway, provider_for_model
+from prompt_cache import anthropic_messages, anthropic_usage, openai_usage
+from resilience import call_with_retry
+
+# Provider limits per batch (requests, bytes)
+ANTHROPIC_BATCH_LIMITS = (100_000, 256 * 1024 * 1024)
+OPENAI_BATCH_LIMITS = (50_000, 200 * 1024 * 1024)
+
+OPENAI_DONE_STATUSES = {"completed", "failed", "expired", "cancelled"}
+POLL_BACKOFF = 1.5
+
+
+def pack(requests: list, max_requests: int, max_bytes: int):
+    """Split (custom_id, request) pairs into batches under the provider limits"""
+    batch, size = [], 0
+    for custom_id, request in requests:
+        request_size = len(json.dumps(request)) + 1
+        if batch and (len(batch) >= max_requests or size + request_size > max_bytes):
+            yield batch
+            batch, size = [], 0
+        batch.append((custom_id, request))
+        size += request_size
+    if batch:
+        yield batch
+
+
+class AnthropicBatches:
+    """Submit, poll and read Anthropic Message Batches"""
+
+    provider = "Anthropic"
+    limits = ANTHROPIC_BATCH_LIMITS
+
+    def __init__(self, client, model: str, temperature: float, max_tokens: int, prompt_caching: bool):
+        self.client = client
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.prompt_caching = prompt_caching
+
+    def request(self, messages: list) -> dict:
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "messages": anthropic_messages(messages, self.model, self.prompt_caching)
+        }
+
+    def submit(self, batch: list) -> str:
+        created = call_with_retry(lambda: self.client.messages.batches.create(requests=[
+            {"custom_id": custom_id, "params": params} for custom_id, params in batch
+        ]), breaker=self.provider)
+        return created.id
+
+    def status(self, batch_id: str) -> tuple:
+        """(finished, progress text)"""
+        batch = call_with_retry(lambda: self.client.messages.batches.retrieve(batch_id), breaker=self.provider)
+        counts = batch.request_counts
+        done = counts.succeeded + counts.errored + counts.canceled + counts.expired
+        return batch.processing_status == "ended", f"{done:,}/{done + counts.processing:,}"
+
+    def results(self, batch_id: str):
+        """Yield (custom_id, status, response, error, usage)"""
+        entries = call_with_retry(lambda: self.client.messages.batches.results(batch_id), breaker=self.provider)
+        for entry in entries:
+            result = entry.result
+            if result.type == "succeeded":
+                text = "".join(block.text for block in result.message.content if block.type == "text")
+                yield entry.custom_id, "succeeded", text, None, anthropic_usage(result.message.usage)
+            elif result.type == "errored":
+                yield entry.custom_id, "errored", None, str(result.error.error.message), {}
+            else:
+                yield entry.custom_id, result.type, None, None, {}
+
+
+class OpenAIBatches:
+    """Submit, poll and read OpenAI Batch API jobs"""
+
+    provider = "OpenAI"
+    limits = OPENAI_BATCH_LIMITS
+
+    def __init__(self, client, model: str, temperature: float, max_tokens: int, prompt_caching: bool):
+        self.client = client
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    def request(self, messages: list) -> dict:
+        return {
+            "model": self.model,
+            "messages": async_providers.to_openai_messages(messages),
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
+        }
+
+    def submit(self, batch: list) -> str:
+        lines = "".join(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body
+        }) + "\n" for custom_id, body in batch)
+        upload = call_with_retry(
+            lambda: self.client.files.create(file=("batch.jsonl", lines.encode("utf-8")), purpose="batch"),
+            breaker=self.provider
+        )
+        created = call_with_retry(lambda: self.client.batches.create(
+            input_file_id=upload.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        ), breaker=self.provider)
+        return created.id
+
+    def status(self, batch_id: str) -> tuple:
+        batch = call_with_retry(lambda: self.client.batches.retrieve(batch_id), breaker=self.provider)
+        counts = batch.request_counts
+        progress = f"{counts.completed + counts.failed:,}/{counts.total:,}" if counts else batch.status
+        return batch.status in OPENAI_DONE_STATUSES, progress
+
+    def results(self, batch_id: str):
+        batch = call_with_retry(lambda: self.client.batches.retrieve(batch_id), breaker=self.provider)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = call_with_retry(lambda: self.client.files.content(file_id), breaker=self.provider)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                body = response.get("body") or {}
+                if response.get("status_code") == 200:
+                    text = body["choices"][0]["message"]["content"]
+                    yield entry["custom_id"], "succeeded", text, None, openai_usage(body.get("usage") or {})
+                else:
+                    error = entry.get("error") or body.get("error") or {}
+                    yield entry["custom_id"], "errored", None, error.get("message", str(error)), {}
+
+
+def result_record(item_id: str, prompt: str, provider: str, model: str, batch_id: str, status: str,
+                  response: str = None, error: str = None, usage: dict = None) -> dict:
+    usage = usage or {}
+    return {
+        "id": item_id,
+        "prompt": prompt,
+        "provider": provider,
+        "model": model,
+        "batch_id": batch_id,
+        "status": status,
+        "response": response,
+        "error": error,
+        "input_tokens": usage.get("input_tokens"),
+        "output_tokens": usage.get("output_tokens"),
+        "cached_input_tokens": usage.get("cached_input_tokens")
+    }
+
+
+async def scan_prompts(gateway: Gateway, items: list, calypso_api_key: str, concurrency: int) -> dict:
+    """Guardrails verdicts for every prompt, keyed by input id"""
+    limit = asyncio.Semaphore(concurrency)
+
+    async def scan(item_id: str, messages: list):
+        prompt = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), "")
+        async with limit:
+            return item_id, await async_providers.check_guardrails(
+                gateway.registry, prompt, calypso_api_key, verdict_cache=gateway.verdict_cache,
+                prefilter=gateway.prefilter
+            )
+
+    try:
+        return dict(await asyncio.gather(*(scan(item_id, messages) for item_id, messages in items)))
+    finally:
+        await gateway.registry.aclose()
+
+
+def save_state(path: Path, state: dict):
+    temp = path.with_name(path.name + ".tmp")
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    temp.replace(path)
+
+
+def submit_all(gateway: Gateway, jobs, items: list, output, state_path: Path, args) -> dict:
+    """Record every allowed prompt as pending, then submit them, returning the saved job state"""
+    settings = gateway.settings()
+    verdicts = {}
+    calypso_api_key = settings.get("calypso_api_key")
+    if args.guardrails and calypso_api_key:
+        print(f"🛡️ Scanning {len(items):,} prompts...", file=sys.stderr)
+        verdicts = asyncio.run(scan_prompts(gateway, items, calypso_api_key, args.scan_concurrency))
+
+    prompts = {}
+    for index, (item_id, messages) in enumerate(items):
+        prompt = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), "")
+        verdict = verdicts.get(item_id)
+        if verdict is not None and verdict["blocked"]:
+            status = "error" if verdict.get("error") else "flagged"
+            output.write(json.dumps(result_record(
+                item_id, prompt, jobs.provider, jobs.model, None, status, error=verdict.get("reason")
+            ), ensure_ascii=False) + "\n")
+            continue
+        # Custom ids only allow [a-zA-Z0-9_-], so input ids are mapped back from the state file
+        custom_id = f"req-{index}"
+        prompts[custom_id] = [item_id, prompt]
+    output.flush()
+
+    # Saved before anything is submitted, so a crash midway leaves the rest pending for a resume
+    state = {"provider": jobs.provider, "model": jobs.model, "batches": [], "pending": prompts}
+    save_state(state_path, state)
+    return submit_pending(jobs, state, items, state_path, args)
+
+
+def submit_pending(jobs, state: dict, items: list, state_path: Path, args) -> dict:
+    """Pack and submit the state's pending prompts, moving each batch's out of pending as it goes"""
+    requests = []
+    for custom_id, (item_id, _) in state["pending"].items():
+        index = int(custom_id.split("-", 1)[1])
+        if index >= len(items) or items[index][0] != item_id:
+            raise SystemExit(f"❌ {item_id} is no longer at the same place in the input; "
+                             "resume with the input the run started with.")
+        requests.append((custom_id, jobs.request(items[index][1])))
+
+    max_requests, max_bytes = jobs.limits
+    for batch in pack(requests, min(max_requests, args.batch_size), max_bytes):
+        batch_id = jobs.submit(batch)
+        state["batches"].append({
+            "id": batch_id,
+            "requests": {custom_id: state["pending"].pop(custom_id) for custom_id, _ in batch},
+            "written": False
+        })
+        # Save after every submission so a crash never submits a batch twice
+        save_state(state_path, state)
+        print(f"📤 Submitted {batch_id} ({len(batch):,} requests)", file=sys.stderr)
+    return state
+
+
+def collect(jobs, state: dict, output, state_path: Path, poll_interval: float, max_poll_interval: float) -> dict:
+    """Poll until every batch ends, writing each batch's results as it finishes"""
+    counts = {}
+    delay = poll_interval
+    while True:
+        pending = [batch for batch in state["batches"] if not batch["written"]]
+        if not pending:
+            return counts
+
+        progressed = False
+        for batch in pending:
+            finished, progress = jobs.status(batch["id"])
+            if not finished:
+                print(f"⏳ {batch['id']}: {progress}", file=sys.stderr)
+                continue
+
+            requests = batch["requests"]
+            seen = set()
+            for custom_id, status, response, error, usage in jobs.results(batch["id"]):
+                if custom_id not in requests:
+                    continue
+                seen.add(custom_id)
+                item_id, prompt = requests[custom_id]
+                output.write(json.dumps(result_record(
+                    item_id, prompt, jobs.provider, jobs.model, batch["id"], status, response, error, usage
+                ), ensure_ascii=False) + "\n")
+                counts[status] = counts.get(status, 0) + 1
+            # Requests with no result line (expired or cancelled jobs) are still accounted for
+            for custom_id in requests.keys() - seen:
+                item_id, prompt = requests[custom_id]
+                output.write(json.dumps(result_record(
+                    item_id, prompt, jobs.provider, jobs.model, batch["id"], "expired"
+                ), ensure_ascii=False) + "\n")
+                counts["expired"] = counts.get("expired", 0) + 1
+            output.flush()
+            batch["written"] = True
+            save_state(state_path, state)
+            progressed = True
+            print(f"📥 {batch['id']} finished", file=sys.stderr)
+
+        # Poll quickly while batches are finishing, back off while they are not
+        delay = poll_interval if progressed else min(delay * POLL_BACKOFF, max_poll_interval)
+        if any(not batch["written"] for batch in state["batches"]):
+            time.sleep(delay)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Run prompts through provider batch APIs")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("-o", "--output", required=True, help="JSONL results file")
+    parser.add_argument("--model", help="Anthropic or OpenAI model (default: the app's saved model)")
+    parser.add_argument("--temperature", type=float)
+    parser.add_argument("--max-tokens", type=int)
+    parser.add_argument("--prompt-field", help="input field holding the prompt")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="requests per provider batch")
+    parser.add_argument("--guardrails", action="store_true", help="scan prompts first and skip flagged ones")
+    parser.add_argument("--scan-concurrency", type=int, default=16)
+    parser.add_argument("--base-url", help="provider base URL, e.g. a mock_server.py instance")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="seconds between status checks")
+    parser.add_argument("--max-poll-interval", type=float, default=60.0)
+    args = parser.parse_args(argv)
+
+    gateway = Gateway()
+    settings = gateway.settings()
+    model = args.model or settings.get("model", "")
+    provider = provider_for_model(model)
+    if provider == "Local":
+        raise SystemExit("❌ Local servers have no batch API; use batch_eval.py instead.")
+    api_key = gateway.api_key(provider, settings) or ("stub" if args.base_url else "")
+    if not api_key:
+        raise SystemExit(f"❌ No API key for {provider}: save one in the app or set {provider.upper()}_API_KEY.")
+
+    registry = ClientRegistry()
+    if provider == "Anthropic":
+        client = registry.anthropic_client(api_key, args.base_url)
+        jobs_class = AnthropicBatches
+    else:
+        client = registry.openai_client(api_key, f"{args.base_url.rstrip('/')}/v1" if args.base_url else None)
+        jobs_class = OpenAIBatches
+    jobs = jobs_class(
+        client,
+        model,
+        settings.get("temperature", 0.7) if args.temperature is None else args.temperature,
+        args.max_tokens or settings.get("max_tokens", 1024),
+        settings.get("prompt_caching", True)
+    )
+
+    output_path = Path(args.output)
+    state_path = output_path.with_name(output_path.name + ".batches.json")
+    started = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as output:
+        if state_path.exists():
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if (state["provider"], state["model"]) != (provider, model):
+                raise SystemExit(f"❌ {state_path} holds {state['provider']} · {state['model']} batches; "
+                                 f"pass --model {state['model']} or use another output.")
+            print(f"↩️ Resuming {len(state['batches'])} submitted batches", file=sys.stderr)
+            if state.get("pending"):
+                print(f"📤 Submitting {len(state['pending']):,} prompts the last run did not get to",
+                      file=sys.stderr)
+                items = list(read_items(Path(args.input), args.prompt_field))
+                submit_pending(jobs, state, items, state_path, args)
+        else:
+            items = list(read_items(Path(args.input), args.prompt_field))
+            state = submit_all(gateway, jobs, items, output, state_path, args)
+        counts = collect(jobs, state, output, state_path, args.poll_interval, args.max_poll_interval)
+
+    summary = " · ".join(f"{count:,} {status}" for status, count in sorted(counts.items())) or "nothing to collect"
+    print(f"✅ {summary} in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
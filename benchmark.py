@@ -0,0 +1,291 @@
+"""Load test the provider layer and the Streamlit app against mock servers
+
+    python benchmark.py providers --requests 500 --concurrency 50 --guardrails
+    python benchmark.py app --sessions 8 --turns 3 --guardrails --ttft-ms 400
+
+Starts mock_server.py in-process (or uses --target) as both the Local
+LLM server and the Calypso scan endpoint, then reports p50/p95/p99 TTFT,
+end-to-end latency and guardrails latency, throughput, and (in app mode)
+memory retained per Streamlit session. TTFT counts from the start of the
+request, so it includes the guardrails scan and any connection pool wait.
+
+"providers" drives async_providers.check_guardrails and stream_chat
+directly. "app" runs concurrent sessions of app.py through Streamlit's
+testing API, so every turn includes the script reruns a user would see;
+it also times a plain rerun after each turn, with --history earlier
+messages in the conversation. The testing API keeps one Streamlit runtime
+per process, so each concurrent session runs in a process of its own.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+
+import uvicorn
+
+import async_providers
+import mock_server
+from clients import AsyncClientRegistry
+from conversation_store import ConversationStore
+from routing import is_error_chunk, percentile
+
+APP_PATH = Path(__file__).with_name("app.py")
+MOCK_MODEL = "mock-model"
+
+
+def start_mock_server(args) -> str:
+    """Run mock_server.py on a background thread and return its base URL"""
+    app = mock_server.create_app(profile=mock_server.profile_from_args(args))
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.mock_port, log_level="warning",
+                                          access_log=False))
+    threading.Thread(target=server.run, name="mock-server", daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise SystemExit(f"❌ Mock server did not start on port {args.mock_port}")
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{args.mock_port}"
+
+
+def use_mock_guardrails(base_url: str):
+    """Point guardrails scans (async layer and app) at the mock scanner"""
+    # app.py imports the URL from async_providers on every run, so this covers both
+    async_providers.CALYPSO_BASE_URL = base_url
+    async_providers.CALYPSO_SCAN_URL = f"{base_url}/backend/v1/scans"
+
+
+def prompt_for(index: int, args) -> str:
+    if args.flag_every and index % args.flag_every == 0:
+        return f"Benchmark prompt {index} {mock_server.FLAG_MARKER}"
+    return f"Benchmark prompt {index}: what's the best way to brew coffee?"
+
+
+async def bench_providers(base_url: str, args) -> list:
+    """Concurrent guardrails + streaming completions through the async provider layer"""
+    registry = AsyncClientRegistry()
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def one(index: int) -> dict:
+        prompt = prompt_for(index, args)
+        sample = {"status": "ok", "ttft": None, "guardrails": None, "output_tokens": 0}
+        async with limit:
+            start = time.perf_counter()
+            if args.guardrails:
+                verdict = await async_providers.check_guardrails(registry, prompt, "benchmark")
+                sample["guardrails"] = time.perf_counter() - start
+                if verdict["blocked"]:
+                    sample["status"] = "flagged"
+                    sample["e2e"] = time.perf_counter() - start
+                    return sample
+
+            stats = {}
+            chunk_count = 0
+            async for chunk in async_providers.stream_chat(
+                registry, "Local", [{"role": "user", "content": prompt}], MOCK_MODEL, 0.7,
+                args.max_tokens, stats, base_url=base_url, prompt_caching=False
+            ):
+                if is_error_chunk(chunk):
+                    sample["status"] = "error"
+                    break
+                if sample["ttft"] is None:
+                    sample["ttft"] = time.perf_counter() - start
+                chunk_count += 1
+            sample["e2e"] = time.perf_counter() - start
+            sample["output_tokens"] = stats.get("output_tokens") or chunk_count
+            return sample
+
+    try:
+        return await asyncio.gather(*(one(index) for index in range(args.requests)))
+    finally:
+        await registry.aclose()
+
+
+def app_session(base_url: str, index: int, args) -> tuple:
+    """One Streamlit session sending args.turns prompts; returns (AppTest, samples)"""
+    from streamlit.testing.v1 import AppTest
+
+    host, port = base_url.rsplit("//", 1)[1].split(":")
+    at = AppTest.from_file(str(APP_PATH), default_timeout=args.timeout)
+    at.session_state["provider"] = "Local"
+    at.session_state["local_host"] = host
+    at.session_state["local_port"] = int(port)
+    at.session_state["model"] = MOCK_MODEL
+    at.session_state["max_tokens"] = args.max_tokens
+    at.session_state["enable_guardrails"] = args.guardrails
+    at.session_state["calypso_api_key"] = "benchmark" if args.guardrails else ""
+    # A long earlier conversation shows how rerun cost grows with history
+    if args.history:
+        # Anonymous sessions keep their conversations in a store of their own, owned by "session"
+        store = ConversationStore(":memory:")
+        at.session_state["conversation_memory"] = store
+        conversation_id = store.create("session")
+        store.append(conversation_id, *[
+            {"role": "user" if number % 2 == 0 else "assistant", "content": f"Earlier message {number}. " * 20}
+            for number in range(args.history)
+        ])
+        at.session_state["conversation_id"] = conversation_id
+        at.session_state["messages"] = store.page(conversation_id, int(os.getenv("HISTORY_PAGE_SIZE", "50")))
+    at.run()
+
+    samples = []
+    for turn in range(args.turns):
+        if not at.chat_input:
+            problem = "; ".join(str(exception.value) for exception in at.exception) or "no chat input rendered"
+            raise RuntimeError(f"Session {index}: app.py did not render the chat input ({problem})")
+        start = time.perf_counter()
+        at.chat_input[0].set_value(prompt_for(index * args.turns + turn, args)).run()
+        sample = {"status": "ok", "e2e": time.perf_counter() - start, "ttft": None, "guardrails": None,
+                  "output_tokens": 0}
+        last = at.session_state["messages"][-1] if at.session_state["messages"] else None
+        if at.exception:
+            sample["status"] = "error"
+        elif last is None or last["role"] != "assistant":
+            # Blocked prompts stop before an answer is added
+            sample["status"] = "flagged"
+        else:
+            metrics = last.get("metrics") or {}
+            sample["ttft"] = metrics.get("ttft")
+            sample["output_tokens"] = metrics.get("output_tokens") or 0
+            if last["content"].startswith("❌"):
+                sample["status"] = "error"
+        # A rerun with no new input, as after any widget interaction
+        start = time.perf_counter()
+        at.run()
+        sample["rerun"] = time.perf_counter() - start
+        samples.append(sample)
+    return at, samples
+
+
+def start_session_process(base_url: str):
+    """Set up a session process: mock guardrails, and Streamlit imported before the clock starts"""
+    use_mock_guardrails(base_url)
+    import streamlit.testing.v1  # noqa: F401
+
+
+def timed_session(base_url: str, index: int, args) -> tuple:
+    """app_session's samples with its wall-clock start and end, for a session process"""
+    started = time.time()
+    samples = app_session(base_url, index, args)[1]
+    return started, time.time(), samples
+
+
+def bench_app(base_url: str, args) -> tuple:
+    """Concurrent app sessions, then memory retained per session; returns (samples, elapsed, bytes)"""
+    # Spawned, not forked: the parent is running the mock server's threads
+    with ProcessPoolExecutor(min(args.concurrency, args.sessions), multiprocessing.get_context("spawn"),
+                             initializer=start_session_process, initargs=(base_url,)) as pool:
+        sessions = list(pool.map(timed_session, repeat(base_url), range(args.sessions), repeat(args)))
+    samples = [sample for _, _, samples in sessions for sample in samples]
+    elapsed = max(end for _, end, _ in sessions) - min(start for start, _, _ in sessions)
+
+    # Measured separately because tracing allocations skews the timings above
+    memory_sessions = max(args.memory_sessions, 1)
+    # The sessions above ran in other processes, so import the app's modules here first
+    app_session(base_url, args.sessions + memory_sessions, args)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    kept = [app_session(base_url, args.sessions + index, args)[0] for index in range(memory_sessions)]
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del kept
+    return samples, elapsed, retained / memory_sessions
+
+
+def distribution(values: list) -> dict:
+    values = [value for value in values if value is not None]
+    if not values:
+        return {}
+    return {
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values)
+    }
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    completed = [sample for sample in samples if sample["status"] == "ok"]
+    return {
+        "requests": len(samples),
+        "ok": len(completed),
+        "flagged": sum(sample["status"] == "flagged" for sample in samples),
+        "errors": sum(sample["status"] == "error" for sample in samples),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+        "tokens_per_sec": sum(sample["output_tokens"] for sample in completed) / elapsed if elapsed else 0.0,
+        "ttft_s": distribution([sample["ttft"] for sample in completed]),
+        "e2e_s": distribution([sample["e2e"] for sample in samples]),
+        "guardrails_s": distribution([sample["guardrails"] for sample in samples]),
+        "rerun_s": distribution([sample.get("rerun") for sample in samples])
+    }
+
+
+def print_report(mode: str, report: dict):
+    print(f"\n☕ {mode} benchmark: {report['requests']:,} requests in {report['elapsed_s']:.1f}s")
+    print(f"   {report['ok']:,} ok · {report['flagged']:,} flagged · {report['errors']:,} errors")
+    print(f"   {report['throughput_rps']:.1f} requests/sec · {report['tokens_per_sec']:.0f} output tokens/sec")
+    print(f"   {'':<12}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for label, key in [("TTFT", "ttft_s"), ("End-to-end", "e2e_s"), ("Guardrails", "guardrails_s"),
+                       ("Rerun", "rerun_s")]:
+        values = report[key]
+        if values:
+            print(f"   {label:<12}" + "".join(f"{values[name] * 1000:>7.0f}ms" for name in ("p50", "p95", "p99", "max")))
+    if "memory_per_session_kb" in report:
+        print(f"   Memory retained per session: {report['memory_per_session_kb']:,.0f} KiB")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Benchmark the provider layer or the Streamlit app")
+    parser.add_argument("mode", choices=["providers", "app"])
+    parser.add_argument("--requests", type=int, default=200, help="providers mode: total requests")
+    parser.add_argument("--sessions", type=int, default=4, help="app mode: concurrent Streamlit sessions")
+    parser.add_argument("--turns", type=int, default=3, help="app mode: prompts per session")
+    parser.add_argument("--history", type=int, default=0, help="app mode: earlier messages per session")
+    parser.add_argument("--memory-sessions", type=int, default=3, help="app mode: sessions traced for memory")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--guardrails", action="store_true", help="scan every prompt first")
+    parser.add_argument("--flag-every", type=int, default=0, help="make every Nth prompt a flagged one")
+    parser.add_argument("--timeout", type=float, default=60, help="app mode: seconds allowed per script run")
+    parser.add_argument("--target", help="base URL of an already running mock_server.py")
+    parser.add_argument("--mock-port", type=int, default=8011)
+    parser.add_argument("--json", help="also write the report to this file")
+    mock_server.add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+
+    base_url = args.target.rstrip("/") if args.target else start_mock_server(args)
+    use_mock_guardrails(base_url)
+
+    started = time.perf_counter()
+    if args.mode == "providers":
+        samples = asyncio.run(bench_providers(base_url, args))
+        report = summarize(samples, time.perf_counter() - started)
+    else:
+        # Keep the app's settings, caches and conversations out of the real home directory
+        os.environ["HOME"] = tempfile.mkdtemp(prefix="coffee-bench-")
+        os.environ["CONVERSATIONS_FILE"] = os.path.join(os.environ["HOME"], "conversations.db")
+        samples, elapsed, memory_per_session = bench_app(base_url, args)
+        report = summarize(samples, elapsed)
+        report["memory_per_session_kb"] = memory_per_session / 1024
+    report["mode"] = args.mode
+    report["concurrency"] = args.concurrency
+
+    print_report(args.mode, report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
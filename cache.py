@@ -0,0 +1,164 @@
+"""In-memory LRU caches with TTL expiry and an optional SQLite tier"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalize a prompt so trivially different copies share a cache key"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def hash_key(*parts) -> str:
+    """Stable SHA-256 cache key over JSON-serializable parts"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def verdict_cache_key(prompt: str, guardrails_api_key: str, scan_model: str) -> str:
+    """Guardrails verdicts depend on the prompt, the policy behind the key and the model"""
+    return hash_key(normalize_prompt(prompt), hash_key(guardrails_api_key), scan_model)
+
+
+class SqliteStore:
+    """Persistent key/value tier so warm entries survive restarts"""
+
+    def __init__(self, path: str, table: str = "cache"):
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str):
+        """Return (value, expires_at) or None"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value, expires_at: float = None):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at)
+            )
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def prune(self, max_entries: int = None):
+        """Drop expired rows and, optionally, the oldest rows above max_entries"""
+        with self._lock:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at < ?",
+                (time.time(),)
+            )
+            if max_entries is not None:
+                self._conn.execute(
+                    f"DELETE FROM {self.table} WHERE rowid NOT IN "
+                    f"(SELECT rowid FROM {self.table} ORDER BY rowid DESC LIMIT ?)",
+                    (max_entries,)
+                )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.commit()
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry TTL and hit/miss counters
+
+    When a store is given, misses fall through to it and hits from the
+    store are promoted back into memory.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None, store: SqliteStore = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = store
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.store is not None:
+            self.store.prune(maxsize * 10)
+
+    def _expired(self, expires_at: float) -> bool:
+        return expires_at is not None and expires_at < time.time()
+
+    def get(self, key: str):
+        """Return the cached value or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if not self._expired(expires_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        if self.store is not None:
+            stored = self.store.get(key)
+            if stored is not None:
+                value, expires_at = stored
+                if not self._expired(expires_at):
+                    with self._lock:
+                        self.hits += 1
+                        self._insert(key, value, expires_at)
+                    return value
+                self.store.delete(key)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            self._insert(key, value, expires_at)
+        if self.store is not None:
+            self.store.set(key, value, expires_at)
+
+    def _insert(self, key: str, value, expires_at: float):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
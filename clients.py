@@ -0,0 +1,226 @@
+"""Process-wide registry of pooled provider clients"""
+import hashlib
+import os
+import threading
+
+import anthropic
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Connection pool limits (override with environment variables)
+POOL_MAX_CONNECTIONS = int(os.getenv("POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("POOL_KEEPALIVE_EXPIRY", "60"))
+
+
+class ConnectionStats:
+    """Thread-safe counters for requests sent and new connections opened"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "reused": max(self.requests - self.connections, 0)
+            }
+
+
+class _CountingAdapter(HTTPAdapter):
+    """requests adapter that counts requests and freshly opened connections"""
+
+    def __init__(self, stats: ConnectionStats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self._stats
+
+        class CountingHTTPPool(HTTPConnectionPool):
+            def _new_conn(self):
+                stats.record_connection()
+                return super()._new_conn()
+
+        class CountingHTTPSPool(HTTPSConnectionPool):
+            def _new_conn(self):
+                stats.record_connection()
+                return super()._new_conn()
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPPool,
+            "https": CountingHTTPSPool
+        }
+
+    def send(self, request, **kwargs):
+        self._stats.record_request()
+        return super().send(request, **kwargs)
+
+
+class ClientRegistry:
+    """Keep-alive clients keyed by (provider, api_key, base_url)
+
+    SDK clients are built with max_retries=0; retries and circuit
+    breaking happen in resilience.py so every provider behaves the same.
+    """
+
+    def __init__(self, max_connections: int = POOL_MAX_CONNECTIONS,
+                 max_keepalive: int = POOL_MAX_KEEPALIVE,
+                 keepalive_expiry: float = POOL_KEEPALIVE_EXPIRY):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._stats = {}
+
+    def _key(self, provider: str, api_key: str, base_url: str) -> tuple:
+        # Never keep raw API keys around as dictionary keys
+        key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+        return (provider, key_hash, base_url or "")
+
+    def _get_or_create(self, provider: str, api_key: str, base_url: str, factory):
+        key = self._key(provider, api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                stats = self._stats.setdefault(provider, ConnectionStats())
+                client = factory(stats)
+                self._clients[key] = client
+            return client
+
+    def _httpx_kwargs(self, stats: ConnectionStats) -> dict:
+        """Shared httpx pool settings with connection tracing hooks"""
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                stats.record_connection()
+
+        def on_request(request):
+            stats.record_request()
+            request.extensions["trace"] = trace
+
+        return {
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            "event_hooks": {"request": [on_request]}
+        }
+
+    def anthropic_client(self, api_key: str, base_url: str = None) -> anthropic.Anthropic:
+        """Get a pooled Anthropic client"""
+        def factory(stats):
+            return anthropic.Anthropic(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=0,
+                http_client=anthropic.DefaultHttpxClient(**self._httpx_kwargs(stats))
+            )
+        return self._get_or_create("Anthropic", api_key, base_url, factory)
+
+    def openai_client(self, api_key: str, base_url: str = None) -> openai.OpenAI:
+        """Get a pooled OpenAI client"""
+        def factory(stats):
+            return openai.OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=0,
+                http_client=openai.DefaultHttpxClient(**self._httpx_kwargs(stats))
+            )
+        return self._get_or_create("OpenAI", api_key, base_url, factory)
+
+    def http_session(self, provider: str, base_url: str) -> requests.Session:
+        """Get a keep-alive requests session for the Local server or guardrails"""
+        def factory(stats):
+            session = requests.Session()
+            adapter = _CountingAdapter(
+                stats,
+                pool_connections=self.max_keepalive,
+                pool_maxsize=self.max_connections
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            return session
+        return self._get_or_create(provider, None, base_url, factory)
+
+    def stats(self) -> dict:
+        """Connection reuse counters per provider"""
+        with self._lock:
+            return {provider: stats.snapshot() for provider, stats in self._stats.items()}
+
+
+class AsyncClientRegistry(ClientRegistry):
+    """Async counterparts of the pooled clients, bound to one event loop"""
+
+    def _httpx_kwargs(self, stats: ConnectionStats) -> dict:
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.complete":
+                stats.record_connection()
+
+        async def on_request(request):
+            stats.record_request()
+            request.extensions["trace"] = trace
+
+        return {
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry
+            ),
+            "event_hooks": {"request": [on_request]}
+        }
+
+    def anthropic_client(self, api_key: str, base_url: str = None) -> anthropic.AsyncAnthropic:
+        """Get a pooled async Anthropic client"""
+        def factory(stats):
+            return anthropic.AsyncAnthropic(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=0,
+                http_client=anthropic.DefaultAsyncHttpxClient(**self._httpx_kwargs(stats))
+            )
+        return self._get_or_create("Anthropic", api_key, base_url, factory)
+
+    def openai_client(self, api_key: str, base_url: str = None) -> openai.AsyncOpenAI:
+        """Get a pooled async OpenAI client"""
+        def factory(stats):
+            return openai.AsyncOpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(**self._httpx_kwargs(stats))
+            )
+        return self._get_or_create("OpenAI", api_key, base_url, factory)
+
+    def http_session(self, provider: str, base_url: str) -> httpx.AsyncClient:
+        """Get a keep-alive async HTTP client for the Local server or guardrails"""
+        def factory(stats):
+            return httpx.AsyncClient(**self._httpx_kwargs(stats))
+        return self._get_or_create(provider, None, base_url, factory)
+
+    async def aclose(self):
+        """Close every pooled connection"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            if isinstance(client, httpx.AsyncClient):
+                await client.aclose()
+            else:
+                await client.close()
@@ -0,0 +1,119 @@
+"""Token budgeting and sliding-window truncation for chat history"""
+import os
+
+try:
+    import tiktoken
+except ImportError:  # optional dependency
+    tiktoken = None
+
+# Context window sizes (tokens) for the models offered in the sidebar
+CONTEXT_WINDOWS = {
+    "claude-sonnet-4-5-20250929": 200000,
+    "claude-3-5-sonnet-20241022": 200000,
+    "claude-3-5-haiku-20241022": 200000,
+    "claude-3-opus-20240229": 200000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-3.5-turbo": 16385
+}
+
+# Local servers rarely report their window, so assume a conservative default
+LOCAL_CONTEXT_WINDOW = int(os.getenv("LOCAL_CONTEXT_WINDOW", "8192"))
+
+# Role markers and separators the chat templates add around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens with tiktoken when installed, else estimate ~4 chars/token"""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def message_tokens(message: dict) -> int:
+    """Token count for a message, cached on the message dict itself"""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        message["tokens"] = tokens
+    return tokens
+
+
+def context_window(model: str) -> int:
+    return CONTEXT_WINDOWS.get(model, LOCAL_CONTEXT_WINDOW)
+
+
+def context_budget(model: str, max_tokens: int, limit: int = 0) -> int:
+    """Prompt tokens available once the response allowance is reserved"""
+    budget = context_window(model) - max_tokens
+    if limit:
+        budget = min(budget, limit)
+    return max(budget, 0)
+
+
+def summarize_dropped(dropped: list, max_chars: int = 600) -> str:
+    """Cheap extractive note listing the questions that fell out of the window"""
+    questions = [msg["content"] for msg in dropped if msg["role"] == "user"]
+    lines = []
+    used = 0
+    for question in reversed(questions):
+        line = "- " + (question[:80] + "..." if len(question) > 80 else question)
+        if used + len(line) > max_chars:
+            break
+        lines.insert(0, line)
+        used += len(line)
+    return "Earlier in this conversation I asked (older turns were truncated):\n" + "\n".join(lines)
+
+
+def fit_to_budget(messages: list, budget: int, summarize: bool = False) -> tuple:
+    """Keep the newest messages that fit in the budget
+
+    Returns (messages_to_send, dropped_count, used_tokens). The latest
+    message is always kept, and the window always starts on a user turn
+    since Anthropic rejects conversations that open with the assistant.
+    With summarize=True a short note about the dropped questions is
+    prepended to the first kept user message.
+    """
+    used = 0
+    start = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        tokens = message_tokens(messages[index])
+        if used + tokens > budget and index < len(messages) - 1:
+            break
+        used += tokens
+        start = index
+
+    # Never open the window on an assistant turn
+    while start < len(messages) - 1 and messages[start]["role"] != "user":
+        used -= message_tokens(messages[start])
+        start += 1
+
+    kept = messages[start:]
+    dropped = messages[:start]
+    if not dropped:
+        return kept, 0, used
+
+    if summarize:
+        note = summarize_dropped(dropped)
+        note_tokens = count_tokens(note)
+        # Make room for the note by dropping more turns if needed
+        while used + note_tokens > budget and len(kept) > 1:
+            used -= message_tokens(kept[0])
+            dropped.append(kept[0])
+            kept = kept[1:]
+            while len(kept) > 1 and kept[0]["role"] != "user":
+                used -= message_tokens(kept[0])
+                dropped.append(kept[0])
+                kept = kept[1:]
+        first = kept[0]
+        kept = [{"role": first["role"], "content": f"{note}\n\n{first['content']}"}] + kept[1:]
+        used += note_tokens
+
+    return kept, len(dropped), used
@@ -0,0 +1,299 @@
+"""Conversations persisted in SQLite, read back a page or a token budget at a time
+
+Each conversation is a row in `conversations`; its messages are numbered
+by `seq` within it. Sessions keep only the messages on screen, while the
+model's context, the "Recent Orders" and the sidebar list of past
+conversations come from indexed queries, so memory no longer grows with
+conversation length and chats survive a restart. The database runs in
+WAL mode, so several app processes can share one file.
+
+Prompts and answers are indexed for full-text search with FTS5, ranked by
+BM25; SQLite builds without FTS5 fall back to a (slower) LIKE scan.
+"""
+import json
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+from context import message_tokens
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    user TEXT NOT NULL DEFAULT '',
+    title TEXT NOT NULL DEFAULT '',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_by_user ON conversations (user, updated_at DESC);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    metrics TEXT,
+    created_at REAL NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation_id, seq);
+-- Covers window()'s running token sum, so it never reads the messages themselves
+CREATE INDEX IF NOT EXISTS messages_tokens_by_seq ON messages (conversation_id, seq, tokens);
+CREATE INDEX IF NOT EXISTS messages_by_role ON messages (conversation_id, role, seq);
+"""
+
+# External-content index over messages.content, kept in step by triggers;
+# prefix indexes keep search-as-you-type on short prefixes fast
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3 4'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+TITLE_LENGTH = 60
+SNIPPET_CHARS = 80
+# Matches ranked per search, newest first
+SEARCH_CANDIDATES = 2000
+
+
+def _message(row) -> dict:
+    seq, role, content, tokens, metrics = row
+    message = {"role": role, "content": content, "seq": seq, "tokens": tokens}
+    if metrics:
+        message["metrics"] = json.loads(metrics)
+    return message
+
+
+def _match_query(query: str) -> str:
+    """FTS5 query matching every word, the last one as a prefix (search as you type)"""
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def _like_pattern(term: str) -> str:
+    """LIKE pattern for a substring, with its wildcards escaped by '!'"""
+    return "%" + term.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+
+
+def _snippet(content: str, terms: list) -> str:
+    """Text around the first word starting with a term, with those words in bold"""
+    text = " ".join(content.split())
+    words = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+    first = words.search(text)
+    start = max(first.start() - SNIPPET_CHARS // 3, 0) if first else 0
+    if start:
+        # Start on a word boundary
+        start = text.find(" ", start) + 1 or start
+    excerpt = words.sub(lambda match: f"**{match.group(0)}**", text[start:start + SNIPPET_CHARS])
+    return ("…" if start else "") + excerpt + ("…" if start + SNIPPET_CHARS < len(text) else "")
+
+
+class ConversationStore:
+    """Conversations and their messages in one SQLite database (":memory:" keeps them in RAM)"""
+
+    def __init__(self, path: str = ":memory:"):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(SCHEMA)
+            self.full_text = self._create_search_index()
+            self._conn.commit()
+
+    def _create_search_index(self) -> bool:
+        """Create the FTS5 index (backfilling existing messages); False if SQLite lacks FTS5"""
+        existed = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        ).fetchone()
+        try:
+            self._conn.executescript(SEARCH_SCHEMA)
+        except sqlite3.OperationalError:
+            return False
+        if not existed:
+            self._conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        return True
+
+    def create(self, user: str = "", title: str = "") -> str:
+        """Start an empty conversation and return its id"""
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO conversations (id, user, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, user, title[:TITLE_LENGTH], now, now)
+            )
+            self._conn.commit()
+        return conversation_id
+
+    def get(self, conversation_id: str) -> dict:
+        """id, user, title, created_at, updated_at and message_count, or None"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT id, user, title, created_at, updated_at, message_count FROM conversations WHERE id = ?",
+                (conversation_id,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def append(self, conversation_id: str, *messages: dict) -> list:
+        """Add messages in order, numbering them (message["seq"]); returns the new seqs"""
+        now = time.time()
+        seqs = []
+        with self._lock:
+            # Take the write lock before reading the count, so another process sharing
+            # the file cannot number its messages from the same count
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                count, title = self._conn.execute(
+                    "SELECT message_count, title FROM conversations WHERE id = ?", (conversation_id,)
+                ).fetchone()
+                for message in messages:
+                    self._conn.execute(
+                        "INSERT INTO messages (conversation_id, seq, role, content, tokens, metrics, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            conversation_id, count, message["role"], message["content"], message_tokens(message),
+                            json.dumps(message["metrics"], default=str) if message.get("metrics") else None, now
+                        )
+                    )
+                    seqs.append(count)
+                    count += 1
+                    if not title and message["role"] == "user":
+                        title = " ".join(message["content"].split())[:TITLE_LENGTH].strip()
+                self._conn.execute(
+                    "UPDATE conversations SET message_count = ?, title = ?, updated_at = ? WHERE id = ?",
+                    (count, title, now, conversation_id)
+                )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        # Number the callers' messages only once they are stored
+        for message, seq in zip(messages, seqs):
+            message["seq"] = seq
+        return seqs
+
+    def page(self, conversation_id: str, limit: int, before: int = None) -> list:
+        """Up to limit messages (oldest first) ending just before seq `before`, or at the latest"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, role, content, tokens, metrics FROM messages "
+                "WHERE conversation_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (conversation_id, before if before is not None else 2 ** 62, limit)
+            ).fetchall()
+        return [_message(row) for row in reversed(rows)]
+
+    def window(self, conversation_id: str, max_tokens: int) -> list:
+        """The newest messages (oldest first) whose tokens add up to at most max_tokens"""
+        with self._lock:
+            # Sums the token counts from the index alone, then reads only the messages that fit
+            start = self._conn.execute(
+                "SELECT MIN(seq) FROM ("
+                "SELECT seq, SUM(tokens) OVER (ORDER BY seq DESC) AS running "
+                "FROM messages WHERE conversation_id = ?"
+                ") WHERE running <= ?",
+                (conversation_id, max_tokens)
+            ).fetchone()[0]
+            if start is None:
+                return []
+            rows = self._conn.execute(
+                "SELECT seq, role, content, tokens, metrics FROM messages "
+                "WHERE conversation_id = ? AND seq >= ? ORDER BY seq",
+                (conversation_id, start)
+            ).fetchall()
+        return [_message(row) for row in rows]
+
+    def recent_prompts(self, conversation_id: str, limit: int = 5) -> list:
+        """The latest user prompts in the conversation, newest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content FROM messages WHERE conversation_id = ? AND role = 'user' "
+                "ORDER BY seq DESC LIMIT ?",
+                (conversation_id, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def conversations(self, user: str, limit: int = 10) -> list:
+        """The user's most recently updated conversations that have messages (none without a user)"""
+        if not user:
+            return []
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT id, title, updated_at, message_count FROM conversations "
+                "WHERE user = ? AND message_count > 0 ORDER BY updated_at DESC LIMIT ?",
+                (user, limit)
+            )
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def search(self, query: str, user: str, limit: int = 10) -> list:
+        """The user's messages matching every word of query, best first (none without a user)
+
+        Returns dicts with conversation_id, title, seq, role, updated_at and
+        a snippet with the matches in **bold**. Only the newest
+        SEARCH_CANDIDATES matches are ranked, so very common words stay fast.
+        """
+        if not user or not query.split():
+            return []
+        if not self.full_text:
+            return self._search_like(query, user, limit)
+        match = _match_query(query)
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT id, conversation_id, title, seq, role, updated_at FROM ("
+                "SELECT messages_fts.rowid AS id, m.conversation_id, c.title, m.seq, m.role, c.updated_at, "
+                "bm25(messages_fts) AS score FROM messages_fts "
+                "JOIN messages m ON m.id = messages_fts.rowid JOIN conversations c ON c.id = m.conversation_id "
+                "WHERE messages_fts MATCH ? AND c.user = ? ORDER BY messages_fts.rowid DESC LIMIT ?"
+                ") ORDER BY score LIMIT ?",
+                (match, user, SEARCH_CANDIDATES, limit)
+            )
+            columns = [column[0] for column in cursor.description]
+            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            # FTS5's snippet() would re-run prefix queries per row, so build them from the shown rows only
+            contents = dict(self._conn.execute(
+                f"SELECT id, content FROM messages WHERE id IN ({', '.join('?' * len(results))})",
+                [result["id"] for result in results]
+            ).fetchall()) if results else {}
+        terms = query.split()
+        for result in results:
+            result["snippet"] = _snippet(contents.get(result.pop("id"), ""), terms)
+        return results
+
+    def _search_like(self, query: str, user: str, limit: int) -> list:
+        """search() for SQLite builds without FTS5: newest matches first, scanning every message"""
+        terms = [term.lower() for term in query.split()]
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT m.conversation_id, c.title, m.seq, m.role, c.updated_at, m.content AS snippet "
+                "FROM messages m JOIN conversations c ON c.id = m.conversation_id "
+                "WHERE c.user = ? AND " + " AND ".join(["m.content LIKE ? ESCAPE '!'"] * len(terms))
+                + " ORDER BY c.updated_at DESC, m.seq DESC LIMIT ?",
+                (user, *[_like_pattern(term) for term in terms], limit)
+            )
+            columns = [column[0] for column in cursor.description]
+            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        for result in results:
+            result["snippet"] = _snippet(result["snippet"], terms)
+        return results
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            self._conn.commit()
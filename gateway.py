@@ -0,0 +1,414 @@
+"""Headless OpenAI-compatible gateway over the app's provider and guardrails layer
+
+Run it next to (or instead of) the Streamlit app:
+
+    python gateway.py
+
+It serves /v1/chat/completions (streaming and non-streaming), /v1/models,
+/health and Prometheus /metrics. With OTEL_TRACES_EXPORTER set, each
+request is traced, continuing the caller's W3C traceparent if it sent one. Provider keys, the Local server, guardrails and prompt
+caching come from the settings the Streamlit app saves; keys for other
+providers come from <PROVIDER>_API_KEY environment variables; behind an
+authenticating proxy (TRUST_FORWARDED_USER=1), X-Forwarded-User picks that
+user's saved settings. Callers must present GATEWAY_API_KEY as a bearer
+token; without one set, the gateway only listens on localhost.
+Like the chat app, only user and assistant turns are forwarded.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import async_providers
+import metrics
+import tracing
+from async_providers import ANTHROPIC_MODELS, OPENAI_MODELS
+from cache import SqliteStore, TTLCache
+from clients import AsyncClientRegistry
+from context import message_tokens
+from local_pool import STRATEGIES, EndpointPool, parse_endpoints
+from prefilter import default_prefilter
+from ratelimit import AdmissionControl, AdmissionTimeout
+from routing import is_error_chunk
+from settings_store import SETTINGS_FILE, SettingsStore, forwarded_user
+
+# Bearer token callers must present; without one the gateway may only listen on localhost
+GATEWAY_API_KEY = os.getenv("GATEWAY_API_KEY", "")
+GATEWAY_HOST = os.getenv("GATEWAY_HOST", "0.0.0.0" if GATEWAY_API_KEY else "127.0.0.1")
+GATEWAY_PORT = int(os.getenv("GATEWAY_PORT", "8000"))
+LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+GUARDRAILS_CACHE_SIZE = int(os.getenv("GUARDRAILS_CACHE_SIZE", "1024"))
+GUARDRAILS_CACHE_TTL = float(os.getenv("GUARDRAILS_CACHE_TTL", "3600"))
+GUARDRAILS_CACHE_FILE = os.getenv("GUARDRAILS_CACHE_FILE", "")
+LOCAL_HEALTH_INTERVAL = float(os.getenv("LOCAL_HEALTH_INTERVAL", "10"))
+LOCAL_FAILURE_THRESHOLD = int(os.getenv("LOCAL_FAILURE_THRESHOLD", "3"))
+
+
+def error_response(status: int, message: str, error_type: str, code: str = None, **extra) -> JSONResponse:
+    """OpenAI-style error body"""
+    return JSONResponse(
+        {"error": {"message": message, "type": error_type, "code": code, **extra}},
+        status_code=status
+    )
+
+
+def message_text(content):
+    """Message content as text: a string, or the joined parts of a text-only content list; None otherwise"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and all(
+            isinstance(part, dict) and part.get("type") == "text" and isinstance(part.get("text"), str)
+            for part in content):
+        return "".join(part["text"] for part in content)
+    return None
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def provider_for_model(model: str) -> str:
+    if model in ANTHROPIC_MODELS or model.startswith("claude"):
+        return "Anthropic"
+    if model in OPENAI_MODELS or model.startswith(("gpt-", "o1", "o3", "o4")):
+        return "OpenAI"
+    return "Local"
+
+
+class Gateway:
+    """Shared clients, caches and limits for every gateway request"""
+
+    def __init__(self, settings_file: Path = SETTINGS_FILE):
+        self.settings_store = SettingsStore(settings_file)
+        self.registry = AsyncClientRegistry()
+        store = SqliteStore(GUARDRAILS_CACHE_FILE, table="verdicts") if GUARDRAILS_CACHE_FILE else None
+        self.verdict_cache = TTLCache(maxsize=GUARDRAILS_CACHE_SIZE, ttl=GUARDRAILS_CACHE_TTL, store=store)
+        self.prefilter = default_prefilter()
+        self.admission = AdmissionControl()
+        self._pools = {}
+
+    def settings(self, user: str = "") -> dict:
+        """Settings the app saved for user (or the shared ones), re-read only when the file changes"""
+        try:
+            return self.settings_store.load(user)
+        except (OSError, ValueError):
+            return {}
+
+    def api_key(self, provider: str, settings: dict) -> str:
+        """The app's saved key for its selected provider, else the environment"""
+        if provider == settings.get("provider") and settings.get("api_key"):
+            return settings["api_key"]
+        return os.getenv(f"{provider.upper()}_API_KEY", "")
+
+    def local_pool(self, settings: dict) -> EndpointPool:
+        urls = tuple(parse_endpoints(
+            f"{settings.get('local_host', '127.0.0.1')}:{settings.get('local_port', 1337)}\n"
+            f"{settings.get('local_endpoints', '')}"
+        ))
+        strategy = settings.get("lb_strategy", STRATEGIES[0])
+        pool = self._pools.get((urls, strategy))
+        if pool is None:
+            pool = self._pools[(urls, strategy)] = EndpointPool(
+                list(urls),
+                strategy,
+                failure_threshold=LOCAL_FAILURE_THRESHOLD,
+                health_interval=LOCAL_HEALTH_INTERVAL if len(urls) > 1 else 0
+            )
+        return pool
+
+
+def create_app(gateway: Gateway = None) -> Starlette:
+    gateway = gateway or Gateway()
+    tracing.setup()
+
+    def authorized(request: Request) -> bool:
+        return not GATEWAY_API_KEY or request.headers.get("authorization") == f"Bearer {GATEWAY_API_KEY}"
+
+    async def health(request: Request):
+        return JSONResponse({"status": "ok"})
+
+    def unauthorized() -> JSONResponse:
+        return error_response(401, "Invalid gateway API key.", "authentication_error", "invalid_api_key")
+
+    async def prometheus(request: Request):
+        if not authorized(request):
+            return unauthorized()
+        return Response(metrics.REGISTRY.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    async def models(request: Request):
+        if not authorized(request):
+            return unauthorized()
+        settings = gateway.settings(forwarded_user(request.headers))
+        names = list(ANTHROPIC_MODELS) + list(OPENAI_MODELS)
+        if settings.get("provider") == "Local" and settings.get("model"):
+            names.append(settings["model"])
+        return JSONResponse({
+            "object": "list",
+            "data": [{"id": name, "object": "model", "owned_by": provider_for_model(name)} for name in names]
+        })
+
+    async def chat_completions(request: Request):
+        if not authorized(request):
+            return unauthorized()
+        try:
+            body = await request.json()
+        except ValueError:
+            return error_response(400, "Request body must be JSON.", "invalid_request_error")
+
+        if not isinstance(body, dict):
+            return error_response(400, "Request body must be a JSON object.", "invalid_request_error")
+        messages = body.get("messages") or []
+        if not isinstance(messages, list) or not messages or not all(
+                isinstance(msg, dict) and msg.get("role") in ("system", "user", "assistant") and "content" in msg
+                for msg in messages):
+            return error_response(400, "messages must be a non-empty list of {role, content} with role "
+                                  "system, user or assistant.", "invalid_request_error")
+        texts = [message_text(msg["content"]) for msg in messages]
+        if None in texts:
+            return error_response(400, "Message content must be a string or a list of text parts.",
+                                  "invalid_request_error")
+        # System prompts are not forwarded, matching the chat app
+        messages = [{"role": msg["role"], "content": text} for msg, text in zip(messages, texts)
+                    if msg["role"] != "system"]
+        if not messages:
+            return error_response(400, "messages must include a user or assistant message.", "invalid_request_error")
+
+        model = body.get("model")
+        if model is not None and not isinstance(model, str):
+            return error_response(400, "model must be a string.", "invalid_request_error")
+        temperature = body.get("temperature")
+        if temperature is not None and not is_number(temperature):
+            return error_response(400, "temperature must be a number.", "invalid_request_error")
+        max_tokens = body.get("max_tokens", body.get("max_completion_tokens"))
+        if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool)
+                                       or max_tokens < 1):
+            return error_response(400, "max_tokens must be a positive integer.", "invalid_request_error")
+
+        request_start = time.perf_counter()
+        settings = gateway.settings(forwarded_user(request.headers))
+        model = model or settings.get("model", "")
+        provider = provider_for_model(model)
+        api_key = gateway.api_key(provider, settings)
+        if provider != "Local" and not api_key:
+            return error_response(400, f"No API key configured for {provider}.", "invalid_request_error")
+        temperature = settings.get("temperature", 0.7) if temperature is None else temperature
+        max_tokens = max_tokens or settings.get("max_tokens", 1024)
+        stream = bool(body.get("stream"))
+        stream_options = body.get("stream_options") or {}
+        if not isinstance(stream_options, dict):
+            return error_response(400, "stream_options must be an object.", "invalid_request_error")
+        include_usage = bool(stream_options.get("include_usage"))
+        turn_span = tracing.start_span(
+            "chat turn",
+            carrier=request.headers,
+            **{
+                "gen_ai.system": provider,
+                "gen_ai.request.model": model,
+                "gen_ai.request.temperature": temperature,
+                "gen_ai.request.max_tokens": max_tokens
+            }
+        )
+
+        headers = {}
+        if settings.get("enable_guardrails") and settings.get("calypso_api_key"):
+            prompt = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), "")
+            with tracing.use_span(turn_span), tracing.span("guardrails scan") as scan_span:
+                verdict = await async_providers.check_guardrails(
+                    gateway.registry,
+                    prompt,
+                    settings["calypso_api_key"],
+                    verdict_cache=gateway.verdict_cache,
+                    prefilter=gateway.prefilter
+                )
+                verdict_label = metrics.observe_guardrails(time.perf_counter() - request_start, verdict)
+                tracing.set_attributes(scan_span, **{"guardrails.verdict": verdict_label})
+            if verdict.get("error"):
+                tracing.end_span(turn_span, error=verdict["error"])
+                return error_response(503, verdict["error"], "guardrails_error")
+            if verdict["blocked"]:
+                tracing.end_span(turn_span, **{"guardrails.verdict": verdict_label})
+                return error_response(
+                    400,
+                    f"Sorry mate, that particular brand of coffee is forbidden. {verdict['reason']}",
+                    "guardrails_violation",
+                    "content_blocked",
+                    categories=verdict.get("categories", [])
+                )
+            headers["X-Guardrails"] = "cached" if verdict.get("cached") else "cleared"
+            if verdict.get("prefilter"):
+                headers["X-Guardrails"] = "local"
+            if verdict.get("warning"):
+                headers["X-Guardrails"] = "skipped"
+                headers["X-Guardrails-Warning"] = verdict["warning"].encode("ascii", "ignore").decode().strip()
+
+        # Same per-key limits as the app; callers are queued fairly by user or address
+        limiter = gateway.admission.limiter(provider, api_key)
+        caller = forwarded_user(request.headers) or (request.client.host if request.client else "")
+        try:
+            with tracing.use_span(turn_span), tracing.span("queue wait", **{"gen_ai.system": provider}):
+                ticket = await asyncio.to_thread(
+                    limiter.acquire, caller, sum(message_tokens(msg) for msg in messages) + max_tokens
+                )
+        except AdmissionTimeout as e:
+            metrics.observe_turn(provider, model, {}, f"❌ Error: {str(e)}")
+            tracing.end_span(turn_span, error=str(e))
+            return error_response(429, str(e), "rate_limit_error", "queue_timeout")
+
+        stats = {"queue_wait": ticket.wait}
+        start = time.perf_counter() - ticket.wait
+
+        def release(error: str = None):
+            end = time.perf_counter()
+            stats["total_time"] = end - start
+            stats["turn_time"] = end - request_start
+            metrics.observe_turn(provider, model, stats, error or stats.get("error"))
+            tracing.end_span(
+                turn_span,
+                error=error or stats.get("error"),
+                **{
+                    "gen_ai.usage.input_tokens": stats.get("input_tokens"),
+                    "gen_ai.usage.output_tokens": stats.get("output_tokens")
+                }
+            )
+            used_tokens = (stats.get("input_tokens") or 0) + (stats.get("output_tokens") or 0)
+            limiter.release(ticket, used_tokens or None)
+
+        chunks = tracing.atraced(
+            async_providers.stream_chat(
+                gateway.registry,
+                provider,
+                messages,
+                model,
+                temperature,
+                max_tokens,
+                stats,
+                api_key=api_key,
+                prompt_caching=settings.get("prompt_caching", True),
+                endpoint_pool=gateway.local_pool(settings) if provider == "Local" else None
+            ),
+            "provider request",
+            is_error=is_error_chunk,
+            **{"gen_ai.system": provider, "gen_ai.request.model": model}
+        )
+
+        # Wait for the first chunk so upstream failures get a proper status code
+        try:
+            with tracing.use_span(turn_span):
+                first = await anext(chunks, None)
+        except BaseException:
+            await chunks.aclose()
+            release()
+            raise
+        if first is None or is_error_chunk(first):
+            await chunks.aclose()
+            error = first or "❌ Error: Empty response from provider."
+            release(error)
+            return error_response(502, error, "upstream_error")
+        stats["ttft"] = time.perf_counter() - start
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        def usage() -> dict:
+            result = {
+                "prompt_tokens": stats.get("input_tokens", 0),
+                "completion_tokens": stats.get("output_tokens", 0),
+                "total_tokens": stats.get("input_tokens", 0) + stats.get("output_tokens", 0)
+            }
+            if stats.get("cached_input_tokens") is not None:
+                result["prompt_tokens_details"] = {"cached_tokens": stats["cached_input_tokens"]}
+            return result
+
+        if not stream:
+            error = None
+            try:
+                parts = [first]
+                async for chunk in chunks:
+                    if is_error_chunk(chunk):
+                        error = chunk
+                        return error_response(502, chunk, "upstream_error")
+                    parts.append(chunk)
+            finally:
+                await chunks.aclose()
+                release(error)
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(parts)},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage()
+            }, headers=headers)
+
+        def frame(choices: list, **extra) -> str:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                **extra
+            }
+            return f"data: {json.dumps(payload)}\n\n"
+
+        async def events():
+            try:
+                yield frame([{"index": 0, "delta": {"role": "assistant", "content": first}, "finish_reason": None}])
+                async for chunk in chunks:
+                    if is_error_chunk(chunk):
+                        stats["error"] = chunk
+                        yield f"data: {json.dumps({'error': {'message': chunk, 'type': 'upstream_error'}})}\n\n"
+                        return
+                    yield frame([{"index": 0, "delta": {"content": chunk}, "finish_reason": None}])
+                yield frame([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if include_usage:
+                    yield frame([], usage=usage())
+                yield "data: [DONE]\n\n"
+            finally:
+                # A client disconnect cancels this generator and closes the upstream stream
+                await chunks.aclose()
+
+        return StreamingResponse(
+            events(),
+            media_type="text/event-stream",
+            headers={**headers, "Cache-Control": "no-cache"},
+            background=BackgroundTask(release)
+        )
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await gateway.registry.aclose()
+
+    return Starlette(
+        routes=[
+            Route("/health", health),
+            Route("/metrics", prometheus),
+            Route("/v1/models", models),
+            Route("/v1/chat/completions", chat_completions, methods=["POST"])
+        ],
+        lifespan=lifespan
+    )
+
+
+if __name__ == "__main__":
+    if not GATEWAY_API_KEY and GATEWAY_HOST not in LOOPBACK_HOSTS:
+        # Anyone who can reach the port could spend the saved provider keys
+        sys.exit(f"❌ Error: set GATEWAY_API_KEY before listening on {GATEWAY_HOST}, or use GATEWAY_HOST=127.0.0.1.")
+    uvicorn.run(create_app(), host=GATEWAY_HOST, port=GATEWAY_PORT)
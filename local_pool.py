@@ -0,0 +1,145 @@
+"""Load balancing and health checking across Local server replicas"""
+import random
+import threading
+import time
+import weakref
+
+import requests
+
+LEAST_OUTSTANDING = "Least outstanding requests"
+POWER_OF_TWO = "Power of two choices"
+STRATEGIES = [LEAST_OUTSTANDING, POWER_OF_TWO]
+
+# Paths probed by the health checker, in order (llama.cpp/vLLM/TGI, then OpenAI-style)
+HEALTH_PATHS = ["/health", "/v1/models"]
+
+
+def parse_endpoints(text: str) -> list:
+    """Turn 'host:port' entries (comma or newline separated) into base URLs"""
+    urls = []
+    for entry in text.replace(",", "\n").splitlines():
+        entry = entry.strip().rstrip("/")
+        if not entry:
+            continue
+        if not entry.startswith(("http://", "https://")):
+            entry = f"http://{entry}"
+        if entry not in urls:
+            urls.append(entry)
+    return urls
+
+
+class Endpoint:
+    """One Local server replica and its live load/health state"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected = False
+        self.requests = 0
+        self.failures = 0
+
+
+class EndpointPool:
+    """Balance requests across replicas and eject the ones that keep failing
+
+    Endpoints are ejected after failure_threshold consecutive failures
+    (request errors or failed health checks). A background health checker
+    probes every endpoint and adds ejected ones back once they answer again.
+    """
+
+    def __init__(self, urls: list, strategy: str = LEAST_OUTSTANDING, failure_threshold: int = 3,
+                 health_interval: float = 10.0, health_timeout: float = 2.0):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._next = 0
+
+        if health_interval:
+            self._start_health_checks()
+
+    def acquire(self) -> Endpoint:
+        """Pick an endpoint and count the request against it"""
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if not endpoint.ejected]
+            if not candidates:
+                # Everything is ejected: try the least-failing replica rather than nothing
+                candidates = [min(self.endpoints, key=lambda endpoint: endpoint.consecutive_failures)]
+
+            if self.strategy == POWER_OF_TWO and len(candidates) > 1:
+                first, second = random.sample(candidates, 2)
+                endpoint = first if first.outstanding <= second.outstanding else second
+            else:
+                # Rotate the starting point so ties spread across replicas
+                self._next = (self._next + 1) % len(candidates)
+                rotated = candidates[self._next:] + candidates[:self._next]
+                endpoint = min(rotated, key=lambda candidate: candidate.outstanding)
+
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, failed: bool = False):
+        """Finish a request, recording whether the replica failed it"""
+        with self._lock:
+            endpoint.outstanding = max(endpoint.outstanding - 1, 0)
+            if failed:
+                self._record_failure(endpoint)
+            else:
+                endpoint.consecutive_failures = 0
+
+    def _record_failure(self, endpoint: Endpoint):
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.failure_threshold:
+            endpoint.ejected = True
+
+    def check_health(self):
+        """Probe every endpoint once"""
+        for endpoint in list(self.endpoints):
+            healthy = False
+            for path in HEALTH_PATHS:
+                try:
+                    response = self._session.get(f"{endpoint.url}{path}", timeout=self.health_timeout)
+                    if response.status_code == 200:
+                        healthy = True
+                        break
+                except requests.exceptions.RequestException:
+                    break
+
+            with self._lock:
+                if healthy:
+                    endpoint.consecutive_failures = 0
+                    endpoint.ejected = False
+                else:
+                    self._record_failure(endpoint)
+
+    def _start_health_checks(self):
+        # The thread only holds a weak reference so dropping the pool stops it
+        pool_ref = weakref.ref(self)
+        interval = self.health_interval
+
+        def run():
+            while True:
+                pool = pool_ref()
+                if pool is None:
+                    return
+                pool.check_health()
+                del pool
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="local-health-check", daemon=True).start()
+
+    def stats(self) -> list:
+        with self._lock:
+            return [{
+                "url": endpoint.url,
+                "healthy": not endpoint.ejected,
+                "outstanding": endpoint.outstanding,
+                "requests": endpoint.requests,
+                "failures": endpoint.failures
+            } for endpoint in self.endpoints]
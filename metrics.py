@@ -0,0 +1,237 @@
+"""Per-turn stage timings, token counts and errors in Prometheus text format
+
+Stages of a turn are observed into histograms (guardrails scan, queue
+wait, time to first token, generation, whole turn), token usage reported
+by the providers into counters, and failures into counters by type.
+Whole Streamlit script runs are timed too, to keep an eye on rerun cost.
+The app serves them on METRICS_PORT; the gateway on its own /metrics.
+"""
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from routing import is_error_chunk
+
+# Port for the app's Prometheus endpoint (0 disables it); the endpoint has no auth, so it
+# listens on loopback unless METRICS_HOST opens it up (e.g. 0.0.0.0 in a container)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_STATUS = re.compile(r"(?:returned|error code:|api error:|status)\s*(\d{3})\b")
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic total per label set"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(tuple(str(labels.get(name, "")) for name in self.labels), 0.0)
+
+    def lines(self) -> list:
+        with self._lock:
+            return [f"{self.name}{_label_text(self.labels, key)} {value:g}" for key, value in self._values.items()]
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def lines(self) -> list:
+        lines = []
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    le = 'le="%g"' % bound
+                    lines.append(f"{self.name}_bucket{_label_text(self.labels, key, le)} {count}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, le)} {series['count']}")
+                lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {series['sum']:g}")
+                lines.append(f"{self.name}_count{_label_text(self.labels, key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """A set of metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "coffee_stage_seconds", "Time spent in each stage of a chat turn", ("stage", "provider")
+)
+TOKENS = REGISTRY.counter(
+    "coffee_tokens_total", "Tokens reported by provider usage fields", ("provider", "model", "kind")
+)
+TURNS = REGISTRY.counter("coffee_turns_total", "Chat turns by outcome", ("provider", "outcome"))
+ERRORS = REGISTRY.counter("coffee_errors_total", "Failed provider calls and guardrails scans", ("stage", "provider", "type"))
+GUARDRAILS_VERDICTS = REGISTRY.counter(
+    "coffee_guardrails_verdicts_total", "Guardrails verdicts (local_* were settled by the prefilter)", ("verdict",)
+)
+SCRIPT_RUNS = REGISTRY.histogram(
+    "coffee_script_run_seconds", "Full Streamlit script runs, with a new turn or without", ("kind",)
+)
+
+
+def error_type(message: str) -> str:
+    """Short, low-cardinality label for an error chunk or fail-open reason"""
+    text = message.lower()
+    if "is failing; skipping" in text or "circuit open" in text:
+        return "circuit_open"
+    if "request queue" in text:
+        return "queue_timeout"
+    if "timeout" in text or "timed out" in text:
+        return "timeout"
+    if "connection" in text or "connect" in text:
+        return "connection"
+    match = _STATUS.search(text)
+    if match:
+        return f"http_{match.group(1)}"
+    return "other"
+
+
+def guardrails_verdict(result: dict) -> str:
+    if result.get("error"):
+        return "error"
+    if result.get("prefilter"):
+        return "local_flagged" if result["blocked"] else "local_cleared"
+    if result["blocked"]:
+        return "flagged"
+    if result.get("warning"):
+        return "unscanned"
+    return "cached" if result.get("cached") else "cleared"
+
+
+def observe_guardrails(seconds: float, result: dict) -> str:
+    """Record one scan and return its verdict label"""
+    verdict = guardrails_verdict(result)
+    GUARDRAILS_VERDICTS.inc(verdict=verdict)
+    # Only remote scans are timed; cached and local verdicts would drag the percentiles down
+    if verdict not in ("cached", "local_flagged", "local_cleared"):
+        STAGE_SECONDS.observe(seconds, stage="guardrails", provider="Guardrails")
+    if verdict in ("error", "unscanned"):
+        ERRORS.inc(stage="guardrails", provider="Guardrails", type=error_type(result.get("reason", "")))
+    return verdict
+
+
+def observe_turn(provider: str, model: str, stats: dict, response: str = ""):
+    """Record the stage timings, token usage and outcome of one answered turn"""
+    if stats.get("backend"):
+        # The backend that actually answered, after any failover
+        provider, model = stats["backend"].split(" · ", 1)
+
+    if stats.get("cache_hit"):
+        TURNS.inc(provider=provider, outcome=f"{stats['cache_hit']}_cache")
+        return
+    if response and is_error_chunk(response):
+        TURNS.inc(provider=provider, outcome="error")
+        ERRORS.inc(stage="provider", provider=provider, type=error_type(response))
+        return
+
+    TURNS.inc(provider=provider, outcome="ok")
+    queue_wait = stats.get("queue_wait", 0.0)
+    if "queue_wait" in stats:
+        STAGE_SECONDS.observe(queue_wait, stage="queue", provider=provider)
+    if stats.get("ttft") is not None:
+        # TTFT is timed from the start of the request, queue wait included
+        STAGE_SECONDS.observe(max(stats["ttft"] - queue_wait, 0.0), stage="first_token", provider=provider)
+        if stats.get("total_time") is not None:
+            STAGE_SECONDS.observe(stats["total_time"] - stats["ttft"], stage="generation", provider=provider)
+    if stats.get("turn_time") is not None:
+        STAGE_SECONDS.observe(stats["turn_time"], stage="turn", provider=provider)
+
+    for kind in ("input", "output", "cached_input"):
+        if stats.get(f"{kind}_tokens"):
+            TOKENS.inc(stats[f"{kind}_tokens"], provider=provider, model=model, kind=kind)
+
+
+def start_exporter(port: int = METRICS_PORT, host: str = METRICS_HOST) -> ThreadingHTTPServer:
+    """Serve REGISTRY at http://host:port/metrics on a daemon thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    return server
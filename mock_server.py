@@ -0,0 +1,389 @@
+"""Local stub of the provider and guardrails APIs for offline testing
+
+    python mock_server.py --port 8010 --ttft-ms 300 --tokens-per-sec 60 --error-rate 0.02
+
+Serves an OpenAI-compatible /v1/chat/completions (streaming or not) and
+a Calypso-style /backend/v1/scans, both with log-normal latency,
+configurable token rate and injected errors, plus in-memory Anthropic
+Message Batches and OpenAI Files/Batch endpoints. Batches finish
+batch_delay seconds after they are created. Prompts containing "[fail]"
+get errors and prompts containing "[flag]" are flagged by the scanner.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+FAIL_MARKER = "[fail]"
+FLAG_MARKER = "[flag]"
+
+# Words the mock model streams back, one token each
+MOCK_WORDS = ["Freshly", " brewed", " tokens", " from", " the", " mock", " barista", "."]
+
+
+class MockProfile:
+    """Latency distributions, token rate and error injection for the mock endpoints
+
+    Latencies are log-normal around the given median; sigma 0 makes them fixed.
+    """
+
+    def __init__(self, ttft_ms: float = 200, ttft_sigma: float = 0.5, tokens_per_sec: float = 50,
+                 output_tokens: int = 64, error_rate: float = 0.0, error_status: int = 503,
+                 scan_ms: float = 150, scan_sigma: float = 0.3, scan_error_rate: float = 0.0,
+                 flag_rate: float = 0.0, seed: int = None):
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.scan_ms = scan_ms
+        self.scan_sigma = scan_sigma
+        self.scan_error_rate = scan_error_rate
+        self.flag_rate = flag_rate
+        self.random = random.Random(seed)
+
+    def sample(self, median_ms: float, sigma: float) -> float:
+        """Seconds drawn from a log-normal distribution with the given median"""
+        return median_ms / 1000 * math.exp(self.random.gauss(0, sigma)) if sigma else median_ms / 1000
+
+    def fails(self, rate: float, prompt: str = "") -> bool:
+        return FAIL_MARKER in prompt or self.random.random() < rate
+
+
+def stub_reply(messages: list) -> str:
+    prompt = messages[-1]["content"] if messages else ""
+    if isinstance(prompt, list):
+        prompt = " ".join(block.get("text", "") for block in prompt if isinstance(block, dict))
+    return f"Stub reply to: {prompt}"
+
+
+def stub_usage(messages: list, reply: str) -> tuple:
+    """Rough (input, output) token counts"""
+    prompt_chars = sum(len(str(msg.get("content", ""))) for msg in messages)
+    return prompt_chars // 4 + 1, len(reply) // 4 + 1
+
+
+class StubState:
+    """In-memory files and batches shared by the stub routes"""
+
+    def __init__(self, batch_delay: float = 2.0):
+        self.batch_delay = batch_delay
+        self.files = {}
+        self.anthropic_batches = {}
+        self.openai_batches = {}
+
+    def ready(self, batch: dict) -> bool:
+        return time.time() - batch["submitted"] >= self.batch_delay
+
+
+def create_app(batch_delay: float = 2.0, profile: MockProfile = None) -> Starlette:
+    state = StubState(batch_delay)
+    profile = profile or MockProfile()
+
+    async def health(request: Request):
+        return JSONResponse({"status": "ok"})
+
+    async def models(request: Request):
+        return JSONResponse({"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "mock"}]})
+
+    # OpenAI-compatible chat completions
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages") or []
+        prompt = str(messages[-1].get("content", "")) if messages else ""
+        model = body.get("model", "mock-model")
+        output_tokens = min(profile.output_tokens, body.get("max_tokens") or profile.output_tokens)
+        input_tokens, _ = stub_usage(messages, "")
+        words = [MOCK_WORDS[index % len(MOCK_WORDS)] for index in range(output_tokens)]
+        usage = {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                 "total_tokens": input_tokens + output_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        await asyncio.sleep(profile.sample(profile.ttft_ms, profile.ttft_sigma))
+        if profile.fails(profile.error_rate, prompt):
+            return JSONResponse({"error": {"message": "Injected mock failure", "type": "server_error"}},
+                                status_code=profile.error_status)
+
+        if not body.get("stream"):
+            await asyncio.sleep(output_tokens / profile.tokens_per_sec)
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                             "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        def frame(choices: list, **extra) -> str:
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                       "model": model, "choices": choices, **extra}
+            return f"data: {json.dumps(payload)}\n\n"
+
+        async def events():
+            for index, word in enumerate(words):
+                if index:
+                    await asyncio.sleep(1 / profile.tokens_per_sec)
+                yield frame([{"index": 0, "delta": {"content": word}, "finish_reason": None}])
+            yield frame([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield frame([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    # Calypso-style guardrails scans
+
+    async def scans(request: Request):
+        body = await request.json()
+        prompt = body.get("input", "")
+        await asyncio.sleep(profile.sample(profile.scan_ms, profile.scan_sigma))
+        if profile.fails(profile.scan_error_rate, prompt):
+            return JSONResponse({"error": "Injected mock failure"}, status_code=profile.error_status)
+        flagged = FLAG_MARKER in prompt or profile.random.random() < profile.flag_rate
+        return JSONResponse({
+            "id": uuid.uuid4().hex,
+            "result": {"outcome": "flagged" if flagged else "cleared", "scannerResults": []}
+        })
+
+    # Anthropic Message Batches
+
+    def anthropic_batch_view(request: Request, batch: dict) -> dict:
+        ended = state.ready(batch)
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        for entry in batch["results"]:
+            counts[entry["result"]["type"] if ended else "processing"] += 1
+        created = batch["submitted"]
+        return {
+            "id": batch["id"],
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(created)),
+            "expires_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(created + 86400)),
+            "ended_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(created + state.batch_delay)) if ended else None,
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": str(request.url_for("anthropic_batch_results", batch_id=batch["id"])) if ended else None
+        }
+
+    async def anthropic_create_batch(request: Request):
+        body = await request.json()
+        results = []
+        for item in body.get("requests", []):
+            params = item["params"]
+            reply = stub_reply(params["messages"])
+            if FAIL_MARKER in reply:
+                result = {"type": "errored", "error": {"type": "error", "error": {
+                    "type": "invalid_request_error", "message": "Stub failure requested"}}}
+            else:
+                input_tokens, output_tokens = stub_usage(params["messages"], reply)
+                result = {"type": "succeeded", "message": {
+                    "id": f"msg_{uuid.uuid4().hex[:24]}",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": params["model"],
+                    "content": [{"type": "text", "text": reply}],
+                    "stop_reason": "end_turn",
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens}
+                }}
+            results.append({"custom_id": item["custom_id"], "result": result})
+        batch = {"id": f"msgbatch_{uuid.uuid4().hex[:24]}", "submitted": time.time(), "results": results}
+        state.anthropic_batches[batch["id"]] = batch
+        return JSONResponse(anthropic_batch_view(request, batch))
+
+    async def anthropic_get_batch(request: Request):
+        batch = state.anthropic_batches.get(request.path_params["batch_id"])
+        if batch is None:
+            return JSONResponse({"type": "error", "error": {"type": "not_found_error", "message": "No such batch"}},
+                                status_code=404)
+        return JSONResponse(anthropic_batch_view(request, batch))
+
+    async def anthropic_batch_results(request: Request):
+        batch = state.anthropic_batches.get(request.path_params["batch_id"])
+        if batch is None or not state.ready(batch):
+            return JSONResponse({"type": "error", "error": {"type": "not_found_error", "message": "Not ready"}},
+                                status_code=404)
+        lines = "".join(json.dumps(entry) + "\n" for entry in batch["results"])
+        return Response(lines, media_type="application/binary")
+
+    # OpenAI Files and Batch API
+
+    async def openai_upload_file(request: Request):
+        form = await request.form()
+        upload = form["file"]
+        content = await upload.read()
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        state.files[file_id] = content
+        return JSONResponse({
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": upload.filename or "batch.jsonl",
+            "purpose": form.get("purpose", "batch"),
+            "status": "processed"
+        })
+
+    async def openai_file_content(request: Request):
+        content = state.files.get(request.path_params["file_id"])
+        if content is None:
+            return JSONResponse({"error": {"message": "No such file", "type": "invalid_request_error"}},
+                                status_code=404)
+        return Response(content, media_type="application/octet-stream")
+
+    def openai_batch_view(batch: dict) -> dict:
+        ended = state.ready(batch)
+        if ended and batch["output_file_id"] is None:
+            # Write the result files the first time a finished batch is looked at
+            output_lines, error_lines = [], []
+            for line in state.files[batch["input_file_id"]].decode("utf-8").splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                messages = item["body"]["messages"]
+                reply = stub_reply(messages)
+                if FAIL_MARKER in reply:
+                    error_lines.append(json.dumps({
+                        "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                        "custom_id": item["custom_id"],
+                        "response": {"status_code": 400, "request_id": uuid.uuid4().hex, "body": {
+                            "error": {"message": "Stub failure requested", "type": "invalid_request_error"}}},
+                        "error": None
+                    }))
+                    continue
+                input_tokens, output_tokens = stub_usage(messages, reply)
+                output_lines.append(json.dumps({
+                    "id": f"batch_req_{uuid.uuid4().hex[:24]}",
+                    "custom_id": item["custom_id"],
+                    "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": {
+                        "id": f"chatcmpl-{uuid.uuid4().hex}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": item["body"]["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                                     "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                                  "total_tokens": input_tokens + output_tokens}
+                    }},
+                    "error": None
+                }))
+                batch["completed"] += 1
+            batch["failed"] = len(error_lines)
+            batch["output_file_id"] = f"file-{uuid.uuid4().hex[:24]}"
+            state.files[batch["output_file_id"]] = "".join(line + "\n" for line in output_lines).encode()
+            if error_lines:
+                batch["error_file_id"] = f"file-{uuid.uuid4().hex[:24]}"
+                state.files[batch["error_file_id"]] = "".join(line + "\n" for line in error_lines).encode()
+        return {
+            "id": batch["id"],
+            "object": "batch",
+            "endpoint": batch["endpoint"],
+            "input_file_id": batch["input_file_id"],
+            "completion_window": "24h",
+            "status": "completed" if ended else "in_progress",
+            "output_file_id": batch["output_file_id"],
+            "error_file_id": batch["error_file_id"],
+            "created_at": int(batch["submitted"]),
+            "request_counts": {"total": batch["total"], "completed": batch["completed"], "failed": batch["failed"]}
+        }
+
+    async def openai_create_batch(request: Request):
+        body = await request.json()
+        content = state.files.get(body["input_file_id"])
+        if content is None:
+            return JSONResponse({"error": {"message": "No such file", "type": "invalid_request_error"}},
+                                status_code=400)
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex[:24]}",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "submitted": time.time(),
+            "total": sum(1 for line in content.splitlines() if line.strip()),
+            "completed": 0,
+            "failed": 0,
+            "output_file_id": None,
+            "error_file_id": None
+        }
+        state.openai_batches[batch["id"]] = batch
+        return JSONResponse(openai_batch_view(batch))
+
+    async def openai_get_batch(request: Request):
+        batch = state.openai_batches.get(request.path_params["batch_id"])
+        if batch is None:
+            return JSONResponse({"error": {"message": "No such batch", "type": "invalid_request_error"}},
+                                status_code=404)
+        return JSONResponse(openai_batch_view(batch))
+
+    return Starlette(routes=[
+        Route("/health", health),
+        Route("/v1/models", models),
+        Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+        Route("/backend/v1/scans", scans, methods=["POST"]),
+        Route("/v1/messages/batches", anthropic_create_batch, methods=["POST"]),
+        Route("/v1/messages/batches/{batch_id}", anthropic_get_batch),
+        Route("/v1/messages/batches/{batch_id}/results", anthropic_batch_results, name="anthropic_batch_results"),
+        Route("/v1/files", openai_upload_file, methods=["POST"]),
+        Route("/v1/files/{file_id}/content", openai_file_content),
+        Route("/v1/batches", openai_create_batch, methods=["POST"]),
+        Route("/v1/batches/{batch_id}", openai_get_batch)
+    ])
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """MockProfile options, shared with benchmark.py"""
+    parser.add_argument("--ttft-ms", type=float, default=200, help="median time to first token")
+    parser.add_argument("--ttft-sigma", type=float, default=0.5, help="log-normal spread of TTFT")
+    parser.add_argument("--tokens-per-sec", type=float, default=50)
+    parser.add_argument("--output-tokens", type=int, default=64)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of completions that fail")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--scan-ms", type=float, default=150, help="median guardrails scan latency")
+    parser.add_argument("--scan-sigma", type=float, default=0.3)
+    parser.add_argument("--scan-error-rate", type=float, default=0.0)
+    parser.add_argument("--flag-rate", type=float, default=0.0, help="fraction of prompts flagged")
+    parser.add_argument("--seed", type=int)
+
+
+def profile_from_args(args) -> MockProfile:
+    return MockProfile(
+        ttft_ms=args.ttft_ms,
+        ttft_sigma=args.ttft_sigma,
+        tokens_per_sec=args.tokens_per_sec,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        scan_ms=args.scan_ms,
+        scan_sigma=args.scan_sigma,
+        scan_error_rate=args.scan_error_rate,
+        flag_rate=args.flag_rate,
+        seed=args.seed
+    )
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Stub provider and guardrails APIs for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--batch-delay", type=float, default=2.0, help="seconds until a batch finishes")
+    add_profile_arguments(parser)
+    args = parser.parse_args(argv)
+    uvicorn.run(create_app(args.batch_delay, profile_from_args(args)), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Local guardrails pre-filter that settles clear-cut prompts without a remote scan
+
+Only high-precision matches are decided here: prompts carrying a real
+credential (provider API key, AWS key, GitHub token, private key block)
+are flagged, and allowlisted prompts are cleared. Anything that merely
+sounds risky, like asking for "your password" or quoting a long number,
+is left to the Calypso scan, whose policy can tell a question about
+password policies from an exfiltration attempt.
+
+PREFILTER_ALLOWLIST_FILE adds known-safe prompts and PREFILTER_BLOCKLIST_FILE
+phrases your policy always blocks, one per line ("Category: phrase" for
+blocklist lines, "#" starts a comment). Blocklist phrases are found in one
+pass over the prompt's words with an Aho-Corasick automaton, so checking
+stays in the microseconds however long the list grows.
+GUARDRAILS_PREFILTER=0 sends every prompt to the remote scan.
+"""
+import os
+import re
+import string
+import threading
+from collections import deque
+from pathlib import Path
+
+from cache import normalize_prompt
+
+GUARDRAILS_PREFILTER = os.getenv("GUARDRAILS_PREFILTER", "1") not in ("0", "false", "no", "off")
+PREFILTER_BLOCKLIST_FILE = os.getenv("PREFILTER_BLOCKLIST_FILE", "")
+PREFILTER_ALLOWLIST_FILE = os.getenv("PREFILTER_ALLOWLIST_FILE", "")
+
+# Phrase -> category, matched as whole words ignoring case and punctuation. None are
+# built in: a phrase alone rarely settles intent, so only operators' own lists block locally
+BLOCKLIST = {}
+
+# Known-safe prompts, matched whole after normalization (see allow_key)
+ALLOWLIST = [
+    "What is the capital of France?",
+    "Explain quantum computing in simple terms",
+    "What are the best practices for REST API design?",
+    "Summarize the latest trends in machine learning",
+    "Tell me how to make coffee beans"
+]
+
+# Credential formats, each searched on its own so the regex engine can skip ahead to its
+# literal prefix; a match must also stand alone as a token (see secret_kinds)
+SECRETS = {
+    "anthropic_key": re.compile(r"sk-ant-(?:api|admin)\d\d-[A-Za-z0-9_-]{80,}"),
+    "openai_key": re.compile(r"sk-(?!ant-)(?:proj-|svcacct-|admin-)?[A-Za-z0-9_-]{40,}"),
+    "aws_key": re.compile(r"(?:AKIA|ASIA)[0-9A-Z]{16}"),
+    "github_token": re.compile(r"gh[pousr]_[A-Za-z0-9]{36}"),
+    "private_key": re.compile(r"-----BEGIN (?:[A-Z]+ )*PRIVATE KEY-----")
+}
+SECRET_LABELS = {
+    "anthropic_key": "an Anthropic API key",
+    "openai_key": "an OpenAI API key",
+    "aws_key": "an AWS access key",
+    "github_token": "a GitHub token",
+    "private_key": "a private key"
+}
+_TOKEN_CHARS = set(string.ascii_letters + string.digits + "_-")
+
+_APOSTROPHES = str.maketrans({"‘": "'", "’": "'", "ʼ": "'", "`": "'"})
+# Punctuation separates words like whitespace does
+_SEPARATORS = str.maketrans({char: " " for char in string.punctuation + "‘’ʼ"})
+
+
+def allow_key(prompt: str) -> str:
+    """Allowlist form of a prompt: normalized, case-folded, without closing punctuation"""
+    return normalize_prompt(prompt).translate(_APOSTROPHES).casefold().rstrip(" ?!.")
+
+
+def words(text: str) -> list:
+    """Case-folded words of text, split at whitespace and punctuation"""
+    return text.casefold().translate(_SEPARATORS).split()
+
+
+def random_looking(token: str) -> bool:
+    """Keys mix digits with upper and lower case; slugs and words rarely do"""
+    return any(c.isdigit() for c in token) and any(c.isupper() for c in token) and any(c.islower() for c in token)
+
+
+def secret_kinds(prompt: str) -> list:
+    """Credential formats found in the prompt, each matched as a whole token"""
+    found = []
+    for name, pattern in SECRETS.items():
+        for match in pattern.finditer(prompt):
+            start, end = match.span()
+            if name != "private_key" and (
+                    (start and prompt[start - 1] in _TOKEN_CHARS)
+                    or (end < len(prompt) and prompt[end] in _TOKEN_CHARS)
+                    or (name in ("anthropic_key", "openai_key") and not random_looking(match.group()))):
+                continue
+            found.append(name)
+            break
+    return found
+
+
+def read_list(path: str) -> list:
+    """Non-empty, non-comment lines of a list file"""
+    if not path:
+        return []
+    lines = Path(path).expanduser().read_text(encoding="utf-8").splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith("#")]
+
+
+class PhraseMatcher:
+    """Aho-Corasick automaton over words, finding every phrase in a text in one pass"""
+
+    def __init__(self, phrases):
+        # Trie of the phrases' words; node 0 is the root
+        goto = [{}]
+        output = [[]]
+        for phrase in phrases:
+            node = 0
+            for word in words(phrase):
+                if word not in goto[node]:
+                    goto[node][word] = len(goto)
+                    goto.append({})
+                    output.append([])
+                node = goto[node][word]
+            if node:
+                output[node].append(phrase)
+
+        # Breadth-first, fold each node's failure link into a full transition table,
+        # so matching takes exactly one lookup per word
+        self._next = [dict(goto[0])] + [{} for _ in goto[1:]]
+        fail = [0] * len(goto)
+        pending = deque(goto[0].values())
+        while pending:
+            node = pending.popleft()
+            output[node] = output[node] + output[fail[node]]
+            self._next[node] = {**self._next[fail[node]], **goto[node]}
+            for word, child in goto[node].items():
+                fail[child] = self._next[fail[node]].get(word, 0) if node else 0
+                pending.append(child)
+        self._output = [tuple(phrases) for phrases in output]
+
+    def find(self, text: str) -> list:
+        """Every phrase occurring in text as whole words, in order of where it ends"""
+        matches = []
+        transitions = self._next
+        outputs = self._output
+        node = 0
+        for word in words(text):
+            node = transitions[node].get(word, 0)
+            if outputs[node]:
+                matches.extend(outputs[node])
+        return matches
+
+
+class Prefilter:
+    """Credential, blocklist and allowlist checks in front of the remote guardrails scan"""
+
+    def __init__(self, blocklist: dict = None, allowlist: list = None):
+        blocklist = BLOCKLIST if blocklist is None else blocklist
+        self.blocklist = {phrase.casefold(): category for phrase, category in blocklist.items()}
+        self.allowlist = {allow_key(prompt) for prompt in (allowlist or ALLOWLIST)}
+        self._matcher = PhraseMatcher(self.blocklist)
+        self._lock = threading.Lock()
+        self.flagged = 0
+        self.cleared = 0
+        self.scanned = 0
+
+    @classmethod
+    def from_files(cls, blocklist_file: str = PREFILTER_BLOCKLIST_FILE,
+                   allowlist_file: str = PREFILTER_ALLOWLIST_FILE) -> "Prefilter":
+        """The built-in lists extended by the given files"""
+        blocklist = dict(BLOCKLIST)
+        for line in read_list(blocklist_file):
+            category, separator, phrase = line.partition(":")
+            if separator and phrase.strip():
+                blocklist[phrase.strip()] = category.strip()
+            else:
+                blocklist[line] = "Blocklist"
+        return cls(blocklist, ALLOWLIST + read_list(allowlist_file))
+
+    def check(self, prompt: str) -> dict:
+        """A guardrails verdict for a clear-cut prompt, or None to scan it remotely"""
+        result = self._verdict(prompt)
+        with self._lock:
+            if result is None:
+                self.scanned += 1
+            elif result["blocked"]:
+                self.flagged += 1
+            else:
+                self.cleared += 1
+        return result
+
+    def _verdict(self, prompt: str):
+        key = allow_key(prompt)
+        categories = []
+        reasons = []
+        for phrase in self._matcher.find(key) if self.blocklist else ():
+            category = self.blocklist[phrase]
+            if category not in categories:
+                categories.append(category)
+                reasons.append(f'mentions "{phrase}"')
+
+        for name in secret_kinds(prompt):
+            if "Secrets" not in categories:
+                categories.append("Secrets")
+            reasons.append(f"contains {SECRET_LABELS[name]}")
+
+        if categories:
+            return {
+                "allowed": False,
+                "blocked": True,
+                "reason": f"Local policy: prompt {' and '.join(reasons)}",
+                "categories": categories,
+                "prefilter": True
+            }
+        if key in self.allowlist:
+            return {
+                "allowed": True,
+                "blocked": False,
+                "reason": "Content approved (allowlist)",
+                "categories": [],
+                "prefilter": True
+            }
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            checked = self.flagged + self.cleared + self.scanned
+            return {
+                "flagged": self.flagged,
+                "cleared": self.cleared,
+                "scanned": self.scanned,
+                "offload_rate": (self.flagged + self.cleared) / checked if checked else 0.0
+            }
+
+
+def default_prefilter():
+    """A Prefilter from the configured list files, or None when GUARDRAILS_PREFILTER is off"""
+    return Prefilter.from_files() if GUARDRAILS_PREFILTER else None
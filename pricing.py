@@ -0,0 +1,43 @@
+"""List prices per model, for estimating what each answer cost"""
+from context import count_tokens
+
+# USD per million tokens: (input, output)
+MODEL_PRICES = {
+    "claude-sonnet-4-5-20250929": (3.00, 15.00),
+    "claude-3-5-sonnet-20241022": (3.00, 15.00),
+    "claude-3-5-haiku-20241022": (0.80, 4.00),
+    "claude-3-opus-20240229": (15.00, 75.00),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-3.5-turbo": (0.50, 1.50)
+}
+
+# Prompt-cache reads are billed at a fraction of the input price, Anthropic cache writes at a premium
+CACHE_READ_MULTIPLIER = {"Anthropic": 0.1, "OpenAI": 0.5}
+CACHE_WRITE_MULTIPLIER = {"Anthropic": 1.25}
+
+
+def turn_cost(provider: str, model: str, stats: dict, response: str = ""):
+    """Estimated USD cost of one answer from its token counts; None if the model's price is unknown
+
+    Token counts the provider did not report are estimated from the
+    context sent (stats["context_tokens"]) and the response text.
+    """
+    if provider == "Local":
+        return 0.0
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    input_price, output_price = prices
+
+    input_tokens = stats.get("input_tokens") or stats.get("context_tokens") or 0
+    cached = stats.get("cached_input_tokens") or 0
+    written = stats.get("cache_write_tokens") or 0
+    output_tokens = stats.get("output_tokens") or (count_tokens(response) if response else 0)
+    return (
+        max(input_tokens - cached - written, 0) * input_price
+        + cached * input_price * CACHE_READ_MULTIPLIER.get(provider, 1.0)
+        + written * input_price * CACHE_WRITE_MULTIPLIER.get(provider, 1.0)
+        + output_tokens * output_price
+    ) / 1_000_000
@@ -0,0 +1,85 @@
+"""Request shaping for provider prompt caches and cached-token accounting"""
+from context import message_tokens
+
+# Anthropic only caches prefixes at least this long (tokens)
+ANTHROPIC_MIN_CACHEABLE_TOKENS = {
+    "claude-3-5-haiku-20241022": 2048
+}
+DEFAULT_MIN_CACHEABLE_TOKENS = 1024
+
+# Anthropic allows up to 4 breakpoints; two rolling ones cover a chat
+ANTHROPIC_BREAKPOINTS = 2
+
+
+def anthropic_min_cacheable(model: str) -> int:
+    return ANTHROPIC_MIN_CACHEABLE_TOKENS.get(model, DEFAULT_MIN_CACHEABLE_TOKENS)
+
+
+def anthropic_messages(messages: list, model: str, cache: bool = True) -> list:
+    """Convert messages to Anthropic format with cache breakpoints
+
+    The newest user message gets a breakpoint so this turn writes the
+    whole conversation to the cache, and the user message before it gets
+    one so the prefix written last turn is read back. Breakpoints are
+    only placed once the prefix is long enough for Anthropic to cache.
+    """
+    shaped = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+    if not cache:
+        return shaped
+
+    model_minimum = anthropic_min_cacheable(model)
+    prefix_tokens = []
+    running = 0
+    for msg in messages:
+        running += message_tokens(msg)
+        prefix_tokens.append(running)
+
+    user_indexes = [i for i, msg in enumerate(shaped) if msg["role"] == "user"]
+    for i in user_indexes[-ANTHROPIC_BREAKPOINTS:]:
+        if prefix_tokens[i] >= model_minimum:
+            shaped[i]["content"] = [{
+                "type": "text",
+                "text": shaped[i]["content"],
+                "cache_control": {"type": "ephemeral"}
+            }]
+    return shaped
+
+
+def local_cache_options(cache: bool = True) -> dict:
+    """Extra request fields that let llama.cpp-style servers reuse their KV cache
+
+    vLLM and SGLang reuse prefixes automatically and ignore the field.
+    """
+    return {"cache_prompt": True} if cache else {}
+
+
+def anthropic_usage(usage) -> dict:
+    """Input/output token counts from an Anthropic usage object"""
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return {
+        # Anthropic reports the uncached remainder as input_tokens
+        "input_tokens": usage.input_tokens + cache_read + cache_write,
+        "output_tokens": usage.output_tokens,
+        "cached_input_tokens": cache_read,
+        "cache_write_tokens": cache_write
+    }
+
+
+def openai_usage(usage: dict, timings: dict = None) -> dict:
+    """Input/output token counts from an OpenAI-compatible usage payload
+
+    llama.cpp reports reused prompt tokens in timings.cache_n instead of
+    usage.prompt_tokens_details.
+    """
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens")
+    if cached is None and timings:
+        cached = timings.get("cache_n")
+    stats = {
+        "input_tokens": usage.get("prompt_tokens"),
+        "output_tokens": usage.get("completion_tokens")
+    }
+    if cached is not None:
+        stats["cached_input_tokens"] = cached
+    return stats
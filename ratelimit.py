@@ -0,0 +1,220 @@
+"""Client-side rate limits and fair admission control per provider key"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Limits per (provider, api_key); 0 disables a limit
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "0"))
+RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", "0"))
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "8"))
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "120"))
+
+# How often waiting requests re-check their queue position and cancellation
+POLL_INTERVAL = 0.25
+
+
+class AdmissionTimeout(Exception):
+    """Raised when a request waited in the queue longer than allowed"""
+
+
+class TokenBucket:
+    """Refills continuously at rate_per_minute up to capacity"""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if available now)"""
+        self._refill()
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def refund(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class Ticket:
+    """One request waiting for, or holding, admission"""
+
+    def __init__(self, session: str, tokens: int):
+        self.session = session
+        self.tokens = tokens
+        self.enqueued_at = time.perf_counter()
+        self.wait = 0.0
+
+
+class Limiter:
+    """Requests/min and tokens/min buckets, a concurrency cap and a fair queue
+
+    Waiting requests are served round-robin across sessions, so one
+    session with several requests queued (failover, hedging) cannot
+    starve the others.
+    """
+
+    def __init__(self, rpm: int = RATE_LIMIT_RPM, tpm: int = RATE_LIMIT_TPM,
+                 max_concurrent: int = MAX_CONCURRENT_REQUESTS):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrent = max_concurrent
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+
+    def _order(self) -> list:
+        """Waiting tickets in the order they will be admitted"""
+        queues = [list(tickets) for tickets in self._queues.values()]
+        order = []
+        for round_index in range(max((len(tickets) for tickets in queues), default=0)):
+            order.extend(tickets[round_index] for tickets in queues if round_index < len(tickets))
+        return order
+
+    def _admission_delay(self, ticket: Ticket):
+        """0 to admit now, seconds to wait for a bucket, or None to wait for a release"""
+        order = self._order()
+        if order[0] is not ticket:
+            return None
+        if self.max_concurrent and self.in_flight >= self.max_concurrent:
+            return None
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.wait_time(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.wait_time(ticket.tokens))
+        return delay
+
+    def _dequeue(self, ticket: Ticket):
+        tickets = self._queues.get(ticket.session)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        if tickets:
+            # The session goes to the back of the rotation
+            self._queues.move_to_end(ticket.session)
+        else:
+            del self._queues[ticket.session]
+
+    def acquire(self, session: str, tokens: int = 0, on_wait=None, timeout: float = ADMISSION_TIMEOUT,
+                should_cancel=None):
+        """Block until the request may go out; returns a Ticket, or None if cancelled
+
+        on_wait(position) is called whenever the 1-based queue position
+        changes, and with 0 once a request that had to wait is admitted.
+        """
+        if self.tokens is not None:
+            # A request bigger than the whole bucket would otherwise wait forever
+            tokens = min(tokens, self.tokens.capacity)
+        ticket = Ticket(session, tokens)
+        deadline = time.monotonic() + timeout if timeout else None
+        last_position = None
+
+        with self._cond:
+            self._queues.setdefault(session, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    delay = self._admission_delay(ticket)
+                    if delay == 0:
+                        self._dequeue(ticket)
+                        self.in_flight += 1
+                        self.admitted += 1
+                        if self.requests is not None:
+                            self.requests.take(1)
+                        if self.tokens is not None:
+                            self.tokens.take(ticket.tokens)
+                        ticket.wait = time.perf_counter() - ticket.enqueued_at
+                        if last_position is not None:
+                            self.queued += 1
+                            self.total_wait += ticket.wait
+                        break
+                    position = self._order().index(ticket) + 1
+                    self._cond.wait(POLL_INTERVAL if delay is None else min(delay, POLL_INTERVAL))
+
+                if position != last_position:
+                    last_position = position
+                    if on_wait is not None:
+                        on_wait(position)
+                if should_cancel is not None and should_cancel():
+                    return None
+                if deadline is not None and time.monotonic() > deadline:
+                    with self._cond:
+                        self.timeouts += 1
+                    raise AdmissionTimeout(f"Waited {timeout:.0f}s in the request queue")
+        finally:
+            with self._cond:
+                self._dequeue(ticket)
+                self._cond.notify_all()
+
+        if last_position is not None and on_wait is not None:
+            on_wait(0)
+        return ticket
+
+    def release(self, ticket: Ticket, used_tokens: int = None):
+        """Finish a request, returning unused estimated tokens to the bucket"""
+        with self._cond:
+            self.in_flight = max(self.in_flight - 1, 0)
+            if self.tokens is not None and used_tokens is not None and used_tokens < ticket.tokens:
+                self.tokens.refund(ticket.tokens - used_tokens)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "waiting": sum(len(tickets) for tickets in self._queues.values()),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "timeouts": self.timeouts,
+                "total_wait": self.total_wait
+            }
+
+
+class AdmissionControl:
+    """Process-wide limiters keyed by (provider, api_key)"""
+
+    def __init__(self, rpm: int = RATE_LIMIT_RPM, tpm: int = RATE_LIMIT_TPM,
+                 max_concurrent: int = MAX_CONCURRENT_REQUESTS):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def limiter(self, provider: str, api_key: str) -> Limiter:
+        # Never keep raw API keys around as dictionary keys
+        key = (provider, hashlib.sha256((api_key or "").encode()).hexdigest()[:16])
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = Limiter(self.rpm, self.tpm, self.max_concurrent)
+            return limiter
+
+    def stats(self) -> dict:
+        """Counters per provider, summed over API keys"""
+        with self._lock:
+            limiters = list(self._limiters.items())
+        totals = {}
+        for (provider, _), limiter in limiters:
+            total = totals.setdefault(provider, {})
+            for key, value in limiter.stats().items():
+                total[key] = total.get(key, 0) + value
+        return totals
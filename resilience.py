@@ -0,0 +1,318 @@
+"""Retries with decorrelated jitter and per-endpoint circuit breakers"""
+import asyncio
+import contextlib
+import email.utils
+import os
+import random
+import sys
+import threading
+import time
+
+import anthropic
+import httpx
+import openai
+import requests
+
+import tracing
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "8"))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RECOVERY_TIMEOUT = float(os.getenv("BREAKER_RECOVERY_TIMEOUT", "30"))
+
+# Statuses worth retrying: timeouts, conflicts, rate limits, overload and gateway errors
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+# Read timeouts count against the endpoint but are not retried: each attempt would wait
+# the full timeout again (a 60s Local timeout would take minutes to fail)
+READ_TIMEOUTS = (requests.exceptions.ReadTimeout, httpx.ReadTimeout, anthropic.APITimeoutError, openai.APITimeoutError)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class RetryableStatusError(Exception):
+    """Raised for a retryable HTTP status from a plain HTTP endpoint"""
+
+    def __init__(self, status_code: int, headers=None, body: str = ""):
+        super().__init__(f"Server returned {status_code} - {body}" if body else f"Server returned {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose breaker is open"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} is failing; skipping it for {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def raise_for_retryable_status(response):
+    """Turn a retryable status on a requests/httpx response into an exception"""
+    if response.status_code in RETRYABLE_STATUS:
+        headers = dict(response.headers)
+        response.close()
+        raise RetryableStatusError(response.status_code, headers)
+
+
+async def araise_for_retryable_status(response):
+    """Async counterpart of raise_for_retryable_status for httpx responses"""
+    if response.status_code in RETRYABLE_STATUS:
+        headers = dict(response.headers)
+        await response.aclose()
+        raise RetryableStatusError(response.status_code, headers)
+
+
+def parse_retry_after(headers) -> float:
+    """Seconds to wait according to retry-after-ms / Retry-After, or None"""
+    if not headers:
+        return None
+    lowered = {key.lower(): value for key, value in dict(headers).items()}
+    if "retry-after-ms" in lowered:
+        try:
+            return float(lowered["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = lowered.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value)
+        return max(parsed.timestamp() - time.time(), 0.0) if parsed else None
+
+
+def classify(error: Exception) -> tuple:
+    """Return (retryable, retry_after_seconds) for an exception"""
+    if isinstance(error, READ_TIMEOUTS):
+        return False, None
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        response = getattr(error, "response", None)
+        headers = getattr(error, "headers", None) or getattr(response, "headers", None)
+        return status in RETRYABLE_STATUS, parse_retry_after(headers)
+    transient = (
+        anthropic.APIConnectionError,
+        openai.APIConnectionError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        httpx.TransportError
+    )
+    return isinstance(error, transient), None
+
+
+def decorrelated_jitter(previous: float, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Next backoff delay: uniform between base and 3x the previous delay, capped"""
+    return min(cap, random.uniform(base, max(previous * 3, base)))
+
+
+class CircuitBreaker:
+    """Closed → open after repeated failures → half-open trial after a cool-down"""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 recovery_timeout: float = BREAKER_RECOVERY_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through"""
+        with self._lock:
+            if self._state == OPEN:
+                waited = time.monotonic() - self._opened_at
+                if waited < self.recovery_timeout:
+                    raise CircuitOpenError(self.name, self.recovery_timeout - waited)
+                self._state = HALF_OPEN
+                self._trial_in_flight = False
+            if self._state == HALF_OPEN:
+                # Let exactly one trial request through
+                if self._trial_in_flight:
+                    raise CircuitOpenError(self.name, 1)
+                self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """End a call that says nothing about the endpoint's health, leaving the state as it was"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+
+class BreakerRegistry:
+    """One circuit breaker per endpoint name"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(name)
+            return breaker
+
+    def states(self) -> dict:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.state for breaker in breakers}
+
+
+# Process-wide breakers shared by the app, gateway and batch tools
+BREAKERS = BreakerRegistry()
+
+
+def _record_error(circuit: CircuitBreaker, error: Exception):
+    """Count a failed attempt against the endpoint's breaker, if it reflects on the endpoint"""
+    if circuit is None or isinstance(error, CircuitOpenError):
+        return
+    if classify(error)[0] or isinstance(error, READ_TIMEOUTS):
+        circuit.record_failure()
+    else:
+        # Client errors say nothing about the endpoint's health, so they neither open nor close it
+        circuit.release_trial()
+
+
+def _next_delay(error: Exception, attempt: int, previous: float, max_attempts: int):
+    """Delay before the next attempt, or None to give up"""
+    retryable, retry_after = classify(error)
+    if not retryable or attempt >= max_attempts:
+        return None
+    if retry_after is not None:
+        # A server asking us to wait longer than we are willing to is a hard failure
+        return retry_after if retry_after <= RETRY_MAX_DELAY else None
+    return decorrelated_jitter(previous)
+
+
+def call_with_retry(fn, breaker: str = None, max_attempts: int = RETRY_MAX_ATTEMPTS):
+    """Call fn(), retrying transient failures behind the endpoint's breaker
+
+    Only wrap the part of a request that is safe to repeat: sending it
+    and reading the status, never consuming a partially streamed body.
+    """
+    circuit = BREAKERS.get(breaker) if breaker else None
+    delay = RETRY_BASE_DELAY
+    for attempt in range(1, max_attempts + 1):
+        try:
+            # One span per attempt, so retries show up as siblings in a trace
+            with tracing.span("request attempt", endpoint=breaker, **{"http.request.resend_count": attempt - 1}):
+                if circuit is not None:
+                    circuit.before_call()
+                result = fn()
+        except Exception as error:
+            _record_error(circuit, error)
+            delay = _next_delay(error, attempt, delay, max_attempts)
+            if delay is None:
+                raise
+            tracing.add_event("retry", endpoint=breaker, attempt=attempt, delay=delay)
+            time.sleep(delay)
+            continue
+        if circuit is not None:
+            circuit.record_success()
+        return result
+
+
+async def acall_with_retry(fn, breaker: str = None, max_attempts: int = RETRY_MAX_ATTEMPTS):
+    """Async counterpart of call_with_retry; fn returns an awaitable"""
+    circuit = BREAKERS.get(breaker) if breaker else None
+    delay = RETRY_BASE_DELAY
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with tracing.span("request attempt", endpoint=breaker, **{"http.request.resend_count": attempt - 1}):
+                if circuit is not None:
+                    circuit.before_call()
+                result = await fn()
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            _record_error(circuit, error)
+            delay = _next_delay(error, attempt, delay, max_attempts)
+            if delay is None:
+                raise
+            tracing.add_event("retry", endpoint=breaker, attempt=attempt, delay=delay)
+            await asyncio.sleep(delay)
+            continue
+        if circuit is not None:
+            circuit.record_success()
+        return result
+
+
+@contextlib.contextmanager
+def entered_with_retry(make_context, check=None, breaker: str = None, max_attempts: int = RETRY_MAX_ATTEMPTS):
+    """Enter make_context()'s context manager, retrying failures to open it
+
+    check, if given, runs on the entered value and may raise (for example
+    raise_for_retryable_status) to trigger a retry.
+    """
+    def open_once():
+        context = make_context()
+        value = context.__enter__()
+        if check is not None:
+            try:
+                check(value)
+            except BaseException:
+                context.__exit__(*sys.exc_info())
+                raise
+        return context, value
+
+    context, value = call_with_retry(open_once, breaker, max_attempts)
+    try:
+        yield value
+    except BaseException:
+        if not context.__exit__(*sys.exc_info()):
+            raise
+    else:
+        context.__exit__(None, None, None)
+
+
+@contextlib.asynccontextmanager
+async def aentered_with_retry(make_context, check=None, breaker: str = None,
+                              max_attempts: int = RETRY_MAX_ATTEMPTS):
+    """Async counterpart of entered_with_retry"""
+    async def open_once():
+        context = make_context()
+        value = await context.__aenter__()
+        if check is not None:
+            try:
+                await check(value)
+            except BaseException:
+                await context.__aexit__(*sys.exc_info())
+                raise
+        return context, value
+
+    context, value = await acall_with_retry(open_once, breaker, max_attempts)
+    try:
+        yield value
+    except BaseException:
+        if not await context.__aexit__(*sys.exc_info()):
+            raise
+    else:
+        await context.__aexit__(None, None, None)
@@ -0,0 +1,244 @@
+"""Ordered provider failover with optional hedged requests"""
+import contextlib
+import contextvars
+import os
+import queue
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+
+import tracing
+
+# Hedge deadline bounds (seconds); the deadline itself is the backend's p95 TTFT
+HEDGE_DEFAULT_DEADLINE = float(os.getenv("HEDGE_DEFAULT_DEADLINE", "3.0"))
+HEDGE_MIN_DEADLINE = float(os.getenv("HEDGE_MIN_DEADLINE", "0.5"))
+HEDGE_MAX_DEADLINE = float(os.getenv("HEDGE_MAX_DEADLINE", "10.0"))
+HEDGE_MIN_SAMPLES = 5
+
+
+def is_error_chunk(chunk: str) -> bool:
+    """Provider calls report failures as a single '❌ ...' chunk"""
+    return chunk.startswith("❌")
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+# The CancelScope of the background stream the current thread is producing, if any
+CURRENT_CANCEL = contextvars.ContextVar("current_cancel", default=None)
+
+
+class CancelScope:
+    """Cancel flag for a stream produced on a worker thread that also closes its upstream
+
+    A worker only sees the flag between chunks; shutting down the upstream
+    connections registered with on_cancel stops one that is blocked
+    waiting for the next chunk right away.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._closers = []
+
+    def is_set(self) -> bool:
+        return self._cancelled
+
+    def set(self):
+        with self._lock:
+            self._cancelled = True
+            closers, self._closers = self._closers, []
+        for close in closers:
+            # The reader may be closing it at the same moment
+            with contextlib.suppress(Exception):
+                close()
+
+    def on_cancel(self, close):
+        """Call close() on cancellation, or right away if already cancelled"""
+        with self._lock:
+            if not self._cancelled:
+                self._closers.append(close)
+                return
+        close()
+
+
+def response_socket(response):
+    """The socket under a streaming requests or httpx response, or None"""
+    extensions = getattr(response, "extensions", None)
+    if extensions is not None:
+        network_stream = extensions.get("network_stream")
+        return network_stream.get_extra_info("socket") if network_stream is not None else None
+    connection = getattr(getattr(response, "raw", None), "connection", None)
+    return getattr(connection, "sock", None)
+
+
+def close_on_cancel(response):
+    """Cut a streaming requests/httpx response off when the stream it feeds is cancelled"""
+    scope = CURRENT_CANCEL.get()
+    if scope is None:
+        return
+    sock = response_socket(response)
+    if sock is None:
+        scope.on_cancel(response.close)
+    else:
+        # Closing a response does not wake a thread blocked reading it; shutting the socket down does
+        scope.on_cancel(lambda: sock.shutdown(socket.SHUT_RDWR))
+
+
+def stream_cancelled() -> bool:
+    """True once the background stream the current thread is producing has been cancelled"""
+    scope = CURRENT_CANCEL.get()
+    return scope is not None and scope.is_set()
+
+
+class Router:
+    """Serve a turn from the first backend in a chain that produces a token
+
+    Each backend is a (label, factory) pair where factory(stats) returns a
+    chunk generator. A backend that fails before its first token hands
+    over to the next one. With hedging, the next backend also starts when
+    the current one has not produced a token within its p95 TTFT, and
+    whichever answers first wins while the other is cancelled.
+    """
+
+    def __init__(self, window: int = 50):
+        self._lock = threading.Lock()
+        self._ttfts = defaultdict(lambda: deque(maxlen=window))
+        self.served = defaultdict(int)
+        self.failovers = 0
+        self.hedges = 0
+
+    def record_ttft(self, label: str, ttft: float):
+        with self._lock:
+            self._ttfts[label].append(ttft)
+
+    def hedge_deadline(self, label: str) -> float:
+        """Seconds to wait for a first token before hedging"""
+        with self._lock:
+            samples = list(self._ttfts[label])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DEADLINE
+        return min(max(percentile(samples, 0.95), HEDGE_MIN_DEADLINE), HEDGE_MAX_DEADLINE)
+
+    def stream(self, backends: list, stats: dict, hedge: bool = False, prepare_thread=None):
+        """Yield the winning backend's chunks, recording it in stats["backend"]
+
+        prepare_thread, if given, is called with each worker thread before
+        it starts (the app uses it to attach the Streamlit script context).
+        """
+        events = queue.Queue()
+        cancels = {}
+        attempt_stats = {}
+        started_at = {}
+        running = set()
+        launched = 0
+        winner = None
+        last_error = "❌ Error: No provider is configured to serve this request."
+
+        def launch(index: int):
+            label, factory = backends[index]
+            cancel = threading.Event()
+            cancels[index] = cancel
+            attempt_stats[index] = {}
+            started_at[index] = time.perf_counter()
+            running.add(index)
+
+            def produce():
+                chunks = factory(attempt_stats[index])
+                try:
+                    for chunk in chunks:
+                        if cancel.is_set():
+                            break
+                        events.put((index, chunk))
+                finally:
+                    chunks.close()
+                    events.put((index, None))
+
+            # Carry the caller's context (e.g. the current trace span) into the worker
+            worker = threading.Thread(
+                target=contextvars.copy_context().run, args=(produce,), name=f"route-{label}", daemon=True
+            )
+            if prepare_thread is not None:
+                prepare_thread(worker)
+            worker.start()
+
+        try:
+            if backends:
+                launch(0)
+                launched = 1
+
+            while running:
+                # Only wait for the hedge deadline while no backend has answered
+                timeout = None
+                can_hedge = hedge and winner is None and launched < len(backends)
+                if can_hedge:
+                    newest = launched - 1
+                    elapsed = time.perf_counter() - started_at[newest]
+                    timeout = max(self.hedge_deadline(backends[newest][0]) - elapsed, 0)
+
+                try:
+                    index, chunk = events.get(timeout=timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.hedges += 1
+                    tracing.add_event("hedge", backend=backends[launched][0])
+                    launch(launched)
+                    launched += 1
+                    continue
+
+                if chunk is None:
+                    running.discard(index)
+                    if winner is None and not running and launched < len(backends):
+                        # Nothing produced a token: fail over to the next backend
+                        with self._lock:
+                            self.failovers += 1
+                        tracing.add_event("failover", backend=backends[launched][0], error=last_error)
+                        launch(launched)
+                        launched += 1
+                    if winner == index:
+                        break
+                    continue
+
+                if winner is None:
+                    if not chunk or is_error_chunk(chunk):
+                        last_error = chunk or last_error
+                        cancels[index].set()
+                        continue
+
+                    winner = index
+                    label = backends[index][0]
+                    self.record_ttft(label, time.perf_counter() - started_at[index])
+                    with self._lock:
+                        self.served[label] += 1
+                    stats["backend"] = label
+                    if index > 0:
+                        stats["fallback"] = True
+                    for other, cancel in cancels.items():
+                        if other != index:
+                            cancel.set()
+
+                if index == winner:
+                    yield chunk
+
+            if winner is None:
+                yield last_error
+            else:
+                stats.update({
+                    key: value for key, value in attempt_stats[winner].items()
+                    if key not in stats
+                })
+        finally:
+            for cancel in cancels.values():
+                cancel.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "served": dict(self.served),
+                "failovers": self.failovers,
+                "hedges": self.hedges
+            }
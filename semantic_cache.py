@@ -0,0 +1,146 @@
+"""Embedding-similarity prompt cache backed by a NumPy vector index"""
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from cache import normalize_prompt
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # optional dependency
+    SentenceTransformer = None
+
+
+class HashingEmbedder:
+    """Dependency-free embedder using hashed word and character n-grams"""
+
+    def __init__(self, dim: int = 1024, char_ngrams: tuple = (3, 4, 5)):
+        self.dim = dim
+        self.char_ngrams = char_ngrams
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text: str):
+        text = normalize_prompt(text).lower()
+        words = re.findall(r"\w+", text)
+        yield from (f"w:{word}" for word in words)
+        yield from (f"b:{a} {b}" for a, b in zip(words, words[1:]))
+        padded = f" {' '.join(words)} "
+        for n in self.char_ngrams:
+            for i in range(len(padded) - n + 1):
+                yield f"c:{padded[i:i + n]}"
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            h = zlib.crc32(feature.encode("utf-8"))
+            # The top bit picks the sign so collisions tend to cancel out
+            vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SentenceEmbedder:
+    """Local CPU sentence-transformers model"""
+
+    def __init__(self, model_name: str):
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = self.model.encode(normalize_prompt(text), normalize_embeddings=True)
+        return np.asarray(vector, dtype=np.float32)
+
+
+def load_embedder(model_name: str = ""):
+    """Use a sentence-transformers model when available, else hashed n-grams"""
+    if model_name and SentenceTransformer is not None:
+        try:
+            return SentenceEmbedder(model_name)
+        except Exception:
+            pass
+    return HashingEmbedder()
+
+
+class SemanticCache:
+    """Serve cached answers for prompts that are near-duplicates of earlier ones
+
+    Entries live in a fixed-size matrix of unit vectors, so a lookup is a
+    single matrix-vector product. Entries are scoped by a namespace (for
+    example provider, model and prior conversation) and only match within
+    it. When full, the least recently used slot is overwritten.
+    """
+
+    def __init__(self, embedder=None, maxsize: int = 2000, threshold: float = 0.9):
+        self.embedder = embedder or HashingEmbedder()
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((maxsize, self.embedder.dim), dtype=np.float32)
+        self._namespaces = np.full(maxsize, -1, dtype=np.int64)
+        self._last_used = np.zeros(maxsize, dtype=np.float64)
+        self._prompts = [None] * maxsize
+        self._responses = [None] * maxsize
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _namespace_id(self, namespace: str) -> int:
+        # Hashing keeps no per-namespace bookkeeping around after eviction
+        return hash(namespace)
+
+    def lookup(self, prompt: str, namespace: str, threshold: float = None):
+        """Return (response, similarity, cached_prompt) or None on a miss"""
+        threshold = self.threshold if threshold is None else threshold
+        vector = self.embedder.embed(prompt)
+
+        namespace_id = self._namespace_id(namespace)
+        with self._lock:
+            if self._size:
+                scores = self._vectors[:self._size] @ vector
+                scores[self._namespaces[:self._size] != namespace_id] = -1.0
+                best = int(np.argmax(scores))
+                if scores[best] >= threshold:
+                    self._last_used[best] = time.monotonic()
+                    self.hits += 1
+                    return self._responses[best], float(scores[best]), self._prompts[best]
+            self.misses += 1
+            return None
+
+    def add(self, prompt: str, namespace: str, response: str):
+        vector = self.embedder.embed(prompt)
+        with self._lock:
+            if self._size < self.maxsize:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+                self.evictions += 1
+            self._vectors[slot] = vector
+            self._namespaces[slot] = self._namespace_id(namespace)
+            self._last_used[slot] = time.monotonic()
+            self._prompts[slot] = prompt
+            self._responses[slot] = response
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+            self._namespaces[:] = -1
+            self._prompts = [None] * self.maxsize
+            self._responses = [None] * self.maxsize
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "embedder": self.embedder.name
+            }
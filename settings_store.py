@@ -0,0 +1,184 @@
+"""Saved settings cached in memory, written in the background, one file per user
+
+save() only updates memory and arms a short timer, so rapid sidebar
+changes coalesce into a single write SETTINGS_WRITE_DELAY seconds after
+the first unsaved one. Writes go to a temp file beside the target and are
+renamed over it while holding an exclusive lock file, so readers never see
+half a file and concurrent sessions or processes cannot interleave.
+load() re-reads a file only when it has changed on disk.
+
+Users are told apart by the X-Forwarded-User header an authenticating
+proxy sets, but only with TRUST_FORWARDED_USER=1: any client can send the
+header itself, so it is ignored unless a proxy in front overwrites it.
+Otherwise everyone shares SETTINGS_FILE as before.
+"""
+import atexit
+import contextlib
+import errno
+import json
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # optional dependency (not on Windows)
+    fcntl = None
+
+from cache import hash_key
+
+SETTINGS_FILE = Path.home() / ".coffee_ai_settings.json"
+# Per-user settings files, named by a hash of the user
+SETTINGS_DIR = Path(os.getenv("SETTINGS_DIR", str(Path.home() / ".coffee_ai_settings.d")))
+SETTINGS_WRITE_DELAY = float(os.getenv("SETTINGS_WRITE_DELAY", "1.0"))
+# Only enable behind a proxy that authenticates users and sets (overwrites) X-Forwarded-User
+TRUST_FORWARDED_USER = os.getenv("TRUST_FORWARDED_USER", "0").lower() in ("1", "true", "yes", "on")
+
+
+def forwarded_user(headers) -> str:
+    """The proxy-authenticated user from request headers, or "" unless TRUST_FORWARDED_USER is set"""
+    if not TRUST_FORWARDED_USER:
+        return ""
+    return headers.get("X-Forwarded-User", "") or ""
+
+
+class SettingsStore:
+    """Thread-safe settings files with an mtime-checked read cache and debounced atomic writes"""
+
+    def __init__(self, path: Path = SETTINGS_FILE, user_dir: Path = SETTINGS_DIR,
+                 write_delay: float = SETTINGS_WRITE_DELAY):
+        self.path = Path(path)
+        self.user_dir = Path(user_dir)
+        self.write_delay = write_delay
+        self._lock = threading.Lock()
+        # path -> (file signature, settings) as last read or written
+        self._cache = {}
+        self._pending = {}
+        self._timers = {}
+        atexit.register(self.flush)
+
+    def path_for(self, user: str = "") -> Path:
+        if not user:
+            return self.path
+        return self.user_dir / f"{hash_key(user)[:32]}.json"
+
+    def load(self, user: str = "") -> dict:
+        """The user's settings, unsaved changes included; {} if none were saved"""
+        path = self.path_for(user)
+        with self._lock:
+            if path in self._pending:
+                return dict(self._pending[path])
+            cached = self._cache.get(path)
+        signature = _signature(path)
+        if signature is None:
+            return {}
+        if cached is not None and cached[0] == signature:
+            return dict(cached[1])
+
+        with open(path, "r", encoding="utf-8") as f:
+            settings = json.load(f)
+        with self._lock:
+            self._cache[path] = (signature, settings)
+        return dict(settings)
+
+    def save(self, settings: dict, user: str = ""):
+        """Queue settings to be written; changes made before the write coalesce into it"""
+        path = self.path_for(user)
+        with self._lock:
+            cached = self._cache.get(path)
+            if path not in self._pending and cached is not None and cached[1] == settings:
+                return
+            self._pending[path] = dict(settings)
+            if path in self._timers:
+                return
+            timer = threading.Timer(self.write_delay, self._write, (path,))
+            timer.daemon = True
+            self._timers[path] = timer
+        timer.start()
+
+    def clear(self, user: str = ""):
+        """Drop the user's saved settings, including any write still queued"""
+        path = self.path_for(user)
+        with self._lock:
+            self._pending.pop(path, None)
+            self._cache.pop(path, None)
+            timer = self._timers.pop(path, None)
+        if timer is not None:
+            timer.cancel()
+        with _file_lock(path):
+            path.unlink(missing_ok=True)
+
+    def flush(self):
+        """Write every queued change now"""
+        with self._lock:
+            paths = list(self._pending)
+        for path in paths:
+            self._write(path)
+
+    def _write(self, path: Path):
+        with self._lock:
+            timer = self._timers.pop(path, None)
+            settings = self._pending.get(path)
+        if timer is not None:
+            timer.cancel()
+        if settings is None:
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with _file_lock(path):
+                with self._lock:
+                    if self._pending.get(path) is not settings:
+                        # Cleared, or superseded by a newer change with its own write queued
+                        return
+                # mkstemp files are private to the owner, which suits saved API keys
+                fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump(settings, f, separators=(",", ":"))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    try:
+                        os.replace(temp_path, path)
+                    except OSError as e:
+                        if e.errno not in (errno.EBUSY, errno.EXDEV):
+                            raise
+                        # A file bind-mounted into a container cannot be renamed over
+                        path.write_text(json.dumps(settings, separators=(",", ":")), encoding="utf-8")
+                finally:
+                    Path(temp_path).unlink(missing_ok=True)
+                signature = _signature(path)
+        except OSError as e:
+            print(f"⚠️ Could not save settings to {path}: {e}", file=sys.stderr)
+            return
+        with self._lock:
+            # Newer changes made during the write stay queued for the next one
+            if self._pending.get(path) is settings:
+                del self._pending[path]
+            self._cache[path] = (signature, settings)
+
+
+def _signature(path: Path):
+    """Identity of the file's current contents, or None if it does not exist"""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    # A rename swaps the inode, so this changes even within one mtime tick
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path):
+    """Hold an exclusive advisory lock on path's sibling .lock file (no-op without fcntl)"""
+    if fcntl is None:
+        yield
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(path.name + ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,191 @@
+"""Optional OpenTelemetry spans for chat turns, guardrails scans and provider requests
+
+Tracing is off unless OTEL_TRACES_EXPORTER names an exporter:
+
+- console: print finished spans to stdout (works offline)
+- memory: keep them in-process, see finished_spans()
+- otlp: send them to OTEL_EXPORTER_OTLP_ENDPOINT (needs opentelemetry-exporter-otlp)
+
+Requests to the Local server and the guardrails service carry a W3C
+traceparent header for the attempt that sent them. Every helper here is
+a no-op while tracing is off or OpenTelemetry is not installed.
+"""
+import contextlib
+import os
+import sys
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import propagate, trace
+    from opentelemetry.trace import Status, StatusCode
+except ImportError:  # optional dependency
+    trace = None
+
+TRACES_EXPORTER = os.getenv("OTEL_TRACES_EXPORTER", "none").lower()
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "coffee-ai")
+
+_tracer = None
+_memory_exporter = None
+
+
+def setup(exporter: str = TRACES_EXPORTER) -> bool:
+    """Install a tracer provider for the exporter, once per process; False if tracing stays off"""
+    global _tracer, _memory_exporter
+    if _tracer is not None:
+        return True
+    if exporter in ("", "none"):
+        return False
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+    except ImportError:
+        print("⚠️ Tracing needs OpenTelemetry: pip install opentelemetry-sdk", file=sys.stderr)
+        return False
+
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    if exporter == "console":
+        provider.add_span_processor(SimpleSpanProcessor(ConsoleSpanExporter()))
+    elif exporter == "memory":
+        from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+        _memory_exporter = InMemorySpanExporter()
+        provider.add_span_processor(SimpleSpanProcessor(_memory_exporter))
+    elif exporter == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            print("⚠️ OTLP export needs: pip install opentelemetry-exporter-otlp", file=sys.stderr)
+            return False
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    else:
+        print(f"⚠️ Unknown OTEL_TRACES_EXPORTER '{exporter}', tracing is off", file=sys.stderr)
+        return False
+
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("coffee-ai")
+    return True
+
+
+def _clean(attributes: dict) -> dict:
+    return {key: value for key, value in attributes.items() if value is not None}
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """A child of the current span for the duration of the block"""
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=_clean(attributes)) as current:
+        yield current
+
+
+def start_span(name: str, carrier: dict = None, **attributes):
+    """A span that is not made current, parented by carrier's traceparent or a new trace
+
+    End it with end_span(); use_span() makes it current for a block.
+    """
+    if _tracer is None:
+        return None
+    parent = propagate.extract(carrier) if carrier else otel_context.Context()
+    return _tracer.start_span(name, context=parent, attributes=_clean(attributes))
+
+
+@contextlib.contextmanager
+def use_span(current):
+    """Make an unended span current for the block"""
+    if current is None:
+        yield None
+        return
+    with trace.use_span(current, end_on_exit=False):
+        yield current
+
+
+def set_attributes(current, **attributes):
+    if current is not None and current.is_recording():
+        current.set_attributes(_clean(attributes))
+
+
+def end_span(current, error: str = None, **attributes):
+    if current is None:
+        return
+    set_attributes(current, **attributes)
+    if error:
+        current.set_status(Status(StatusCode.ERROR, error))
+    current.end()
+
+
+def add_event(name: str, **attributes):
+    """Record an event on the current span"""
+    if _tracer is not None:
+        trace.get_current_span().add_event(name, _clean(attributes))
+
+
+def inject(headers: dict) -> dict:
+    """Copy of headers with the current span's W3C traceparent (and tracestate) added"""
+    if _tracer is None:
+        return headers
+    carrier = dict(headers)
+    propagate.inject(carrier)
+    return carrier
+
+
+def traced(chunks, name: str, is_error=None, **attributes):
+    """Wrap a chunk generator in a span (chunks itself while tracing is off)
+
+    The span is current only while the next chunk is produced, never
+    between yields, so it cannot leak into the consumer's context.
+    """
+    if _tracer is None:
+        return chunks
+    return _traced(chunks, name, is_error, attributes)
+
+
+def _traced(chunks, name: str, is_error, attributes: dict):
+    current = _tracer.start_span(name, attributes=_clean(attributes))
+    error = None
+    try:
+        while True:
+            with trace.use_span(current, end_on_exit=False):
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+            if is_error is not None and is_error(chunk):
+                error = chunk
+            yield chunk
+    finally:
+        with trace.use_span(current, end_on_exit=False):
+            chunks.close()
+        end_span(current, error)
+
+
+def atraced(chunks, name: str, is_error=None, **attributes):
+    """Async counterpart of traced() for async chunk generators"""
+    if _tracer is None:
+        return chunks
+    return _atraced(chunks, name, is_error, attributes)
+
+
+async def _atraced(chunks, name: str, is_error, attributes: dict):
+    current = _tracer.start_span(name, attributes=_clean(attributes))
+    error = None
+    try:
+        while True:
+            with trace.use_span(current, end_on_exit=False):
+                try:
+                    chunk = await anext(chunks)
+                except StopAsyncIteration:
+                    break
+            if is_error is not None and is_error(chunk):
+                error = chunk
+            yield chunk
+    finally:
+        with trace.use_span(current, end_on_exit=False):
+            await chunks.aclose()
+        end_span(current, error)
+
+
+def finished_spans() -> list:
+    """Spans kept by the "memory" exporter"""
+    return list(_memory_exporter.get_finished_spans()) if _memory_exporter is not None else []